@@ -27,9 +27,10 @@ def main(spec, cancel):
     with run_it(spec) as proc:
         while True:
             if cancel.get():
+                proc.kill()
                 raise CancelledError("Cancelled by request")
             try:
-                out, err = proc.communicate(timeout=5)
+                out, err = proc.communicate(timeout=1)
             except sp.TimeoutExpired:
                 continue
             if proc.returncode:
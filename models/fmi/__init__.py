@@ -17,7 +17,8 @@ timeout	Simulation timeout in seconds or None (default).  Can be overridden
 	by input parameter simsvc.timeout.
 """
 
-import os, logging, multiprocessing as mp
+from concurrent.futures import CancelledError
+import os, logging, time, multiprocessing as mp
 import multiprocessing.connection as mp_conn
 import dask, fmpy
 from distributed import get_worker
@@ -58,13 +59,16 @@ class FMU_process(mp.Process):
         finally:
             s.pin.close()
 
-def simulate(*args, timeout=None):
+def simulate(*args, timeout=None, cancel=None):
     """Simulate FMU.
 
     If timeout is None and there is only one thread, simulate directly.
     Otherwise use a subprocess.  If timeout elapses, kill the subprocess
-    and raise RuntimeError.  args are passed to simulate_direct and
-    its return value is returned.
+    and raise RuntimeError.  If cancel (a simsvc.tasks.Cancel_flag) is
+    given, it is polled every second while waiting for the subprocess,
+    which is killed on cancellation and CancelledError raised.  Direct
+    simulation cannot be cancelled.  args are passed to simulate_direct
+    and its return value is returned.
 
     If running in a daemon process and a subprocess is required, raise
     ValueError.
@@ -77,10 +81,19 @@ def simulate(*args, timeout=None):
             "Try setting distributed.worker.daemon to false.")
     p = FMU_process(*args)
     p.start()
-    ready = mp_conn.wait([p.pout, p.sentinel], timeout)
-    if not ready:
-        p.terminate()
-        raise RuntimeError("Timeout in FMU simulation")
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        wt = (1 if deadline is None
+              else max(0, min(1, deadline - time.monotonic())))
+        ready = mp_conn.wait([p.pout, p.sentinel], wt)
+        if ready:
+            break
+        if cancel is not None and cancel.get():
+            p.terminate()
+            raise CancelledError("Cancelled by request")
+        if deadline is not None and time.monotonic() >= deadline:
+            p.terminate()
+            raise RuntimeError("Timeout in FMU simulation")
     if p.pout not in ready:
         p.join()
         raise RuntimeError("FMU subprocess terminated without output")
@@ -110,11 +123,13 @@ def task(spec, cancel):
             t1 = v
         elif k == "simsvc.timeout":
             timeout = v
+        elif k.startswith("simsvc."):
+            pass
         elif k.startswith("p."):
             pars[k[2:]] = v
         else:
             unk.append(k)
     if unk:
         warn += "Unknown inputs: {}\n".format(", ".join(unk))
-    recs = simulate(fmu, t0, t1, pars, timeout=timeout)
+    recs = simulate(fmu, t0, t1, pars, timeout=timeout, cancel=cancel)
     return process_results(recs, {'warnings': warn})
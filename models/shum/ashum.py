@@ -23,7 +23,7 @@ async def run_it(spec):
 
 async def poll_cancel(run, cancel):
     while not cancel.get():
-        await asyncio.sleep(5)
+        await asyncio.sleep(1)
     run.cancel()
 
 async def main(spec, cancel):
@@ -2,6 +2,8 @@
 # Simple synchronous client for the simulation service.
 # Based on the requests library.
 
+import io
+import numpy
 import requests
 from threading import Condition
 import socketio
@@ -54,24 +56,72 @@ def is_completed(status):
 def endslash(url):
     return url if (len(url) > 0 and url[-1] == '/') else url + '/'
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# MessagePack extension type of numeric arrays in server responses.
+ARRAY_EXT = 1
+
+def _ext_hook(code, data):
+    if code == ARRAY_EXT:
+        return numpy.load(io.BytesIO(data), allow_pickle=False)
+    return msgpack.ExtType(code, data)
+
+def decode_response(r):
+    """Decode the content of response r according to its content type.
+    MessagePack arrays are returned as NumPy arrays.
+    """
+    ctype = r.headers.get('Content-Type', "").split(";")[0].strip()
+    if ctype == 'application/msgpack':
+        return msgpack.unpackb(r.content, ext_hook=_ext_hook, raw=False,
+                               strict_map_key=False)
+    elif ctype == 'application/x-npy':
+        return numpy.load(io.BytesIO(r.content), allow_pickle=False)
+    else:
+        return r.json()
+
 #XXX This class tries to be thread safe, particularly run_job, but is based
 # on requests.Session, whose thread safety is doubtful.
 class SimsvcClient:
     def __init__(self, service_url, auth=None,
-                 timeout_sec=60, wait_status_retries=11):
+                 timeout_sec=60, wait_status_retries=11, binary=True,
+                 use_socketio=True, progress_handler=None):
+        """If binary is true and msgpack is installed, inputs, results
+        and defaults are transferred as MessagePack and large numeric
+        arrays in them are returned as NumPy arrays rather than lists.
+        If use_socketio is false, no Socket.IO connection is made and
+        waiting for jobs uses long polling (wait_jobs) instead.
+        If progress_handler is given, it is called as
+        progress_handler(jobid, fraction, values) on progress reports
+        of watched jobs (requires Socket.IO).
+        """
         super().__init__()
         self.service_url = endslash(service_url)
         self.timeout_sec = timeout_sec
         self.wait_status_retries = wait_status_retries
+        self.var_headers = (
+            {'Accept': "application/msgpack, application/json;q=0.5"}
+            if binary and msgpack is not None else {})
         self.session = requests.Session()
         if auth is not None:
             self.session.auth = auth
         self.watched = set()
         self.job_terminated = Condition()
-        self.sio = socketio.Client()
-        self.sio.on('terminated', self.on_terminated)
-        path = urlparse(self.service_url)[2].rstrip("/") + "/socket.io"
-        self.sio.connect(self.service_url, socketio_path=path)
+        # Whether the server supports subscriptions; None if unknown.
+        self.can_subscribe = None
+        self.progress_handler = progress_handler
+        if use_socketio:
+            self.sio = socketio.Client()
+            self.sio.on('terminated', self.on_terminated)
+            self.sio.on('terminated_batch', self.on_terminated_batch)
+            self.sio.on('progress', self.on_progress)
+            self.sio.on('progress_batch', self.on_progress_batch)
+            path = urlparse(self.service_url)[2].rstrip("/") + "/socket.io"
+            self.sio.connect(self.service_url, socketio_path=path)
+        else:
+            self.sio = None
 
     def on_terminated(self, arg):
         """Socket.IO termination event handler.
@@ -88,6 +138,39 @@ class SimsvcClient:
             else:
                 self.job_terminated.notify_all()
 
+    def on_terminated_batch(self, args):
+        """Socket.IO handler for lists of termination events."""
+        for arg in args:
+            self.on_terminated(arg)
+
+    def on_progress(self, arg):
+        """Socket.IO progress event handler.
+        Passes reports of watched jobs to progress_handler.
+        """
+        if self.progress_handler is not None and arg['job'] in self.watched:
+            self.progress_handler(arg['job'], arg['progress'], arg['values'])
+
+    def on_progress_batch(self, args):
+        """Socket.IO handler for lists of progress events."""
+        for arg in args:
+            self.on_progress(arg)
+
+    def _subscribe(self, jobids):
+        """Subscribe to Socket.IO events of jobids only.
+        Servers without subscriptions send events of all jobs anyway.
+        """
+        if self.can_subscribe is False:
+            return
+        try:
+            self.sio.call('subscribe', {'jobs': list(jobids), 'batch': True},
+                          timeout=(self.timeout_sec if self.can_subscribe
+                                   else 5))
+        except socketio.exceptions.TimeoutError:
+            if self.can_subscribe is None:
+                self.can_subscribe = False
+        else:
+            self.can_subscribe = True
+
     def __enter__(self):
         return self
 
@@ -96,7 +179,8 @@ class SimsvcClient:
 
     def close(self):
         self.session.close()
-        self.sio.disconnect()
+        if self.sio is not None:
+            self.sio.disconnect()
 
     def _join_url(self, *parts):
         return urljoin(self.service_url, '/'.join(map(str, parts)))
@@ -106,16 +190,18 @@ class SimsvcClient:
         r.raise_for_status()
         return r
 
+    def _get_var(self, url, params=None):
+        r = self.session.get(url, params=params, headers=self.var_headers,
+                             timeout=self.timeout_sec)
+        r.raise_for_status()
+        return decode_response(r)
+
     def _get_dict(self, url, keys):
         url = endslash(url)
         if keys is None:
-            r = self.session.get(url, params={'values': 'true'},
-                                 timeout=self.timeout_sec)
+            return self._get_var(url, {'values': 'true'})
         else:
-            r = self.session.get(url, params={'only': ",".join(keys)},
-                                 timeout=self.timeout_sec)
-        r.raise_for_status()
-        return r.json()
+            return self._get_var(url, {'only': ",".join(keys)})
 
     def _put_json(self, url, value):
         r = self.session.put(url, json=value, timeout=self.timeout_sec)
@@ -133,7 +219,7 @@ class SimsvcClient:
         return self._get_dict(self._join_url('default'), keys)
 
     def get_default_value(self, key):
-        return self._get(self._join_url('default', key)).json()
+        return self._get_var(self._join_url('default', key))
 
     def put_default_values(self, default_dict):
         self._put_json(self._join_url('default/'), default_dict)
@@ -141,22 +227,72 @@ class SimsvcClient:
     def put_default_value(self, key, value):
         self._put_json(self._join_url('default', key), value)
 
+    def _iter_pages(self, params, retries=0, path='jobs/', headers=None):
+        """Yield the decoded bodies of a paginated listing at path.
+        Follows the next links of the server until the last page.
+        """
+        url = self._join_url(path)
+        while url is not None:
+            try:
+                r = self.session.get(url, params=params, headers=headers,
+                                     timeout=self.timeout_sec)
+                r.raise_for_status()
+            except requests.ConnectionError:
+                if retries <= 0:
+                    raise
+                retries -= 1
+                continue
+            yield decode_response(r)
+            url = r.links.get('next', {}).get('url')
+            if url is not None:
+                # The next link carries all parameters.
+                url = urljoin(r.url, url)
+                params = None
+
+    def _list_params(self, states, since, until, page_size):
+        params = {'limit': page_size}
+        if states is not None:
+            params['state'] = ",".join(
+                s.name if isinstance(s, JobStatus) else s for s in states)
+        if since is not None:
+            params['since'] = since
+        if until is not None:
+            params['until'] = until
+        return params
+
+    def iter_job_ids(self, states=None, since=None, until=None,
+                     page_size=1000):
+        """Iterate over job ids in ascending order, fetching pages lazily.
+        states is a collection of JobStatus (or names) to include, since and
+        until bound the job creation time (seconds since the epoch).
+        """
+        for page in self._iter_pages(
+                self._list_params(states, since, until, page_size)):
+            yield from page
+
+    def iter_job_statuses(self, states=None, since=None, until=None,
+                          page_size=1000, retries=0):
+        """Iterate over (job id, JobStatus) pairs like iter_job_ids.
+        """
+        params = self._list_params(states, since, until, page_size)
+        params['status'] = 'true'
+        for page in self._iter_pages(params, retries):
+            for k, v in page.items():
+                yield int(k), JobStatus[v]
+
     def get_job_ids(self):
-        return self._get(self._join_url('jobs/')).json()
+        return list(self.iter_job_ids())
 
     def get_job_statuses(self, jobids=None, retries=0):
+        if jobids is None:
+            return dict(self.iter_job_statuses(retries=retries))
         url = self._join_url('jobs/')
         while True:
             try:
-                if jobids is None:
-                    r = self.session.get(
-                        url, params={'status': 'true'},
-                        timeout=self.timeout_sec)
-                else:
-                    r = self.session.get(
-                        url, params={'status': 'true',
-                                     'only': ",".join(map(str, jobids))},
-                        timeout=self.timeout_sec)
+                r = self.session.get(
+                    url, params={'status': 'true',
+                                 'only': ",".join(map(str, jobids))},
+                    timeout=self.timeout_sec)
                 r.raise_for_status()
                 return dict((int(k), JobStatus[v]) for k,v in r.json().items())
             except requests.ConnectionError:
@@ -164,17 +300,77 @@ class SimsvcClient:
                     raise
                 retries -= 1
 
-    def post_job(self, inputs_dict):
+    def _post_params(self, cache, priority):
+        params = {}
+        if not cache:
+            params['cache'] = 'false'
+        if priority is not None:
+            params['priority'] = priority
+        return params
+
+    def post_job(self, inputs_dict, cache=True, priority=None):
         r = self.session.post(self._join_url('jobs/'),
+                              params=self._post_params(cache, priority),
                               json=inputs_dict, timeout=self.timeout_sec)
         r.raise_for_status()
         if r.status_code != requests.codes.created:
-            raise Exception('Unexpected status ' + r.status_code)
+            raise Exception('Unexpected status %s' % r.status_code)
+        return r.json()
+
+    def post_jobs(self, inputs_list, cache=True, priority=None):
+        r = self.session.post(self._join_url('jobs/batch'),
+                              params=self._post_params(cache, priority),
+                              json=list(inputs_list), timeout=self.timeout_sec)
+        r.raise_for_status()
+        if r.status_code != requests.codes.created:
+            raise Exception('Unexpected status %s' % r.status_code)
         return r.json()
 
     def delete_all_jobs(self):
         self._delete(self._join_url('jobs/'))
 
+    def post_sweep(self, design, cache=True, priority=None):
+        """Post a parameter sweep, which the server expands into jobs.
+        design is a dict as described in the REST API documentation,
+        e.g., {"design": "lhs", "inputs": {"x": [0, 1]}, "points": 100}.
+        Returns (sweep id, list of job ids in design order).
+        """
+        r = self.session.post(self._join_url('sweeps/'),
+                              params=self._post_params(cache, priority),
+                              json=design, timeout=self.timeout_sec)
+        r.raise_for_status()
+        if r.status_code != requests.codes.created:
+            raise Exception('Unexpected status %s' % r.status_code)
+        res = r.json()
+        return res['sweep'], res['jobs']
+
+    def get_sweep(self, sweepid):
+        """Return sweep info: design, job ids and job counts by status."""
+        return self._get(self._join_url('sweeps', sweepid)).json()
+
+    def get_sweep_table(self, sweepid, result_keys=None, input_keys=None,
+                        states=None):
+        """Get the inputs and results of the jobs of a sweep as a table,
+        in design order.  Like get_table, except that by default the
+        table has the varied inputs and all results of all jobs.
+        """
+        params = {}
+        if states is not None:
+            params['status'] = ",".join(
+                s.name if isinstance(s, JobStatus) else s for s in states)
+        if input_keys is not None:
+            params['inputs'] = (input_keys if isinstance(input_keys, str)
+                                else ",".join(input_keys))
+        if result_keys is not None:
+            params['vars'] = (result_keys if isinstance(result_keys, str)
+                              else ",".join(result_keys))
+        return self._get_var(self._join_url('sweeps', sweepid, 'results'),
+                             params)
+
+    def delete_sweep(self, sweepid):
+        """Delete a sweep and its jobs."""
+        self._delete(self._join_url('sweeps', sweepid))
+
     def get_job_status(self, jobid, retries=0):
         while True:
             try:
@@ -192,7 +388,15 @@ class SimsvcClient:
         return self._get_dict(self._join_url('jobs', jobid, 'inputs'), keys)
 
     def get_job_input_value(self, jobid, key):
-        return self._get(self._join_url('jobs', jobid, 'inputs', key)).json()
+        return self._get_var(self._join_url('jobs', jobid, 'inputs', key))
+
+    def get_job_progress(self, jobid):
+        """Return the latest progress report of a job as a pair
+        (fraction, values).  Both are None if the job has not
+        reported progress.
+        """
+        p = self._get(self._join_url('jobs', jobid, 'progress')).json()
+        return p['progress'], p['values']
 
     def get_job_error(self, jobid):
         return self._get(self._join_url('jobs', jobid, 'error')).json()
@@ -201,7 +405,19 @@ class SimsvcClient:
         return self._get_dict(self._join_url('jobs', jobid, 'results'), keys)
 
     def get_job_result_value(self, jobid, key):
-        return self._get(self._join_url('jobs', jobid, 'results', key)).json()
+        return self._get_var(self._join_url('jobs', jobid, 'results', key))
+
+    def get_job_result_series(self, jobid, key, start=None, end=None,
+                              step=None, buckets=None, agg=None):
+        """Get a time series result, selected and downsampled on the
+        server.  Returns a dict with times and values.  See the REST API
+        documentation for the parameters.
+        """
+        params = {'from': start, 'to': end, 'step': step,
+                  'buckets': buckets, 'agg': agg}
+        return self._get_var(
+            self._join_url('jobs', jobid, 'results', key),
+            {k: v for k, v in params.items() if v is not None})
 
     def get_job_file(self, jobid, path):
         return self._get(self._join_url('jobs', jobid, 'files', path)).content
@@ -209,11 +425,40 @@ class SimsvcClient:
     def get_job_dir(self, jobid, path=''):
         return self._get(self._join_url('jobs', jobid, 'dir', path)).json()
 
+    def wait_jobs(self, jobids, all=False, timeout=None):
+        """Wait on the server until any (or all) of jobids have
+        terminated or timeout seconds have passed.  Returns a dict
+        jobid -> JobStatus of those of jobids that exist.  The server
+        limits timeout; by default it is what fits in timeout_sec.
+        """
+        if timeout is None:
+            timeout = max(1, self.timeout_sec - 10)
+        r = self.session.get(
+            self._join_url('jobs', 'wait'),
+            params={'ids': ",".join(map(str, jobids)),
+                    'mode': 'all' if all else 'any', 'timeout': timeout},
+            timeout=self.timeout_sec + timeout)
+        r.raise_for_status()
+        return dict((int(k), JobStatus[v]) for k, v in r.json().items())
+
     def wait_for_any_job(self, jobids):
+        if self.sio is None:
+            jobids = frozenset(jobids)
+            while True:
+                statuses = self.wait_jobs(jobids)
+                result = dict((k, s) for k, s in statuses.items()
+                              if is_completed(s))
+                if result:
+                    return result
+                missing = jobids - statuses.keys()
+                if missing:
+                    # The server regards them terminated.
+                    raise KeyError("No such jobs: %s" % sorted(missing))
         timestep = 30.0
         max_timestep = 30.0
         jobids = frozenset(jobids)
         self.watched.update(jobids)
+        self._subscribe(jobids)
         result = dict()
         while True:
             statuses = self.get_job_statuses(jobids,
@@ -249,16 +494,98 @@ class SimsvcClient:
             if delete:
                 self.delete_job(jobid)
 
+    def get_table(self, result_keys=None, input_keys=None,
+                  states=(JobStatus.DONE,), since=None, until=None,
+                  page_size=1000, missing=False):
+        """Get job inputs and results as a table in a few requests.
+
+        Returns a dict mapping column names to lists (or NumPy arrays)
+        of equal length: "job" (ids), "status" (names), "inputs.x" for
+        each x in input_keys and "results.x" for each x in result_keys.
+        The keys are lists of names or "*" for all that occur; missing
+        values are None.  If missing, column "missing" lists for each
+        job the names of the columns that it lacks a value for.
+        states, since and until are as with iter_job_ids.
+        """
+        if states is None:
+            states = list(JobStatus)
+        params = self._list_params(states, since, until, page_size)
+        params['status'] = params.pop('state')
+        if missing:
+            params['missing'] = 'true'
+        if input_keys is not None:
+            params['inputs'] = (input_keys if isinstance(input_keys, str)
+                                else ",".join(input_keys))
+        if result_keys is not None:
+            params['vars'] = (result_keys if isinstance(result_keys, str)
+                              else ",".join(result_keys))
+        pages = list(self._iter_pages(params, path='results/',
+                                      headers=self.var_headers))
+        if len(pages) == 1:
+            return pages[0]
+        # Columns may be missing from pages ("*") and be NumPy arrays.
+        n = 0
+        parts = {}
+        for page in pages:
+            for k, col in page.items():
+                parts.setdefault(k, []).append((n, col))
+            n += len(page['job'])
+        table = {}
+        for k, ps in parts.items():
+            if (len(ps) == len(pages)
+                    and all(isinstance(c, numpy.ndarray) for _, c in ps)):
+                try:
+                    table[k] = numpy.concatenate([c for _, c in ps])
+                    continue
+                except ValueError:
+                    pass
+            col = table[k] = [None] * n
+            for start, c in ps:
+                col[start : start + len(c)] = list(c)
+        return table
+
+    def get_results_frame(self, result_keys=None, input_keys=None, **kws):
+        """Like get_table but return a pandas DataFrame indexed by job id.
+        """
+        import pandas
+        table = self.get_table(result_keys, input_keys, **kws)
+        return pandas.DataFrame(
+            {k: v for k, v in table.items() if k != 'job'},
+            index=pandas.Index(table.get('job', []), name='job'))
+
     def read_all_results(self):
         """Reads all successful job inputs and results from the service.
         Returns dict mapping jobid to (inputs, results) pairs."""
+        try:
+            table = self.get_table("*", "*", missing=True)
+        except requests.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+            # Old server without results/.
+            return self._read_all_results_per_job()
         results = dict()
-        for jobid in self.get_job_ids():
-            status = self.get_job_status(jobid)
-            if status == JobStatus.DONE:
-                inputs = self.get_job_input_values(jobid)
-                result = self.get_job_result_values(jobid)
-                results[jobid] = (inputs, result)
+        missing = table.get('missing')
+        for i, jobid in enumerate(table.get('job', [])):
+            parts = {'inputs.': {}, 'results.': {}}
+            absent = set() if missing is None else set(missing[i])
+            for k, col in table.items():
+                if k in absent:
+                    continue
+                v = col[i]
+                if isinstance(v, numpy.generic):
+                    v = v.item()
+                for pre, d in parts.items():
+                    if k.startswith(pre):
+                        d[k[len(pre):]] = v
+            results[jobid] = (parts['inputs.'], parts['results.'])
+        return results
+
+    def _read_all_results_per_job(self):
+        results = dict()
+        for jobid in self.iter_job_ids(states=[JobStatus.DONE]):
+            inputs = self.get_job_input_values(jobid)
+            result = self.get_job_result_values(jobid)
+            results[jobid] = (inputs, result)
         return results
 
 if __name__ == '__main__':
@@ -282,7 +609,7 @@ if __name__ == '__main__':
         d = {}
     if args.data:
         d.update(json.loads(args.data))
-    with SimsvcClient(args.url) as cli:
+    with SimsvcClient(args.url, binary=False) as cli:
         st, res = cli.run_job(d)
     if st:
         print(json.dumps(res))
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+"""Check that cancellation releases worker cores promptly.
+
+Starts a LocalCluster with a single one-thread worker, launches a task
+that runs a long subprocess the way models/shum does, cancels it with
+simsvc.tasks.Cancel_flag and then times a trivial task on the same
+worker.  Exits with non-zero status if the trivial task does not finish
+within the limit.
+
+simsvc.tasks imports model, thus run this where the server would find
+a model (any model will do).
+"""
+
+from concurrent.futures import CancelledError
+import argparse, subprocess as sp, sys, time
+
+import dask.distributed as dd
+
+from simsvc.tasks import Cancel_flag
+
+def sleeper(cancel, secs):
+    cmd = [sys.executable, "-c", "import time; time.sleep(%s)" % secs]
+    with sp.Popen(cmd, stdin=sp.DEVNULL) as proc:
+        while True:
+            if cancel.get():
+                proc.kill()
+                raise CancelledError("Cancelled by request")
+            try:
+                return proc.wait(timeout=1)
+            except sp.TimeoutExpired:
+                continue
+
+def wait_running(cli, fut, timeout):
+    end = time.monotonic() + timeout
+    while not any(fut.key in ks for ks in cli.processing().values()):
+        if time.monotonic() > end:
+            raise TimeoutError("Task did not start")
+        time.sleep(0.1)
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description="Simsvc cancellation test")
+    p.add_argument('-s', '--sleep', type=float, default=60,
+                   help="Duration of the cancelled task (default %(default)s)")
+    p.add_argument('-l', '--limit', type=float, default=3,
+                   help="Maximum time for the core to be released"
+                   " (default %(default)s)")
+    args = p.parse_args()
+    with dd.LocalCluster(n_workers=1, threads_per_worker=1) as clust, \
+         dd.Client(clust) as cli:
+        canc = Cancel_flag("test", cli)
+        fut = cli.submit(sleeper, canc, args.sleep, pure=False)
+        wait_running(cli, fut, 30)
+        time.sleep(1)
+        t0 = time.time()
+        canc.set(True)
+        fut.cancel()
+        quick = cli.submit(time.time, pure=False)
+        try:
+            t1 = quick.result(timeout=args.limit)
+        except dd.TimeoutError:
+            print("FAIL: core not released in %s s" % args.limit)
+            sys.exit(1)
+        finally:
+            canc.set(False)
+        print("OK: core released in %.2f s" % (t1 - t0))
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+"""Benchmark job posting throughput against the number of frontends.
+
+For each frontend count this starts a fresh ZEO server and python -m
+simsvc with that many frontends sharing it, posts jobs from concurrent
+client threads and reports jobs posted per second and the time from
+the last post until all jobs have terminated.  The server runs
+the model found on PYTHONPATH (or --model-dir) on a local Dask cluster,
+so use a trivial model: we want to measure the server, not the model.
+"""
+
+import argparse, json, os, shutil, subprocess, sys, tempfile, threading, time
+
+import requests
+
+def wait_http(url, proc, timeout=120):
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < timeout:
+        if proc.poll() is not None:
+            raise RuntimeError("Server exited with status %s" % proc.returncode)
+        try:
+            requests.get(url, params={'limit': 1}, timeout=5)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.5)
+    raise RuntimeError("Server did not start in %s s" % timeout)
+
+def post_jobs(url, njobs, nthreads):
+    """Post njobs jobs from nthreads threads.
+    Return (elapsed seconds, number of failed posts).
+    """
+    counts = [njobs // nthreads + (i < njobs % nthreads)
+              for i in range(nthreads)]
+    fails = [0] * nthreads
+    def worker(i):
+        with requests.Session() as s:
+            for k in range(counts[i]):
+                r = s.post(url, json={'x': i, 'k': k}, timeout=60)
+                if r.status_code != 201:
+                    fails[i] += 1
+    ths = [threading.Thread(target=worker, args=(i,))
+           for i in range(nthreads)]
+    t0 = time.monotonic()
+    for t in ths:
+        t.start()
+    for t in ths:
+        t.join()
+    return time.monotonic() - t0, sum(fails)
+
+def wait_done(url, timeout=300):
+    """Wait until no jobs are active.
+    Return elapsed seconds or None on timeout.
+    """
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < timeout:
+        r = requests.get(url, params={'state': "SCHEDULED,RUNNING",
+                                      'limit': 1}, timeout=60)
+        if not r.json():
+            return time.monotonic() - t0
+        time.sleep(0.5)
+    return None
+
+def run(nfront, args, tmp):
+    env = dict(os.environ)
+    zaddr = "127.0.0.1:%d" % args.zeo_port
+    env.update(SIMSVC_ADDR="127.0.0.1:%d" % args.port,
+               SIMSVC_FRONTENDS=str(nfront),
+               LEADER_LOCK=os.path.join(tmp, "leader.lock"),
+               JOB_DB="zeo://" + zaddr,
+               DASK_SIMSVC__CLUSTER__TYPE="local",
+               DASK_SIMSVC__CLUSTER__ARGS=
+               "{'n_workers': 1, 'processes': False}")
+    if args.model_dir:
+        env['PYTHONPATH'] = os.pathsep.join(
+            [args.model_dir, env.get('PYTHONPATH', "")])
+    out = open(os.path.join(tmp, "server-%d.log" % nfront), "w")
+    zeo = subprocess.Popen(
+        [sys.executable, "-m", "ZEO.runzeo", "-a", zaddr,
+         "-f", os.path.join(tmp, "bench-%d.fs" % nfront)],
+        stdout=out, stderr=subprocess.STDOUT)
+    srv = None
+    try:
+        time.sleep(1)
+        srv = subprocess.Popen(
+            [sys.executable, "-m", "simsvc"], env=env,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=out, stderr=subprocess.STDOUT)
+        url = "http://127.0.0.1:%d/jobs/" % args.port
+        wait_http(url, srv)
+        if args.defaults:
+            requests.put(url.replace("/jobs/", "/default/"),
+                         json=json.loads(args.defaults)).raise_for_status()
+        # Let all frontends start up.
+        time.sleep(2 * nfront)
+        post_jobs(url, args.nthreads, args.nthreads)
+        wait_done(url)
+        dt, nfail = post_jobs(url, args.jobs, args.nthreads)
+        return dt, nfail, wait_done(url)
+    finally:
+        for p in [srv, zeo]:
+            if p is not None:
+                p.terminate()
+                p.wait()
+        out.close()
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument('-n', '--frontends', default="1,2,4",
+                   help="Comma-separated frontend counts, default %(default)s")
+    p.add_argument('-j', '--jobs', type=int, default=2000,
+                   help="Jobs to post per run, default %(default)s")
+    p.add_argument('-c', '--nthreads', type=int, default=16,
+                   help="Concurrent client threads, default %(default)s")
+    p.add_argument('-m', '--model-dir', default=None,
+                   help="Directory to add to PYTHONPATH for model")
+    p.add_argument('-d', '--defaults', metavar="JSON", default=None,
+                   help="Default inputs for the model as a JSON object."
+                   "  Jobs are posted with inputs x and k (integers).")
+    p.add_argument('--port', type=int, default=8090,
+                   help="HTTP port, default %(default)s")
+    p.add_argument('--zeo-port', type=int, default=8091,
+                   help="ZEO port, default %(default)s")
+    p.add_argument('-k', '--keep', action='store_true',
+                   help="Keep the temporary directory (logs, databases)")
+    args = p.parse_args()
+    tmp = tempfile.mkdtemp(prefix="simsvc-bench-")
+    try:
+        print("frontends  jobs/s  failed  settle/s")
+        for n in map(int, args.frontends.split(",")):
+            dt, nfail, settle = run(n, args, tmp)
+            print("%9d %7.1f %7d %9s" % (
+                n, args.jobs / dt, nfail,
+                "timeout" if settle is None else "%.1f" % settle), flush=True)
+    finally:
+        if args.keep:
+            print("Output in", tmp)
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
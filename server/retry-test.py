@@ -0,0 +1,305 @@
+#!/usr/bin/python3
+"""Check automatic retries and speculative duplicates of jobs.
+
+Runs the server in this process (threading mode, in-memory job
+database, local Dask cluster) with a test model written to a
+temporary directory and posts jobs through the Flask test client.
+The model fails on the first attempt of a job as asked by its input
+fail: "transient" raises Transient_error, "killed" a real KilledWorker
+as if its worker had died and "bad" a RuntimeError every time, after
+delay seconds.  Input slow makes the first attempt take that many
+seconds, thus a speculative duplicate should finish the job.  A job
+that takes an input from a job that is retried should be relaunched
+with the result of the retry.  Posting a job with an invalid
+simsvc.priority should fail with status 400.  A job with the inputs
+of a finished job should be completed from the result cache, with its
+finish time set and a terminated event.  Subscribing to it then
+should send its terminated event at once without creating its room.
+Concurrent jobs/wait requests for a job should all see it DONE.  A
+job should be RUNNING, with its start time set, while the model runs.
+A retry whose update transaction conflicts should not launch a second
+task when the update runs again.
+
+Checks the final status and number of retries of each job and that
+Socket.IO clients, one receiving all events, one subscribed to the
+job and one subscribed to both, each get exactly one terminated event
+with that status.  Exits
+with non-zero status if anything is other than expected.
+"""
+
+import argparse, os, shutil, sys, tempfile, threading, time
+
+import dask
+import flask_socketio.test_client
+from werkzeug.test import EnvironBuilder
+
+MODEL = '''
+import os, time, types, dask
+from concurrent.futures import CancelledError
+
+@dask.delayed
+def task(spec, cancel):
+    from simsvc.tasks import Transient_error
+    from distributed.scheduler import KilledWorker
+    inp = spec.inputs
+    mark = os.path.join(spec.workdir, "attempts")
+    first = not os.path.exists(mark)
+    with open(mark, "a") as f:
+        f.write("x")
+    fail = inp.get("fail")
+    if first:
+        time.sleep(inp.get("delay", 0))
+    if fail == "bad":
+        raise RuntimeError("Permanent failure")
+    if first and fail == "transient":
+        raise Transient_error("Try again")
+    if first and fail == "killed":
+        lost = types.SimpleNamespace(address="tcp://lost-worker:0")
+        raise KilledWorker(task="simsvc-test", last_worker=lost,
+                           allowed_failures=0)
+    if first and cancel.wait(inp.get("slow", 0)):
+        raise CancelledError("Cancelled by request")
+    return {"sum": inp.get("x", 0) + inp.get("y", 0), "first": first}
+'''
+
+class Remote_environ(EnvironBuilder):
+    """Environment for the Socket.IO test client with a client
+    address, which on_connect requires.
+    """
+    def __init__(s, *args, **kws):
+        kws.setdefault('environ_base', {'REMOTE_ADDR': '127.0.0.1'})
+        super().__init__(*args, **kws)
+
+def post(web, inputs):
+    r = web.post('/jobs/', json=inputs)
+    if r.status_code != 201:
+        raise RuntimeError("POST %s: %s" % (inputs, r.status))
+    return r.get_json()
+
+def wait(web, jid, timeout):
+    """Wait for job jid to terminate and return its info."""
+    end = time.monotonic() + timeout
+    while True:
+        info = web.get('/jobs/%d/info' % jid).get_json()
+        if info["status"] not in ("SCHEDULED", "RUNNING"):
+            return info
+        if time.monotonic() > end:
+            raise TimeoutError("Job %d did not terminate" % jid)
+        time.sleep(0.2)
+
+def terminations(sioc, jid):
+    """Return the statuses of terminated events of job jid received
+    by Socket.IO test client sioc.
+    """
+    return [ev['args'][0]['status'] for ev in sioc.get_received()
+            if ev['name'] == 'terminated' and ev['args'][0]['job'] == jid]
+
+def check(web, sios, inputs, status, attempts, timeout, first=None):
+    """Post a job and check its final status, number of retries and
+    terminated events.  If first is not None, also check that the
+    result first (whether the first attempt produced the results) is
+    that.  sios are the Socket.IO test clients: one in the default
+    room of all events, one to subscribe to the job and one to
+    subscribe to it and all events.  Return true if as expected.
+    """
+    all_sio, job_sio, both_sio = sios
+    all_sio.get_received()
+    jid = post(web, inputs)
+    job_sio.emit('subscribe', {'jobs': [jid]}, callback=True)
+    both_sio.emit('subscribe', {'jobs': [jid], 'all': True}, callback=True)
+    job_sio.get_received()
+    both_sio.get_received()
+    info = wait(web, jid, timeout)
+    time.sleep(5 * dask.config.get('simsvc.server.event-interval'))
+    evs = [terminations(c, jid) for c in sios]
+    ok = (info["status"] == status and info["attempts"] == attempts
+          and all(e == [status.lower()] for e in evs))
+    if first is not None and info["status"] == "DONE":
+        res = web.get('/jobs/%d/results/first' % jid).get_json()
+        ok = ok and res == first
+    print("%s: %s %s, %d retries, events %s (expected %s, %d)"
+          % ("OK" if ok else "FAIL", inputs, info["status"],
+             info["attempts"], evs, status, attempts))
+    return ok
+
+def check_dependent(web, timeout):
+    """Post a job that fails transiently after a second and a job
+    that takes an input from it.  Check that both end DONE, only the
+    first having been retried, with the right result.  Return true if
+    as expected.
+    """
+    up = post(web, {"fail": "transient", "delay": 1, "x": 1, "y": 2})
+    down = post(web, {"x": {"$from": [up, "sum"]}, "y": 10})
+    infos = [wait(web, jid, timeout) for jid in (up, down)]
+    got = [(i["status"], i["attempts"]) for i in infos]
+    res = (web.get('/jobs/%d/results/sum' % down).get_json()
+           if infos[1]["status"] == "DONE" else None)
+    ok = got == [("DONE", 1), ("DONE", 0)] and res == 13
+    print("%s: dependent of a retried job: %s, result %s"
+          " (expected DONE with 1 and 0 retries, 13)"
+          % ("OK" if ok else "FAIL", got, res))
+    return ok
+
+def check_cached(web, all_sio, job_sio, inputs, timeout):
+    """Post a job with inputs twice, the second time after the first
+    is DONE, and check that the second is DONE as a cache hit, with
+    its finish time set and one terminated event received by all_sio.
+    Then check that job_sio gets a terminated event on subscribing to
+    it and that the job has no room.  Return true if as expected.
+    """
+    from simsvc.sockio import job_room
+    wait(web, post(web, inputs), timeout)
+    all_sio.get_received()
+    jid = post(web, inputs)
+    info = web.get('/jobs/%d/info' % jid).get_json()
+    time.sleep(5 * dask.config.get('simsvc.server.event-interval'))
+    evs = terminations(all_sio, jid)
+    job_sio.get_received()
+    job_sio.emit('subscribe', {'jobs': [jid]}, callback=True)
+    sub = terminations(job_sio, jid)
+    rooms = web.application.monitor.sio.server.manager.rooms.get('/', {})
+    ok = (info["status"] == "DONE" and info["finished"] is not None
+          and evs == ["done"] and sub == ["done"]
+          and job_room(jid) not in rooms)
+    print("%s: cached %s %s, finished %s, events %s, on subscribe %s"
+          " (expected DONE, a time, ['done'], ['done'])"
+          % ("OK" if ok else "FAIL", inputs, info["status"],
+             info["finished"], evs, sub))
+    return ok
+
+def check_waiters(web, n, timeout):
+    """Post a job that takes a couple of seconds and wait for it with
+    n concurrent jobs/wait requests, which flush updates in turn.
+    Return true if all of them see it DONE.
+    """
+    jid = post(web, {"delay": 2, "x": 5})
+    got = [None] * n
+    def waiter(i):
+        r = web.get('/jobs/wait?ids=%d&timeout=%s' % (jid, timeout))
+        got[i] = r.get_json().get(str(jid))
+    ths = [threading.Thread(target=waiter, args=(i,)) for i in range(n)]
+    for th in ths:
+        th.start()
+    for th in ths:
+        th.join()
+    ok = got == ["DONE"] * n
+    print("%s: %d concurrent waits got %s (expected DONE)"
+          % ("OK" if ok else "FAIL", n, got))
+    return ok
+
+def check_running(web, timeout):
+    """Post a job whose model takes three seconds and check that it is
+    seen RUNNING, with its start time set, before it is DONE.  Return
+    true if it is.
+    """
+    jid = post(web, {"delay": 3, "y": 1})
+    end = time.monotonic() + timeout
+    seen = []
+    while time.monotonic() < end:
+        info = web.get('/jobs/%d/info' % jid).get_json()
+        if not seen or seen[-1] != info["status"]:
+            seen.append(info["status"])
+        if info["status"] == "RUNNING":
+            started = info["started"]
+        if info["status"] not in ("SCHEDULED", "RUNNING"):
+            break
+        time.sleep(0.1)
+    ok = "RUNNING" in seen and seen[-1] == "DONE" and started is not None
+    print("%s: statuses %s (expected RUNNING with a start time, then DONE)"
+          % ("OK" if ok else "FAIL", seen))
+    return ok
+
+def check_conflict(web, timeout):
+    """Post a job that fails transiently and make the update
+    transaction that retries it fail on a conflict.  Check that the
+    job is retried once and that no task remains in flight.  Return
+    true if so.
+    """
+    from ZODB.POSException import ConflictError
+    app = web.application
+    base = app.retried
+    speculate = app.speculate
+    def conflicting(conn):
+        if app.retried > base:
+            app.speculate = speculate
+            raise ConflictError("Simulated conflict")
+        return speculate(conn)
+    app.speculate = conflicting
+    jid = post(web, {"fail": "transient", "x": 2})
+    info = wait(web, jid, timeout)
+    app.speculate = speculate
+    time.sleep(1)
+    ok = (info["status"] == "DONE" and info["attempts"] == 1
+          and app.retried == base + 1 and not app.in_flight)
+    print("%s: conflict on retry: %s, %d retries, %d counted,"
+          " in flight %s (expected DONE, 1, 1, none)"
+          % ("OK" if ok else "FAIL", info["status"], info["attempts"],
+             app.retried - base, dict(app.in_flight)))
+    return ok
+
+def check_rejected(web, inputs):
+    """Check that posting a job with inputs fails with status 400.
+    Return true if it does.
+    """
+    r = web.post('/jobs/', json=inputs)
+    ok = r.status_code == 400
+    print("%s: %s rejected with %s (expected 400)"
+          % ("OK" if ok else "FAIL", inputs, r.status))
+    return ok
+
+def make_app(tmp, retries):
+    """Return the server app using the test model in tmp.  Tasks are
+    duplicated if they take three times as long as the slowest of the
+    earlier ones (at least three).
+    """
+    with open(os.path.join(tmp, "model.py"), "w") as f:
+        f.write(MODEL)
+    sys.path.insert(0, tmp)
+    os.environ['JOB_DB'] = 'memory://'
+    os.environ['WORK_DIR'] = os.path.join(tmp, "work")
+    os.mkdir(os.environ['WORK_DIR'])
+    from simsvc import create_app
+    dask.config.set({
+        'simsvc.cluster.type': 'local',
+        'simsvc.cluster.args': {'n_workers': 1, 'threads_per_worker': 2,
+                                'processes': False},
+        'simsvc.cache.enabled': True,
+        'simsvc.tasks.retries': retries,
+        'simsvc.tasks.speculate.factor': 3,
+        'simsvc.tasks.speculate.quantile': 1,
+        'simsvc.tasks.speculate.min-history': 3})
+    return create_app(async_mode='threading')
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description="Simsvc retry test")
+    p.add_argument('-t', '--timeout', type=float, default=60,
+                   help="Maximum duration of a job (default %(default)s)")
+    args = p.parse_args()
+    tmp = tempfile.mkdtemp()
+    try:
+        flask_socketio.test_client.EnvironBuilder = Remote_environ
+        app = make_app(tmp, retries=2)
+        web = app.test_client()
+        sios = [app.monitor.sio.test_client(app) for i in range(3)]
+        t = args.timeout
+        ok = all([
+            check_rejected(web, {"simsvc.priority": "high"}),
+            check_rejected(web, {"simsvc.priority": [1]}),
+            # Before there is history for duplicating tasks.
+            check_dependent(web, t),
+            check_waiters(web, 8, t),
+            check_running(web, t),
+            check_conflict(web, t),
+            check(web, sios, {"x": 1, "y": 2}, "DONE", 0, t),
+            check(web, sios, {"fail": "transient"}, "DONE", 1, t),
+            check(web, sios, {"fail": "killed"}, "DONE", 1, t),
+            check(web, sios, {"fail": "bad"}, "FAILED", 0, t),
+            check_cached(web, sios[0], sios[1], {"x": 3, "y": 4}, t),
+            # With the history above, this gets a duplicate that wins.
+            check(web, sios, {"slow": 2 * t}, "DONE", 0, t,
+                  first=False)])
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    sys.stdout.flush()
+    # The server's background threads would keep us running.
+    os._exit(0 if ok else 1)
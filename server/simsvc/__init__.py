@@ -9,24 +9,30 @@ def create_app(**kws):
     
     kws is passed to the SocketIO constructor.
     
-    Also start up coroutines to periodically sync tasks and pack the ZODB
-    database unless socketio.async_mode is 'threading', in which case only sync
-    and pack once to avoid concurrency issues.  async_mode can be forced by
+    Also start up coroutines to drain task updates, periodically sync tasks
+    and pack the ZODB database unless socketio.async_mode is 'threading', in
+    which case only sync and pack once to avoid concurrency issues and drain
+    updates before each request instead.  async_mode can be forced by
     specifying it in kws, otherwise the Sockiet.IO library auto-detects and
     prefers Eventlet.  We assume that greenthreads are safe against concurrency
     issues, in particular the standard library has not been monkey-patched.
+
+    All of the above only happens in the leader process (see
+    TaskFlask.try_lead).  Other processes only serve requests.  With
+    Eventlet they keep trying to take over leadership.
     """
     from urllib.parse import urljoin
     from flask_socketio import SocketIO
 
     from .tasks import TaskFlask
     from .auth import Auth
-    from . import sockio, jobs, vars
+    from . import sockio, jobs, vars, status, results, sweeps, wait, db
 
     app = TaskFlask(__name__)
     app.config.from_object(Config)
 
     auth = Auth(app)
+    app.waiters = wait.Waiters(app)
 
     p = app.config['SIMSVC_ROOT']
 
@@ -39,29 +45,60 @@ def create_app(**kws):
         vars.get_vars,
         url_prefix=urljoin(p, "jobs/<int:job>/<any(inputs, results):vtype>"))
     app.register_blueprint(vars.set_vars, url_prefix=urljoin(p, "default"))
+    app.register_blueprint(status.status_bp, url_prefix=urljoin(p, "status"))
+    app.register_blueprint(results.results_bp,
+                           url_prefix=urljoin(p, "results"))
+    app.register_blueprint(sweeps.sweeps_bp, url_prefix=urljoin(p, "sweeps"))
 
     # As a side effect this ensures that app.db and app.client are created.
     # If either one is going to fail, we want to know now.
     app.logger.info("Connected to database %s", app.db.storage.getName())
-    cores = app.client.ncores()
-    app.logger.info("%d workers with %d cores",
-                    len(cores), sum(cores.values()))
+    app.retry(db.get_state, "upgrade")
+    if app.try_lead():
+        cores = app.client.ncores()
+        app.logger.info("%d workers with %d cores",
+                        len(cores), sum(cores.values()))
+    else:
+        app.logger.info("Not the leader; serving requests only.")
 
     if socketio.async_mode == 'threading':
         app.logger.info("Periodic sync & pack disabled; only doing once.")
-        app.sync_tasks()
-        app.db.pack(days=7)
+        if app.leader:
+            app.sync_tasks()
+            app.db.pack(days=7)
+        app.before_request(app.flush_updates)
+        app.waiters.poll_interval = app.config['DRAIN_INTERVAL']
     else:
-        def task_syncer():
+        from eventlet import tpool
+        from eventlet.green import threading
+        app.offload = tpool.execute
+        app.waiters.event_type = threading.Event
+        # Syncing also flushes updates, so both are done here to keep
+        # them from interleaving.
+        def update_drainer():
+            interval = app.config['DRAIN_INTERVAL']
+            nsync = max(1, round(30 / interval))
+            i = 0
             while True:
-                app.sync_tasks()
-                socketio.sleep(30)
+                try:
+                    sync = i % nsync == 0
+                    if app.leader or (sync and app.try_lead()):
+                        if sync:
+                            app.sync_tasks()
+                        else:
+                            app.flush_updates()
+                    app.waiters.check()
+                except:
+                    app.logger.exception("Update drainer failed")
+                i += 1
+                socketio.sleep(interval)
         def zodb_packer():
             while True:
-                app.logger.info("Packing the database")
-                app.db.pack(days=7)
+                if app.leader:
+                    app.logger.info("Packing the database")
+                    app.db.pack(days=7)
                 socketio.sleep(86400) # 24 h
-        socketio.start_background_task(task_syncer)
+        socketio.start_background_task(update_drainer)
         socketio.start_background_task(zodb_packer)
 
     return app
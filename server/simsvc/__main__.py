@@ -2,21 +2,84 @@
 
 This always uses eventlet.wsgi, bypassing SocketIO.run because it does
 not support AF_UNIX.
+
+If configured with multiple frontends, the listening socket is created
+first and then the process forks.  All processes accept connections on
+the socket.  The parent terminates the children on exit.  Socket.IO is
+then served by the leader alone on its own address, if configured:
+each process waits to become the leader and then starts listening.
 """
 
-import atexit
+import atexit, os, signal, sys
 from socket import AddressFamily as AF
 
 from . import create_app
+from .config import Config
+from .sockio import leader_app
 from .util import addrstr, tryrm
 
+def fork_frontends(n):
+    """Fork n - 1 child processes.
+    Return the list of child pids in the parent and None in children.
+    """
+    pids = []
+    for i in range(n - 1):
+        pid = os.fork()
+        if pid == 0:
+            return None
+        pids.append(pid)
+    return pids
+
+def serve_sockio(app, astr):
+    """Serve app on address astr once this process is the leader.
+    Run in a green thread.
+    """
+    import eventlet
+    from eventlet import wsgi
+    while not app.leader:
+        eventlet.sleep(Config.DRAIN_INTERVAL)
+    addr, af = addrstr(astr)
+    if af == getattr(AF, 'AF_UNIX', None):
+        tryrm(addr)
+        atexit.register(tryrm, addr)
+    app.logger.info("Serving Socket.IO on %s", astr)
+    wsgi.server(eventlet.listen(addr, af), leader_app(app),
+                max_size=Config.MAX_CONNECTIONS)
+
+def kill_all(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
 if __name__ == '__main__':
     import eventlet
     from eventlet import wsgi
-    app = create_app(async_mode='eventlet')
+    if Config.FRONTENDS > 1 and Config.LEADER_LOCK is None:
+        sys.exit("Multiple frontends require simsvc.server.leader-lock")
 
-    addr, af = addrstr(app.config['SIMSVC_ADDR'])
+    addr, af = addrstr(Config.SIMSVC_ADDR)
     if af == getattr(AF, 'AF_UNIX', None):
         tryrm(addr)
-        atexit.register(tryrm, addr)
-    wsgi.server(eventlet.listen(addr, af), app)
+    sock = eventlet.listen(addr, af)
+    pids = fork_frontends(Config.FRONTENDS)
+    if pids is not None:
+        if af == getattr(AF, 'AF_UNIX', None):
+            atexit.register(tryrm, addr)
+        if pids:
+            atexit.register(kill_all, pids)
+            def on_term(sig, frame):
+                kill_all(pids)
+                signal.signal(sig, signal.SIG_DFL)
+                os.kill(os.getpid(), sig)
+            signal.signal(signal.SIGTERM, on_term)
+
+    app = create_app(async_mode='eventlet')
+    if Config.FRONTENDS > 1:
+        if Config.SOCKIO_ADDR is None:
+            app.logger.warning("Socket.IO disabled: multiple frontends"
+                               " and no simsvc.server.sockio-address")
+        else:
+            eventlet.spawn(serve_sockio, app, Config.SOCKIO_ADDR)
+    wsgi.server(sock, app, max_size=Config.MAX_CONNECTIONS)
@@ -1,7 +1,7 @@
 """HTTP basic authentication support.
 """
 
-from flask import current_app
+from flask import current_app, has_request_context
 from flask_httpauth import HTTPBasicAuth
 from passlib.apache import HtpasswdFile
 
@@ -35,6 +35,14 @@ class Auth(object):
             app.extensions[ext_name] = HtpasswdFile(fname)
             app.before_request(require_auth)
 
+def current_user():
+    """Return the name of the authenticated user.
+    Return None if authentication is disabled or outside requests.
+    """
+    if not has_request_context() or ext_name not in current_app.extensions:
+        return None
+    return auth.username() or None
+
 @auth.verify_password
 def verify_password(user, pw):
     htpw = current_app.extensions[ext_name]
@@ -0,0 +1,138 @@
+"""Scaling the Dask cluster by the job queue.
+
+Configured by simsvc.cluster.autoscale and enabled by its
+target-latency, an alternative to the Dask adaptive policy
+(simsvc.cluster.adapt).  Where Dask adapts to the
+tasks it sees, the Autoscaler also knows the jobs that are waiting for
+their fair share and how long jobs take, and sizes the cluster to
+finish the active jobs within a target latency.  It scales up with
+Cluster.scale, thus it works with any cluster that we construct,
+LocalCluster included.  Scaling down retires idle workers first, as
+Dask's Adaptive does, so that the results they hold (unsaved or
+published for reattaching) are moved rather than recomputed.
+
+Calls to the scheduler and the cluster block, thus they go through
+TaskFlask.offload, keeping them off the Eventlet hub.
+"""
+
+import math, statistics, time
+
+import dask
+
+def target_workers(jobs, runtime, latency, per_worker, lo=0, hi=None):
+    """Return the number of workers needed to run jobs jobs of runtime
+    seconds each within latency seconds when each worker runs
+    per_worker jobs at a time.  Never more than it takes to run all
+    of them at once, and clamped to [lo, hi] (hi None for no limit).
+    """
+    slots = min(jobs, math.ceil(jobs * runtime / latency)) if jobs else 0
+    n = max(lo, math.ceil(slots / per_worker))
+    return n if hi is None else min(n, hi)
+
+class Autoscaler(object):
+    """Scales the cluster of a TaskFlask.
+
+    Constructor arguments, also instance attributes:
+    app		The TaskFlask, which has a cluster
+
+    Instance attributes:
+    target	The number of workers last requested, initially the
+		number present, or None before the first step
+    scaled_at	When target was requested (time.monotonic())
+    checked_at	When step last computed a target or None
+    """
+    def __init__(s, app):
+        s.app = app
+        s.target = None
+        s.scaled_at = s.checked_at = None
+
+    def conf(s, key):
+        return dask.config.get('simsvc.cluster.autoscale.' + key)
+
+    def runtime(s):
+        """Return the estimated run time of a job: the median of
+        recent successful tasks or default-runtime if there are none.
+        """
+        rts = s.app.runtimes
+        return statistics.median(rts) if rts else s.conf('default-runtime')
+
+    def per_worker(s):
+        """Return the number of jobs that a worker runs at a time:
+        tasks-per-worker or the mean number of threads of the current
+        workers (1 if there are none).
+        """
+        n = s.conf('tasks-per-worker')
+        if n:
+            return n
+        ws = s.app.offload(s.app.client.scheduler_info)['workers'].values()
+        return max(1, round(sum(w['nthreads'] for w in ws) / len(ws))
+                   if ws else 1)
+
+    def jobs(s):
+        """Return the number of active jobs: those with a task and
+        those waiting for their fair share.
+        """
+        return len(s.app.tasks) + sum(map(len, s.app.waiting.values()))
+
+    def workers(s):
+        """Return the current number of workers."""
+        return len(s.app.offload(s.app.client.scheduler_info)['workers'])
+
+    def shrink(s, n):
+        """Retire idle workers, at most down to n.  Return the number
+        of workers left, which is more than n if too few are idle or
+        their data cannot be moved elsewhere.  Clusters without
+        scale_down are just scaled to n.  This blocks; step offloads
+        it.
+        """
+        cli, clust = s.app.client, s.app.cluster
+        if not hasattr(clust, 'scale_down'):
+            clust.scale(n)
+            return n
+        cur = s.workers()
+        names = cli.sync(cli.scheduler.workers_to_close, target=n,
+                         attribute="name")
+        if names:
+            # Workers whose data has nowhere to go are not retired.
+            names = [w['name'] for w in
+                     cli.retire_workers(names=names).values()]
+        if names:
+            clust.sync(clust.scale_down, names)
+        return cur - len(names)
+
+    def step(s, now=None):
+        """Rescale if due.
+        Compute the target at most every interval seconds.  Scale up
+        only up-cooldown and down only down-cooldown seconds after the
+        previous change.  Return the new target or None if unchanged.
+        """
+        now = time.monotonic() if now is None else now
+        if s.checked_at is not None and now - s.checked_at < s.conf(
+                'interval'):
+            return None
+        s.checked_at = now
+        n = target_workers(s.jobs(), s.runtime(), s.conf('target-latency'),
+                           s.per_worker(), s.conf('min-workers'),
+                           s.conf('max-workers'))
+        if s.target is None:
+            s.target = s.workers()
+        if n == s.target:
+            return None
+        if s.scaled_at is not None:
+            cool = s.conf('up-cooldown' if n > s.target else 'down-cooldown')
+            if now - s.scaled_at < cool:
+                return None
+        s.app.logger.info("Scaling the cluster from %s to %d workers",
+                          s.target, n)
+        if n > s.target:
+            s.app.offload(s.app.cluster.scale, n)
+        else:
+            n = s.app.offload(s.shrink, n)
+            if n == s.target:
+                return None
+        s.target, s.scaled_at = n, now
+        return n
+
+    def stats(s):
+        """Return a dict of statistics for TaskFlask.stats."""
+        return {"target": s.target, "runtime": s.runtime()}
@@ -0,0 +1,189 @@
+"""Binary encodings and compression for variable responses.
+
+JSON is the default.  Clients can ask for other encodings with the
+Accept header:
+
+application/msgpack
+		MessagePack.  Numeric arrays (result store arrays and
+		lists of at least min_size numbers) are encoded as
+		extension type ARRAY_EXT, whose data is the array in .npy
+		format.  Everything else is as in JSON.
+application/x-npy
+		A single numeric array in .npy format.
+application/vnd.apache.arrow.stream
+		Arrow IPC stream of a table.  A numeric array is a table
+		with one column named after the variable; a dict of equally
+		long numeric arrays, such as a time series, a table with
+		a column per key.
+
+Encodings whose modules (msgpack, NumPy, pyarrow) are not installed
+or that cannot represent the value are not offered.  Responses can
+also be compressed with gzip or, if zstandard is installed, zstd
+according to Accept-Encoding.
+"""
+
+import io, zlib
+
+from . import store
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+NPY = "application/x-npy"
+ARROW = "application/vnd.apache.arrow.stream"
+
+ARRAY_EXT = 1
+
+def _have(module):
+    import importlib.util
+    return importlib.util.find_spec(module) is not None
+
+def have_arrow():
+    """Return true if Arrow encoding is available."""
+    return _have("pyarrow")
+
+def as_array(v, min_size=1):
+    """Return v as a numeric numpy.ndarray or None if it is not one.
+    v may be an Array_ref, an ndarray or a list or tuple of at least
+    min_size numbers (or equally long lists of numbers).
+    """
+    import numpy as np
+    if isinstance(v, store.Array_ref):
+        return v.load()
+    if isinstance(v, np.ndarray):
+        a = v
+    elif isinstance(v, (list, tuple)) and len(v) >= min_size:
+        try:
+            a = np.asarray(v)
+        except (ValueError, TypeError):
+            return None
+    else:
+        return None
+    return a if a.dtype.kind in "biuf" else None
+
+def as_table(v, name):
+    """Return v as a dict column name -> 1-d ndarray or None if it is not
+    a numeric array or a dict of equally long ones.  name is the column
+    name for an array.
+    """
+    if isinstance(v, dict):
+        cols = {str(k): as_array(x) for k, x in v.items()}
+    else:
+        cols = {name: as_array(v)}
+    if (not cols or any(a is None or a.ndim != 1 for a in cols.values())
+            or len(set(map(len, cols.values()))) != 1):
+        return None
+    return cols
+
+def tolists(v):
+    """Return v with ndarrays, also those nested in dicts, replaced by
+    lists for JSON encoding.
+    """
+    if isinstance(v, dict):
+        return {k: tolists(x) for k, x in v.items()}
+    elif hasattr(v, "tolist") and hasattr(v, "dtype"):
+        return v.tolist()
+    else:
+        return v
+
+def npy_bytes(a):
+    import numpy as np
+    buf = io.BytesIO()
+    np.save(buf, a, allow_pickle=False)
+    return buf.getvalue()
+
+def pack_msgpack(v, min_size):
+    """Encode v as MessagePack, with numeric arrays as ARRAY_EXT."""
+    import msgpack
+    def prepare(x):
+        if isinstance(x, dict):
+            return {k: prepare(y) for k, y in x.items()}
+        a = as_array(x, min_size)
+        if a is not None:
+            return msgpack.ExtType(ARRAY_EXT, npy_bytes(a))
+        if isinstance(x, (list, tuple)):
+            return [prepare(y) for y in x]
+        return x
+    return msgpack.packb(prepare(v), use_bin_type=True)
+
+def pack_arrow(cols):
+    """Encode a dict from as_table as an Arrow IPC stream."""
+    import pyarrow as pa
+    tab = pa.table(cols)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, tab.schema) as w:
+        w.write_table(tab)
+    return sink.getvalue().to_pybytes()
+
+def offers(v, name=None, wanted=()):
+    """Return the MIME types that v can be encoded as, JSON first.
+    name is the variable name if v is a single variable.  The array
+    encodings, which require inspecting v, are only considered if
+    they are in wanted.
+    """
+    res = [JSON]
+    if _have("msgpack") and _have("numpy"):
+        res.append(MSGPACK)
+    if name is not None and _have("numpy"):
+        if NPY in wanted and as_array(v) is not None:
+            res.append(NPY)
+        if (ARROW in wanted and have_arrow()
+                and as_table(v, name) is not None):
+            res.append(ARROW)
+    return res
+
+def encode(v, mimetype, name=None, min_size=16):
+    """Encode v as mimetype, one of offers(v, name) other than JSON.
+    min_size is the minimum length of lists encoded as arrays in
+    MessagePack.
+    """
+    if mimetype == MSGPACK:
+        return pack_msgpack(v, min_size)
+    elif mimetype == NPY:
+        return npy_bytes(as_array(v))
+    elif mimetype == ARROW:
+        return pack_arrow(as_table(v, name))
+    else:
+        raise ValueError("Unsupported MIME type %s" % mimetype)
+
+def encodings():
+    """Return the supported content codings, preferred first."""
+    return (["zstd"] if _have("zstandard") else []) + ["gzip"]
+
+def compressor(coding):
+    """Return a function that is called with successive pieces of
+    data (bytes) and finally with None, returning compressed data.
+    """
+    if coding == "gzip":
+        c = zlib.compressobj(6, zlib.DEFLATED, 31)
+    elif coding == "zstd":
+        import zstandard
+        c = zstandard.ZstdCompressor().compressobj()
+    else:
+        raise ValueError("Unsupported content coding %s" % coding)
+    return lambda data: c.flush() if data is None else c.compress(data)
+
+def compress_iter(pieces, coding):
+    """Generate compressed data from pieces (str or bytes)."""
+    comp = compressor(coding)
+    for p in pieces:
+        out = comp(p.encode() if isinstance(p, str) else p)
+        if out:
+            yield out
+    yield comp(None)
+
+def finish(resp, coding, min_bytes):
+    """Compress Flask response resp with coding unless it is None.
+    Streamed responses are always compressed, others only if they
+    have at least min_bytes (None disables).  Return resp.
+    """
+    if coding is not None:
+        if resp.is_streamed:
+            resp.response = compress_iter(resp.response, coding)
+        elif min_bytes is not None and resp.content_length >= min_bytes:
+            resp.set_data(b"".join(compress_iter([resp.get_data()], coding)))
+        else:
+            coding = None
+    if coding is not None:
+        resp.content_encoding = coding
+    resp.vary.update(["Accept", "Accept-Encoding"])
+    return resp
@@ -32,3 +32,11 @@ class Config(object):
     WORK_DIR = _env_conf("WORK_DIR", "server.work_dir")
     JOB_DB = _env_conf("JOB_DB", "server.job_db")
     HTPASSWD_FILE = _env_conf("HTPASSWD_FILE", "server.htpasswd_file")
+    DRAIN_INTERVAL = float(_env_conf("DRAIN_INTERVAL",
+                                     "server.drain_interval"))
+    LEADER_LOCK = _env_conf("LEADER_LOCK", "server.leader_lock")
+    SOCKIO_ADDR = _env_conf("SIMSVC_SOCKIO_ADDR", "server.sockio_address")
+    FRONTENDS = int(_env_conf("SIMSVC_FRONTENDS", "server.frontends"))
+    ID_BLOCK = int(_env_conf("ID_BLOCK", "server.id_block"))
+    MAX_CONNECTIONS = int(_env_conf("SIMSVC_MAX_CONNECTIONS",
+                                    "server.max_connections"))
@@ -1,19 +1,35 @@
 """Database objects and support.
 """
 
+from collections.abc import Mapping
 from enum import Enum
-import random, shutil
+import os, shutil, sys, threading, time
 
 import flask
 from werkzeug.utils import cached_property
 from persistent import Persistent
-from BTrees.OOBTree import OOBTree, difference
-from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOBTree, OOTreeSet
+from BTrees.IOBTree import IOBTree, IOTreeSet, multiunion, intersection
+from BTrees.IIBTree import IIBTree
 import ZODB, zodburi
+from ZODB.POSException import ConflictError
+
+from . import store, util
 
 class DBFlask(flask.Flask):
     """A Flask app with a database association.
+
+    Job ids are reserved from the database in blocks of config
+    ID_BLOCK (see new_jobid), so that concurrent posting of jobs in
+    several processes does not conflict on id allocation.
     """
+    def __init__(s, *args, **kws):
+        """args and kws are passed to super.
+        """
+        super().__init__(*args, **kws)
+        s._ids = iter(())
+        s._ids_lock = threading.Lock()
+
     @cached_property
     def db(s):
         """ZODB connection pool.
@@ -24,7 +40,16 @@ class DBFlask(flask.Flask):
             z = ZODB.DB("simsvc.fs")
         else:
             sf, kws = zodburi.resolve_uri(zuri)
-            z = ZODB.DB(sf(), **kws)
+            # Opening a new shared database creates its root, which
+            # conflicts if several frontends start at once.
+            for i in range(10):
+                try:
+                    z = ZODB.DB(sf(), **kws)
+                    break
+                except ConflictError:
+                    if i == 9:
+                        raise
+                    time.sleep(0.1 * (i + 1))
         atexit.register(z.close)
         return z
 
@@ -41,20 +66,339 @@ class DBFlask(flask.Flask):
         """
         return s.db.transaction(note)
 
+    def retry(s, f, note=None, retries=10):
+        """Return f(conn) executed in a transaction of its own.
+        The transaction is retried up to retries times on conflicts.
+        f should only modify the database, nothing else.
+        """
+        for i in range(retries + 1):
+            try:
+                with s.transact(note) as conn:
+                    return f(conn)
+            except ConflictError:
+                if i == retries:
+                    raise
+                s.logger.debug("%s: conflict, retrying", note)
+
+    def reserve_ids(s, n):
+        """Reserve n job ids in a transaction of its own.
+        Return them as a range.
+        """
+        return s.retry(lambda conn: get_state(conn).id_counter.reserve(n),
+                       "reserve_ids")
+
+    def new_jobid(s):
+        """Return a new job id.
+        Ids are taken from a block reserved with reserve_ids, thus they
+        increase within each process but ids from concurrent processes
+        interleave.  Ids are not reused even if the transaction that
+        they were allocated for is aborted.  This may be called from
+        any thread.
+        """
+        with s._ids_lock:
+            jid = next(s._ids, None)
+            if jid is None:
+                s._ids = iter(s.reserve_ids(s.config.get('ID_BLOCK', 100)))
+                jid = next(s._ids)
+            return jid
+
 def transact(note=None):
     """Run DBFlask.transact on current app.
     """
     return flask.current_app.transact(note)
 
+def new_jobid():
+    """Run DBFlask.new_jobid on current app.
+    """
+    return flask.current_app.new_jobid()
+
+def id_set():
+    """Return a new IOTreeSet for job ids.
+    It permanently contains 0, which is not a job id: BTrees conflict
+    resolution fails if one transaction removes the first key of a
+    bucket that another transaction changes, which would otherwise be
+    common for sets where the oldest jobs are removed and new ones
+    added.  Use keys(1) to iterate over the ids.
+    """
+    return IOTreeSet([0])
+
+class Id_counter(Persistent):
+    """The next unreserved job id.
+    Reservations are in blocks, see DBFlask.new_jobid.  This is
+    deliberately a separate object so that reservations only conflict
+    with each other.  Instance attributes:
+    next	The smallest unreserved id.
+    """
+    def __init__(s, next=1):
+        s.next = next
+
+    def reserve(s, n):
+        """Reserve n ids and return them as a range.
+        """
+        r = range(s.next, s.next + n)
+        s.next = r.stop
+        return r
+
+class Result_cache(Persistent):
+    """A cache of job results by input hash.
+
+    Entries refer to jobs rather than copy their results.  An entry
+    whose job has been deleted or is no longer done is treated as a miss
+    and removed.  Instance attributes:
+    entries	a mapping input hash -> (job id, time added)
+    order	a set of (time added, input hash) for eviction
+    """
+    def __init__(s):
+        s.entries = OOBTree()
+        s.order = OOTreeSet()
+
+    def _remove(s, key):
+        jid, t = s.entries.pop(key)
+        s.order.remove((t, key))
+
+    def lookup(s, key, jobs, now, ttl=None):
+        """Return a done Job with input hash key or None if not found.
+        jobs is the job mapping of App_state.  Entries added more than ttl
+        seconds before now are expired.
+        """
+        ent = s.entries.get(key)
+        if ent is None:
+            return None
+        jid, t = ent
+        job = jobs.get(jid)
+        if ((ttl is not None and t < now - ttl)
+            or job is None or job.status != Job_status.DONE):
+            s._remove(key)
+            return None
+        return job
+
+    def add(s, key, jid, now):
+        """Add or replace the entry for key.
+        """
+        if key in s.entries:
+            s._remove(key)
+        s.entries[key] = jid, now
+        s.order.insert((now, key))
+
+    def prune(s, now, max_entries=None, ttl=None):
+        """Remove entries older than ttl seconds and the oldest entries
+        in excess of max_entries.  Return the number of entries removed.
+        """
+        n = 0
+        while s.order:
+            t, key = s.order.minKey()
+            if ((max_entries is None or len(s.entries) <= max_entries)
+                and (ttl is None or t >= now - ttl)):
+                break
+            s._remove(key)
+            n += 1
+        return n
+
 class App_state(Persistent):
     """Application state.
     Contains everything that we store in the database.  Instance attributes:
-    default	a mapping of default inputs (name -> value)
+    default	a mapping of default inputs (name -> value).  Call
+		defaults_changed after modifying it.
+    snapshots	a mapping Defaults_snapshot.version -> Defaults_snapshot
+    current_snapshot  the Defaults_snapshot of default or None if
+		default has changed since it was taken
     jobs	a mapping of Jobs (job id -> Job)
+    cache	a Result_cache
+    status_of	a mapping job id -> Job_status value (int)
+    by_status	a mapping Job_status value -> id_set of job ids,
+		except INVALID
+    by_created	a set of (Job.created, job id)
+    id_counter	an Id_counter
+    unlaunched	an id_set of ids of jobs posted to a frontend that
+		is not the leader, to be launched by the leader
+    cancel_requests  jobs to be cancelled by the leader at the request
+		of other frontends: an IIBTree job id -> 1 if the job
+		should also be deleted, else 0
+    unreported	an id_set of ids of jobs that other frontends
+		completed from the result cache, for the leader to
+		report as terminated
+    sweeps	a mapping of Sweeps (sweep id -> Sweep)
+    sweep_counter  an Id_counter for sweep ids
+
+    status_of, by_status and by_created are indexes that allow listing
+    and filtering jobs without loading Job objects.  To keep them up to
+    date, add jobs with add_job, change their status with set_status and
+    delete them with remove_job or close_job.  Code that sets Job.status
+    directly must call reindex afterwards.  Jobs from databases older
+    than by_created have no creation time and are not in it.
+
+    New jobs are INVALID until submitted in the same transaction.
+    Leaving INVALID out of by_status avoids every job post writing the
+    same set, which would make concurrent posts conflict.
+
+    Jobs refer to a Defaults_snapshot instead of copying default.
+    Snapshots are not deleted when their jobs are, so that defaults
+    changed back to an earlier version reuse its snapshot.  There
+    should not be many versions.
     """
     def __init__(s):
         s.default = OOBTree()
         s.jobs = IOBTree()
+        s.upgrade()
+
+    def upgrade(s):
+        """Add any attributes missing from databases created by
+        earlier versions.
+        """
+        if not hasattr(s, 'cache'):
+            s.cache = Result_cache()
+        if not hasattr(s, 'status_of'):
+            s.status_of = IIBTree()
+            s.by_status = IOBTree()
+            for jid, job in s.jobs.items():
+                s._index(jid, job.status)
+        if not hasattr(s, 'by_created'):
+            s.by_created = OOTreeSet()
+        if not hasattr(s, 'id_counter'):
+            s.id_counter = Id_counter(s.jobs.maxKey() + 1 if s.jobs else 1)
+        if not hasattr(s, 'unlaunched'):
+            s.unlaunched = id_set()
+            s.cancel_requests = IIBTree()
+        if not hasattr(s, 'snapshots'):
+            s.snapshots = OOBTree()
+            s.current_snapshot = None
+        if not hasattr(s, 'sweeps'):
+            s.sweeps = IOBTree()
+            s.sweep_counter = Id_counter()
+        if not hasattr(s, 'unreported'):
+            s.unreported = id_set()
+
+    def default_snapshot(s):
+        """Return the Defaults_snapshot of default.
+        A new snapshot is only created if default has changed to
+        values that have no snapshot yet.
+        """
+        snap = s.current_snapshot
+        if snap is None:
+            values = dict(s.default)
+            ver = util.canonical_hash(values)
+            snap = s.snapshots.get(ver)
+            if snap is None:
+                snap = s.snapshots[ver] = Defaults_snapshot(ver, values)
+            s.current_snapshot = snap
+        return snap
+
+    def defaults_changed(s):
+        """Note that default has been modified.
+        The next default_snapshot call takes a new snapshot.
+        """
+        s.current_snapshot = None
+
+    def _index(s, jid, status):
+        old = s.status_of.get(jid)
+        if old == status.value:
+            return
+        if old is not None and old != Job_status.INVALID.value:
+            s.by_status[old].remove(jid)
+        s.status_of[jid] = status.value
+        if status == Job_status.INVALID:
+            return
+        ids = s.by_status.get(status.value)
+        if ids is None:
+            ids = s.by_status[status.value] = id_set()
+        ids.insert(jid)
+
+    def add_job(s, k, job):
+        """Add job to jobs with id k and return k.
+        k must be new, see new_jobid.
+        """
+        if not s.jobs.insert(k, job):
+            raise KeyError("Duplicate job id %s" % k)
+        s._index(k, job.status)
+        if job.created is not None:
+            s.by_created.insert((job.created, k))
+        return k
+
+    def set_status(s, jid, status):
+        """Set the status of job jid.
+        """
+        s.jobs[jid].status = status
+        s._index(jid, status)
+
+    def reindex(s, jid):
+        """Update the status index from the status of job jid.
+        """
+        s._index(jid, s.jobs[jid].status)
+
+    def remove_job(s, jid):
+        """Delete job jid from the database.
+        Does not close the job; see close_job.
+        """
+        job = s.jobs.pop(jid)
+        if job.created is not None:
+            s.by_created.remove((job.created, jid))
+        old = s.status_of.pop(jid, None)
+        if old is not None and old != Job_status.INVALID.value:
+            s.by_status[old].remove(jid)
+
+    def close_job(s, jid):
+        """Close job jid and if successful, delete it.
+        Return the value returned by Job.close.
+        """
+        if s.jobs[jid].close():
+            s.remove_job(jid)
+            return True
+        else:
+            # Closing marks the job invalid.
+            s.reindex(jid)
+            return False
+
+    def add_sweep(s, sweep):
+        """Add a Sweep to sweeps with a new id and return the id.
+        """
+        k, = s.sweep_counter.reserve(1)
+        s.sweeps[k] = sweep
+        return k
+
+    def status(s, jid):
+        """Return the status of job jid or None if it does not exist.
+        This does not load the Job.
+        """
+        v = s.status_of.get(jid)
+        return None if v is None else Job_status(v)
+
+    def ids_with_status(s, statuses):
+        """Return an ordered collection of ids of jobs with any of statuses.
+        INVALID jobs are found by scanning status_of.
+        """
+        ids = multiunion([s.by_status[st.value] for st in statuses
+                          if st.value in s.by_status])
+        if Job_status.INVALID in statuses:
+            ids = multiunion([ids, IOTreeSet(
+                jid for jid, v in s.status_of.items()
+                if v == Job_status.INVALID.value)])
+        if 0 in ids:
+            ids.remove(0)
+        return ids
+
+    def select_ids(s, statuses=None, since=None, until=None, after=None):
+        """Return an iterator over job ids in ascending order.
+        If statuses is not None, only jobs with those statuses are
+        included.  If since or until is not None, only jobs created at or
+        after since and before until (time.time() values) are included.
+        If after is not None, only ids greater than after are included.
+
+        Without time filters this is lazy: the cost of reading the first
+        n ids is independent of the number of jobs.  A time filter
+        costs time proportional to the number of jobs created in the
+        time range.
+        """
+        ids = (s.status_of if statuses is None
+               else s.ids_with_status(statuses))
+        if since is not None or until is not None:
+            lo = (since, 0) if since is not None else None
+            # Job ids are positive, thus (until, 0) excludes until.
+            hi = (until, 0) if until is not None else None
+            created = IOTreeSet(jid for t, jid in s.by_created.keys(lo, hi))
+            ids = (created if statuses is None
+                   else intersection(ids, created))
+        return iter(ids.keys(after, excludemin=True) if after is not None
+                    else ids.keys())
 
 def get_state(conn):
     """Return the application state.
@@ -63,10 +407,12 @@ def get_state(conn):
     """
     r = conn.root
     try:
-        return r.app_state
+        st = r.app_state
     except AttributeError:
         st = r.app_state = App_state()
         return st
+    st.upgrade()
+    return st
 
 class Job_status(Enum):
     """Job states.
@@ -86,16 +432,105 @@ class Job_status(Enum):
         """Scheduled, running or done"""
         return s.value > 0
 
+class Defaults_snapshot(Persistent):
+    """Default inputs as they were when jobs were created.
+    Shared by those jobs.  Do not modify.  Instance attributes:
+    version	A hash of values, also the key in App_state.snapshots
+    values	A mapping name -> value
+    """
+    def __init__(s, version, values):
+        s.version = version
+        s.values = OOBTree()
+        s.values.update(values)
+
+class Sweep(Persistent):
+    """A group of jobs posted together from a design of experiments.
+    See .sweeps.  Instance attributes:
+    design	The design as posted (a dict)
+    varied	Names of the inputs that the design varies
+    jobs	Ids of the jobs, a tuple in design order.  The jobs
+		may since have been deleted.
+    owner	The name of the user who posted the sweep or None.
+    created	When the sweep was created (time.time()).
+    """
+    def __init__(s, design, varied, jobs, owner=None):
+        s.design = design
+        s.varied = tuple(varied)
+        s.jobs = tuple(jobs)
+        s.owner = owner
+        s.created = time.time()
+
+    def counts(s, st):
+        """Return a dict Job_status name -> number of jobs of the sweep
+        in App_state st.  Deleted jobs are counted as DELETED.
+        """
+        res = {}
+        for jid in s.jobs:
+            status = st.status(jid)
+            name = "DELETED" if status is None else status.name
+            res[name] = res.get(name, 0) + 1
+        return res
+
+class Inputs(Mapping):
+    """Read-only inputs of a job: overrides merged with defaults.
+
+    Instance attributes, also constructor arguments:
+    overrides	A mapping name -> value of job-specific inputs
+    defaults	A mapping name -> value or None.  Values in overrides
+		take precedence.
+    """
+    def __init__(s, overrides, defaults=None):
+        s.overrides = overrides
+        s.defaults = defaults
+
+    def __getitem__(s, k):
+        try:
+            return s.overrides[k]
+        except KeyError:
+            if s.defaults is None:
+                raise
+            return s.defaults[k]
+
+    def _keys(s):
+        if s.defaults is None:
+            return s.overrides.keys()
+        return sorted(set(s.overrides.keys()) | set(s.defaults.keys()))
+
+    def __iter__(s):
+        return iter(s._keys())
+
+    def __len__(s):
+        return len(s._keys())
+
 class Job(Persistent):
     """Persistent data for a single job.  Instance attributes:
     status	Job_status
-    inputs	A mapping (name -> value) of inputs.  Includes
-    		default values as applied.
+    overrides	A mapping (name -> value) of job-specific inputs,
+		those that differ from defaults.
+    defaults	The Defaults_snapshot applied or None.  Jobs from
+		versions before snapshots have all inputs in overrides.
+    inputs	Property: all inputs as a read-only Inputs mapping.
     results	A mapping (name -> value) of results (generally empty
-    		unless status == DONE).
+    		unless status == DONE).  Large values may be
+		.store.Array_refs; see save_results.
     error	An error message (str) or None.
     workdir	The working directory of the job (absolute file name)
     		or None.
+    cache_key	Input hash for adding results to Result_cache when done
+		or None if results should not be cached.
+    task_key	Dask key of the task last launched for the job or None.
+    result_file	File holding large results or None.  See save_results.
+    owner	The name of the user who posted the job or None.
+    priority	Dask priority or None to use input simsvc.priority.
+    created	When the job was created (time.time()) or None if
+    		created by an old version.
+    started	When the job started running (time.time()) or None.
+    finished	When the job terminated or None.
+    progress	Fraction done (0 to 1) as last reported by the task or
+		None.  See tasks.Task_spec.progress.
+    partial	Intermediate results (a dict) last reported by the
+		task or None.
+    attempts	Number of automatic retries after transient failures.
 
     Input and result values can be of any (serializable) type.  If they
     are mutable, do not modify them or you'll confuse persistence
@@ -107,28 +542,88 @@ class Job(Persistent):
     method recursively removes workdir unless it is None.
     """
         
-    def __init__(s, inputs, defaults):
-        """Initialise from given inputs and defaults, which are name -> value
-        collections.  The job inputs are their union, with values in
-        inputs having precedence over defaults.
+    def __init__(s, inputs, defaults=None):
+        """Initialise from given inputs, a name -> value collection,
+        and defaults, a Defaults_snapshot or None.  The job inputs
+        are their union, with values in inputs having precedence over
+        defaults.  Only inputs that differ from defaults are stored
+        in the job.
         """
         s.status = Job_status.INVALID
-        s.inputs = OOBTree()
-        s.inputs.update(inputs)
-        s.inputs.update(difference(defaults, s.inputs))
+        s.created = time.time()
+        s.defaults = defaults
+        dv = {} if defaults is None else defaults.values
+        s.overrides = OOBTree()
+        s.overrides.update(
+            [(k, v) for k, v in inputs.items()
+             if not (k in dv and type(dv[k]) is type(v) and dv[k] == v)])
         s.results = OOBTree()
         s.error = s.workdir = None
 
-    def save_results(s, results):
+    def __setstate__(s, state):
+        # Before snapshots all inputs were copied into the job.
+        if 'inputs' in state:
+            state = dict(state)
+            state['overrides'] = state.pop('inputs')
+        super().__setstate__(state)
+
+    @property
+    def inputs(s):
+        return Inputs(s.overrides,
+                      None if s.defaults is None else s.defaults.values)
+
+    def input_hash(s, digits=None):
+        """Return a hash of the inputs as a hex string.
+        This hashes the defaults version and overrides, thus it
+        does not load the defaults.  digits is as with
+        util.canonical_hash and only applies to overrides.
+        """
+        return util.canonical_hash(
+            [None if s.defaults is None else s.defaults.version,
+             dict(s.overrides)], digits)
+
+    defaults = None
+    cache_key = task_key = result_file = None
+    owner = None
+    priority = None
+    created = started = finished = None
+    progress = partial = None
+    attempts = 0
+
+    def save_results(s, results, rstore=None):
         """Save results into the database.
         Previous results are replaced.  results is a sequence
         of (name, value) pairs or an object with a method 'items'
         that returns such a sequence (e.g., dict).  Transaction management
         is up to the caller.
+
+        If a result store (see .store) rstore is given, it saves
+        large values in result_file and only references to them go
+        in the database.  Values that are references to another file
+        (copied from another job's results) are loaded first.
         """
+        results = dict(results.items() if hasattr(results, 'items')
+                       else results)
+        if any(map(store.has_refs, results.values())):
+            files = {}
+            results = {k: store.load_value(v, files)
+                       for k, v in results.items()}
+            for f in files.values():
+                f.close()
+        s.remove_result_file()
+        if rstore is not None:
+            results, s.result_file = rstore.save(s, results)
         s.results.clear()
         s.results.update(results)
 
+    def remove_result_file(s):
+        """Remove result_file, if any, and set it to None.
+        Results referring to it become unavailable.
+        """
+        if s.result_file is not None:
+            util.tryrm(s.result_file)
+            s.result_file = None
+
     def close(s):
         """Remove any non-database resources associated with this job.
         On success return true: the job can now be deleted from the database
@@ -151,32 +646,32 @@ class Job(Persistent):
                 good = False
                 s.status = Job_status.INVALID
                 s.error = (("Error on closing job, on deleting %s:\n" % path)
-                           + tb.format_exception(*ei))
+                           + "".join(tb.format_exception(*ei)))
             else:
                 s.error += "Failed to delete %s.\n" % path
+        try:
+            s.remove_result_file()
+        except OSError:
+            onerr(os.remove, s.result_file, sys.exc_info())
         if s.workdir is not None and shutil.rmtree.avoids_symlink_attacks:
             shutil.rmtree(s.workdir, onerror=onerr)
             if good:
                 s.workdir = None
         return good
 
-def gen_jobid(jobs):
-    if not jobs:
-        return 1
-    mk = jobs.maxKey()
-    if mk > 10 * len(jobs):
-        return random.randrange(1, mk)
-    else:
-        return mk + 1
-
-def create_job(conn, inputs):
+def create_job(conn, inputs, owner=None):
     """Create a Job and add to the job list.
     Return (job id, Job).
     """
     st = get_state(conn)
-    j = Job(inputs, st.default)
-    k = gen_jobid(st.jobs)
-    while not st.jobs.insert(k, j):
-        k = gen_jobid(st.jobs)
-    return k, j
+    j = Job(inputs, st.default_snapshot())
+    j.owner = owner
+    return st.add_job(new_jobid(), j), j
+
+def create_jobs(conn, inputs, owner=None):
+    """Create multiple Jobs and add them to the job list.
+    inputs is a sequence of input mappings, one per job.
+    Return a list of (job id, Job) in the same order.
+    """
+    return [create_job(conn, inp, owner) for inp in inputs]
 
@@ -2,71 +2,184 @@
 """
 
 import os, tempfile
+from itertools import islice
 
-import flask
+import dask, flask
 from flask import Blueprint, jsonify, request, current_app, url_for
 import werkzeug.exceptions as wexc
 from http import HTTPStatus
+from ZODB.POSException import ConflictError
 
 from . import db, tasks, util
+from .auth import current_user
 
 jobs_bp = Blueprint('jobs_bp', __name__)
-jobs_bp.before_request(tasks.flush_updates)
 
 @jobs_bp.route('/')
 def get_jobs():
     wstat = request.args.get("status", type=util.boolstr)
     only = request.args.get("only")
-    if wstat:
-        tasks.refresh_jobs()
+    state = request.args.get("state")
+    try:
+        states = (None if state is None
+                  else {db.Job_status[s] for s in state.split(",")})
+    except KeyError as e:
+        raise wexc.BadRequest("Unknown job state %s" % e)
+    since = request.args.get("since", type=float)
+    until = request.args.get("until", type=float)
+    after = request.args.get("after", type=int)
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit < 1:
+        raise wexc.BadRequest("limit must be positive")
+    only_ids = None if only is None else [int(ks) for ks in only.split(",")]
+    def wanted(st, k):
+        # The filters of select_ids, for ids listed in only.
+        s = st.status(k)
+        if s is None or (states is not None and s not in states):
+            return False
+        if (after is not None and k <= after):
+            return False
+        if since is None and until is None:
+            return True
+        t = st.jobs[k].created
+        return (t is not None and (since is None or t >= since)
+                and (until is None or t < until))
     def gen_items():
         with db.transact() as conn:
-            jobs = db.get_state(conn).jobs
-            if only is not None:
-                for ks in only.split(","):
-                    k = int(ks)
-                    j = jobs.get(k)
-                    if j is not None:
-                        yield k, j
+            st = db.get_state(conn)
+            if only_ids is not None:
+                ids = (k for k in only_ids if wanted(st, k))
             else:
-                yield from jobs.items()
-    return jsonify({k: j.status.name for k, j in gen_items()}
-                   if wstat else [k for k, j in gen_items()])
+                ids = st.select_ids(states, since, until, after)
+            for k in ids:
+                yield k, st.status(k).name
+    items = gen_items()
+    hdrs = {}
+    if limit is not None:
+        items = list(islice(items, limit + 1))
+        if len(items) > limit:
+            del items[limit:]
+            args = request.args.to_dict()
+            args["after"] = items[-1][0]
+            hdrs["Link"] = '<%s>; rel="next"' % url_for('.get_jobs', **args)
+    if not wstat:
+        items = (k for k, s in items)
+    return flask.Response(
+        flask.stream_with_context(util.json_stream(items, wstat)),
+        mimetype="application/json", headers=hdrs)
+
+@jobs_bp.route('/wait')
+def wait_jobs():
+    try:
+        ids = [int(ks) for ks in request.args["ids"].split(",")]
+    except KeyError as e:
+        raise wexc.BadRequest("ids is required") from e
+    except ValueError as e:
+        raise wexc.BadRequest("Invalid job id: %s" % e) from e
+    mode = request.args.get("mode", "any")
+    if mode not in ("any", "all"):
+        raise wexc.BadRequest("mode must be any or all")
+    lim = dask.config.get('simsvc.server.max-wait')
+    timeout = min(request.args.get("timeout", lim, type=float), lim)
+    def statuses():
+        with db.transact() as conn:
+            st = db.get_state(conn)
+            return {k: s.name for k, s in ((k, st.status(k)) for k in ids)
+                    if s is not None}
+    res = statuses()
+    done = {k for k in ids if k not in res
+            or not db.Job_status[res[k]].active()}
+    over = done.issuperset(ids) if mode == "all" else done
+    if not over and timeout > 0:
+        if current_app.waiters.wait(ids, mode == "all", timeout):
+            res = statuses()
+    return jsonify({str(k): s for k, s in res.items()})
 
 @jobs_bp.route('/<int:job>')
 def get_job(job):
-    tasks.refresh_jobs()
     with db.transact() as conn:
         j = db.get_state(conn).jobs[job]
         return jsonify(j.status.name)
 
+@jobs_bp.route('/<int:job>/info')
+def get_info(job):
+    with db.transact() as conn:
+        j = db.get_state(conn).jobs[job]
+        return jsonify({"status": j.status.name, "owner": j.owner,
+                        "priority": j.priority, "created": j.created,
+                        "started": j.started, "finished": j.finished,
+                        "progress": j.progress, "attempts": j.attempts})
+
+@jobs_bp.route('/<int:job>/progress')
+def get_progress(job):
+    with db.transact() as conn:
+        j = db.get_state(conn).jobs[job]
+        return jsonify({"progress": j.progress, "values": j.partial})
+
+# How many times to retry posting jobs on database conflicts.
+post_retries = 5
+
+def submit_jobs(inputs, note, on_created=None):
+    """Create jobs from a list of input dicts and submit them.
+    Return a list of the new job ids.  Query parameters cache and
+    priority are applied.  Everything happens in a single transaction,
+    which is retried on conflicts with concurrent transactions (of
+    other frontends).  If the transaction fails, work directories
+    are removed and any launched tasks cancelled.  If on_created is
+    given, it is called as on_created(conn, ids) in the transaction
+    after the jobs have been submitted.  Invalid inputs (see
+    tasks.Input_error) are a bad request.
+    """
+    use_cache = request.args.get("cache", True, type=util.boolstr)
+    prio = request.args.get("priority", type=int)
+    wd = current_app.config['WORK_DIR']
+    for attempt in range(post_retries + 1):
+        new = []
+        try:
+            with db.transact(note) as conn:
+                new = db.create_jobs(conn, inputs, current_user())
+                for jid, j in new:
+                    j.priority = prio
+                    j.workdir = tempfile.mkdtemp(dir=wd) if wd else None
+                tasks.submit(conn, new, use_cache)
+                if on_created is not None:
+                    on_created(conn, [jid for jid, j in new])
+            return [jid for jid, j in new]
+        except Exception as e:
+            for jid, j in new:
+                tasks.cancel(jid)
+                j.close()
+            if isinstance(e, tasks.Input_error):
+                raise wexc.BadRequest(str(e)) from e
+            if not isinstance(e, ConflictError) or attempt == post_retries:
+                raise
+            current_app.logger.info("%s: conflict, retrying", note)
+
 @jobs_bp.route('/', methods=['POST'])
 def post_job():
     current_app.logger.debug("post_job: %s", request.data)
     req = request.get_json()
     if not isinstance(req, dict):
         raise wexc.UnsupportedMediaType("Not a JSON object")
-    with db.transact("post_job") as conn:
-        jid, j = db.create_job(conn, req)
-        try:
-            wd = current_app.config['WORK_DIR']
-            j.workdir = tempfile.mkdtemp(dir=wd) if wd else None
-            tasks.launch(jid, j)
-        except:
-            j.close()
-            raise
+    jid, = submit_jobs([req], "post_job")
     return jsonify(jid), HTTPStatus.CREATED, {
         "Location": url_for('.get_job', job=jid)}
 
+@jobs_bp.route('/batch', methods=['POST'])
+def post_batch():
+    current_app.logger.debug("post_batch: %d bytes", len(request.data))
+    req = request.get_json()
+    if not (isinstance(req, list) and all(isinstance(r, dict) for r in req)):
+        raise wexc.UnsupportedMediaType("Not a JSON array of objects")
+    return jsonify(submit_jobs(req, "post_batch")), HTTPStatus.CREATED
+
 @jobs_bp.route('/<int:job>', methods=['DELETE'])
 def delete_job(job):
     err = None
     canc = tasks.cancel(job, delete=True)
-    if canc:
-        tasks.flush_updates()
     with db.transact("delete_job") as conn:
-        jobs = db.get_state(conn).jobs
-        j = jobs.get(job)
+        st = db.get_state(conn)
+        j = st.jobs.get(job)
         if j is None:
             if canc:
                 # That was quick!
@@ -74,34 +187,38 @@ def delete_job(job):
             else:
                 raise wexc.NotFound
         elif canc:
-            j.status = db.Job_status.CANCELLED
-        elif j.close():
-            del jobs[job]
-        else:
+            st.set_status(job, db.Job_status.CANCELLED)
+        elif tasks.defer_cancel(conn, job, delete=True):
+            canc = True
+        elif not st.close_job(job):
             err = j.error
     # Let's be careful - jsonify might raise.
     return ((jsonify("Cancelling active task"), HTTPStatus.ACCEPTED) if canc
             else util.empty_response if err is None
             else (jsonify(err), HTTPStatus.INTERNAL_SERVER_ERROR))
 
-@jobs_bp.route('/', methods=['DELETE'])
-def delete_all_jobs():
-    canc = frozenset(tasks.cancel_all(delete=True))
-    if canc:
-        tasks.flush_updates()
-    with db.transact("delete_all_jobs") as conn:
-        jobs = db.get_state(conn).jobs
-        nnow = len(jobs)
-        ncanc = nerr = 0
-        for jid, job in list(jobs.items()):
+def delete_jobs(ids, canc, note):
+    """Delete jobs and return a response summarising the outcome.
+    ids are the job ids or None for all jobs, canc a set of the
+    ids whose tasks have been cancelled with delete=True.  Active
+    jobs of other frontends are cancelled and deleted on termination.
+    """
+    with db.transact(note) as conn:
+        st = db.get_state(conn)
+        ids = (list(st.status_of.keys()) if ids is None
+               else [jid for jid in ids if jid in st.status_of])
+        nnow = len(ids)
+        nlocal = ncanc = nerr = 0
+        for jid in ids:
             if jid in canc:
+                nlocal += 1
+                st.set_status(jid, db.Job_status.CANCELLED)
+            elif tasks.defer_cancel(conn, jid, delete=True):
                 ncanc += 1
-                job.status = db.Job_status.CANCELLED
-            elif job.close():
-                del jobs[jid]
-            else:
+            elif not st.close_job(jid):
                 nerr += 1
-    ntot = len(canc) + nnow - ncanc
+    ncanc += nlocal
+    ntot = len(canc) + nnow - nlocal
     return ((jsonify("Errors deleting %d/%d jobs" % (nerr, ntot)),
              HTTPStatus.INTERNAL_SERVER_ERROR) if nerr
             else (jsonify("%d/%d job deletions pending cancellation"
@@ -109,6 +226,11 @@ def delete_all_jobs():
                   HTTPStatus.ACCEPTED) if ncanc
             else jsonify("%d jobs deleted" % ntot))
 
+@jobs_bp.route('/', methods=['DELETE'])
+def delete_all_jobs():
+    canc = frozenset(tasks.cancel_all(delete=True))
+    return delete_jobs(None, canc, "delete_all_jobs")
+
 @jobs_bp.route('/<int:job>/error')
 def get_error(job):
     with db.transact() as conn:
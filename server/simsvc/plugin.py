@@ -0,0 +1,35 @@
+"""Dask scheduler plugin for tracking simsvc tasks.
+
+This module is loaded on the Dask scheduler, thus it must not import
+model or other parts of simsvc that the scheduler may lack.
+"""
+
+from distributed.diagnostics.plugin import SchedulerPlugin
+
+# Event topic for task transitions.
+topic = "simsvc-tasks"
+# Task annotation containing the job id.
+annotation = "simsvc_job"
+
+class Task_tracker(SchedulerPlugin):
+    """Report state transitions of simsvc tasks to the server.
+
+    Tasks are recognised by annotation simsvc_job, whose value is the
+    job id.  Transitions into processing, memory and erred are logged
+    as scheduler events (job id, key, state) on topic, to which the
+    server subscribes.  The server gets event times from the log.
+    """
+    name = "simsvc-task-tracker"
+    idempotent = True
+    states = frozenset(["processing", "memory", "erred"])
+
+    async def start(s, scheduler):
+        s.scheduler = scheduler
+
+    def transition(s, key, start, finish, *args, **kws):
+        if finish not in s.states:
+            return
+        ts = s.scheduler.tasks.get(key)
+        jid = ts is not None and (ts.annotations or {}).get(annotation)
+        if jid:
+            s.scheduler.log_event(topic, (jid, key, finish))
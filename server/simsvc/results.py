@@ -0,0 +1,144 @@
+"""Requests for tabulating inputs and results across jobs.
+"""
+
+from itertools import islice
+
+import dask, flask
+from flask import Blueprint, jsonify, request, url_for
+import werkzeug.exceptions as wexc
+
+from . import codec, db, store, util
+
+results_bp = Blueprint('results_bp', __name__)
+
+def names_arg(param):
+    """Return the names in query parameter param: None if not given,
+    "*" for all or a list of names.
+    """
+    arg = request.args.get(param)
+    if arg is None or arg.strip() == "*":
+        return arg and "*"
+    return [vn.strip() for vn in arg.split(",")]
+
+def _names(names, dicts):
+    """Return names (as from names_arg) as a list, with "*" replaced
+    by all keys of dicts (which may be None) in order of appearance.
+    """
+    if names is None:
+        return []
+    if names == "*":
+        seen = {}
+        for d in dicts:
+            seen.update(dict.fromkeys(d or ()))
+        names = list(seen)
+    return names
+
+def _columns(prefix, names, dicts):
+    """Return columns prefix + name -> list of values from dicts.
+    Missing values (and dicts that are None) are None.  names is a
+    list from _names.
+    """
+    return {prefix + n: [None if d is None else d.get(n) for d in dicts]
+            for n in names}
+
+def _missing(prefix, names, dicts):
+    """Return a list of lists of prefix + name for names missing from
+    each of dicts.
+    """
+    return [[prefix + n for n in names if d is None or n not in d]
+            for d in dicts]
+
+def states_arg(default=None):
+    """Return the set of Job_statuses in query parameter status or
+    None if neither it nor default (a string like status) is given.
+    """
+    status = request.args.get("status", default)
+    if status is None:
+        return None
+    try:
+        return {db.Job_status[s] for s in status.split(",")}
+    except KeyError as e:
+        raise wexc.BadRequest("Unknown job state %s" % e)
+
+def columns(st, ids, inputs=None, results=None, missing=False):
+    """Return the table of jobs ids (a list) in App_state st as a dict
+    column name -> list.  inputs and results are the input and result
+    names as from names_arg.  If missing, column "missing" lists for
+    each job the names of the other columns whose values it lacks,
+    which tells them from None values.  Call within a transaction.
+    """
+    jobs = [st.jobs[k] for k in ids]
+    cols = {"job": ids, "status": [j.status.name for j in jobs]}
+    miss = [[] for j in jobs]
+    for prefix, names, dicts in [
+            ("inputs.", inputs, [j.inputs for j in jobs]),
+            ("results.", results, [j.results for j in jobs])]:
+        names = _names(names, dicts)
+        cols.update(_columns(prefix, names, dicts))
+        if missing:
+            for m, ms in zip(miss, _missing(prefix, names, dicts)):
+                m.extend(ms)
+    if missing:
+        cols["missing"] = miss
+    return cols
+
+def table_response(cols, headers=None):
+    """Return a response with cols from columns, encoded according to
+    the Accept headers of the request.  Call after the transaction.
+    """
+    explicit = {mt for mt, q in request.accept_mimetypes if q > 0}
+    offers = codec.offers(cols)
+    if codec.ARROW in explicit and codec.have_arrow():
+        offers.append(codec.ARROW)
+    mt = request.accept_mimetypes.best_match(offers, codec.JSON)
+    if mt == codec.MSGPACK:
+        body = codec.pack_msgpack(
+            cols, dask.config.get('simsvc.server.array-min-size'))
+    else:
+        files = {}
+        cols = {k: [store.load_value(v, files) for v in col]
+                for k, col in cols.items()}
+        for f in files.values():
+            f.close()
+        body = None
+        if mt == codec.ARROW:
+            try:
+                body = codec.pack_arrow(cols)
+            except (TypeError, ValueError):
+                # Not representable, e.g., mixed types in a column.
+                mt = codec.JSON
+        if body is None:
+            body = jsonify(cols).get_data()
+    resp = flask.Response(body, mimetype=mt, headers=headers)
+    return codec.finish(
+        resp, request.accept_encodings.best_match(codec.encodings()),
+        dask.config.get('simsvc.server.compress-min-bytes'))
+
+@results_bp.route('/')
+def get_table():
+    """Return a table of job inputs and results.
+    See the REST API documentation for the parameters.
+    """
+    inputs = names_arg("inputs")
+    results = names_arg("vars")
+    states = states_arg("DONE")
+    since = request.args.get("since", type=float)
+    until = request.args.get("until", type=float)
+    after = request.args.get("after", type=int)
+    limit = request.args.get("limit", type=int)
+    missing = request.args.get("missing", False, type=util.boolstr)
+    if limit is not None and limit < 1:
+        raise wexc.BadRequest("limit must be positive")
+    with db.transact() as conn:
+        st = db.get_state(conn)
+        ids = st.select_ids(states, since, until, after)
+        ids = list(ids if limit is None else islice(ids, limit + 1))
+        hdrs = {}
+        if limit is not None and len(ids) > limit:
+            del ids[limit:]
+            args = request.args.to_dict()
+            args["after"] = ids[-1]
+            hdrs["Link"] = '<%s>; rel="next"' % url_for(
+                '.get_table', **args)
+        cols = columns(st, ids, inputs, results, missing)
+    return table_response(cols, hdrs)
@@ -0,0 +1,71 @@
+"""Time series selection for result requests.
+
+Time series are represented as dicts with fields times and values,
+where times is a vector of time values or the name of another variable
+containing such a vector and values is a vector of the same length.
+The times are assumed to be ascending.  This module selects windows
+of series and downsamples them with NumPy.
+"""
+
+AGGREGATES = {"mean", "min", "max"}
+
+def is_series(v):
+    """Return true if v looks like a time series."""
+    return isinstance(v, dict) and set(v) == {"times", "values"}
+
+def _array(v):
+    from . import codec
+    a = codec.as_array(v)
+    if a is None:
+        raise ValueError("Not a numeric array")
+    return a
+
+def select(times, values, start=None, end=None, step=None,
+           buckets=None, agg="mean"):
+    """Select from a time series.  Return (times, values) as ndarrays.
+
+    times and values are vectors (lists, ndarrays or Array_refs) of
+    equal length.  If start or end is given, only the samples with
+    start <= time <= end are kept.  Then, if step is given, every
+    step'th sample is kept.  Alternatively, if buckets is given, the
+    window is divided into that many intervals of equal length and
+    values in each nonempty interval are aggregated by agg, which is
+    one of AGGREGATES; the times are those of the interval starts.
+    """
+    import numpy as np
+    t = _array(times)
+    v = _array(values)
+    if t.ndim != 1 or len(t) != len(v):
+        raise ValueError("Times and values differ in length")
+    lo = 0 if start is None else np.searchsorted(t, start, "left")
+    hi = len(t) if end is None else np.searchsorted(t, end, "right")
+    t, v = t[lo:hi], v[lo:hi]
+    if step is not None:
+        if buckets is not None:
+            raise ValueError("Cannot have both step and buckets")
+        if step < 1:
+            raise ValueError("step must be positive")
+        return t[::step], v[::step]
+    if buckets is None or not len(t):
+        return t, v
+    if buckets < 1:
+        raise ValueError("buckets must be positive")
+    if agg not in AGGREGATES:
+        raise ValueError("Unknown aggregate %s" % agg)
+    t0 = t[0] if start is None else start
+    t1 = t[-1] if end is None else end
+    edges = np.linspace(t0, t1, buckets + 1)
+    # Interval i is [edges[i], edges[i+1]), the last one closed.
+    first = np.unique(np.searchsorted(t, edges[:-1], "left"))
+    first = first[first < len(t)]
+    bt = edges[np.searchsorted(edges, t[first], "right") - 1]
+    bt = np.minimum(bt, edges[-2])
+    if agg == "min":
+        bv = np.minimum.reduceat(v, first)
+    elif agg == "max":
+        bv = np.maximum.reduceat(v, first)
+    else:
+        counts = np.diff(np.append(first, len(t)))
+        bv = (np.add.reduceat(v.astype(float), first)
+              / counts.reshape((-1,) + (1,) * (v.ndim - 1)))
+    return bt, bv
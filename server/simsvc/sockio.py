@@ -3,10 +3,32 @@
 To use this, create a TaskFlask app and call
 socketio = bind_socketio(app).  Run the app with socketio.run(app) or
 see the Flask-SocketIO docs for other server options.
+
+Events about a job are emitted to the rooms job_room(job id) and
+ALL_ROOM, once to clients in both.  Clients start in ALL_ROOM and can
+instead subscribe to the jobs that they are interested in (see
+Simsvc_namespace).  The room of a job is closed when it terminates;
+subscribing to a job that has already terminated sends its terminated
+event instead.  Clients that subscribe
+with batch are in the same rooms prefixed with BATCH_PREFIX instead
+and receive lists of events (see Monitor).
 """
 
-from flask import request
-from flask_socketio import Namespace, SocketIO
+import threading
+
+import dask
+from flask import current_app, request
+from flask_socketio import Namespace, SocketIO, emit, join_room, leave_room
+
+from . import db
+
+ALL_ROOM = "all"
+BATCH_PREFIX = "batch:"
+# WSGI environ key set by leader_app.
+LEADER_ENVIRON = "simsvc.sockio.leader"
+
+def job_room(jid):
+    return "job-%d" % jid
 
 class Simsvc_namespace(Namespace):
     """Default namespace handler for simsvc.
@@ -21,14 +43,76 @@ class Simsvc_namespace(Namespace):
             s.logger.error(
                 "Socket.IO: refusing connection from unknown address")
             return False
+        elif (current_app.config['FRONTENDS'] > 1
+              and not request.environ.get(LEADER_ENVIRON)):
+            s.logger.warning(
+                "Socket.IO: refusing connection from %s on the shared"
+                " address; use simsvc.server.sockio-address", addr)
+            return False
         else:
             s.logger.info("Socket.IO: %s connected", addr)
+            join_room(ALL_ROOM)
 
     def on_disconnect(s):
         s.logger.info("Socket.IO: %s disconnected", request.remote_addr)
 
+    def on_subscribe(s, data):
+        """Subscribe to events of jobs.
+        data is a dict with optional fields jobs, a list of job ids
+        whose events to receive, all, whether to receive events of
+        all jobs, and batch, whether to receive them in lists (both
+        default false).  Returns true (as acknowledgement).
+
+        Jobs that have terminated are not joined, because their rooms
+        would never close.  Unless all, the client gets their
+        terminated events at once instead.  Unknown jobs are ignored.
+        """
+        batch = data.get('batch')
+        pre = BATCH_PREFIX if batch else ""
+        with db.transact() as conn:
+            st = db.get_state(conn)
+            statuses = [(jid, st.status(jid))
+                        for jid in map(int, data.get('jobs', ()))]
+        done = []
+        for jid, status in statuses:
+            if status is None:
+                continue
+            if status.active() or status == db.Job_status.INVALID:
+                join_room(pre + job_room(jid))
+            else:
+                done.append({'job': jid, 'status': status.name.lower()})
+        leave_room(ALL_ROOM)
+        leave_room(BATCH_PREFIX + ALL_ROOM)
+        if data.get('all'):
+            join_room(pre + ALL_ROOM)
+        elif done and batch:
+            emit('terminated_batch', done)
+        else:
+            for ev in done:
+                emit('terminated', ev)
+        return True
+
+    def on_unsubscribe(s, data):
+        """Unsubscribe from events of data['jobs'], a list of job ids.
+        """
+        for jid in data.get('jobs', ()):
+            room = job_room(int(jid))
+            leave_room(room)
+            leave_room(BATCH_PREFIX + room)
+        return True
+
 class Monitor(object):
     """A monitor that sends events over Socket.IO.
+
+    Events are queued and emitted by a background task every
+    simsvc.server.event-interval seconds: individually to the rooms of
+    their jobs and in lists (launched_batch, terminated_batch) to
+    clients that subscribed with batch, at most one of each per client
+    per interval.  A queued progress event is replaced by a later one
+    of the same job.  Once simsvc.server.event-queue events are queued,
+    new progress events are dropped (and logged); launched and
+    terminated events are always queued.
+
     Instance attributes, also constructor arguments:
     app		Flask app that we monitor
     sio		SocketIO instance to use
@@ -36,36 +120,101 @@ class Monitor(object):
     def __init__(s, app, sio):
         s.app = app
         s.sio = sio
-        if s.sio.async_mode == 'threading':
-            s._queue = None
-        elif s.sio.async_mode == 'eventlet':
-            from queue import Queue
-            s._queue = Queue()
-            def emitter():
-                from eventlet import tpool
-                while True:
-                    ev, arg = tpool.execute(s._queue.get)
-                    s.sio.emit(ev, arg)
-            s.sio.start_background_task(emitter)
-        else:
+        if s.sio.async_mode not in ['threading', 'eventlet']:
             raise ValueError("Unsupported socketio.asyncmode %s"
                              % s.sio.async_mode)
+        s.interval = dask.config.get('simsvc.server.event-interval')
+        s.max_queued = dask.config.get('simsvc.server.event-queue')
+        # Event callbacks run in Dask client threads.
+        s._lock = threading.Lock()
+        s._queue = []
+        # job id -> index of its progress event in _queue
+        s._progress = {}
+        s._dropped = 0
+        def emitter():
+            while True:
+                try:
+                    s.flush()
+                except:
+                    s.app.logger.exception("Socket.IO emitter failed")
+                s.sio.sleep(s.interval)
+        s.sio.start_background_task(emitter)
 
     def __call__(s, jid, fut):
-        fut.add_done_callback(lambda fut: s.finish(jid, fut))
-        s.sio.emit('launched', jid)
-    
-    def _emit(s, ev, arg):
-        if s._queue is None:
-            s.sio.emit(ev, arg)
-        else:
-            s._queue.put((ev, arg))
+        s._emit('launched', jid, jid)
+
+    def terminated(s, jid, status):
+        """Emit the final status of job jid and close its room."""
+        s._emit('terminated', {'job': jid, 'status': status}, jid, True)
 
-    def finish(s, jid, fut):
-        st = ('cancelled' if fut.cancelled()
-              else 'failed' if fut.exception()
-              else 'done')
-        s._emit('terminated', {'job': jid, 'status': st})
+    def progress(s, jid, fraction, values):
+        """Emit a progress report of job jid.
+        Only the latest report of a job per interval is emitted.  It
+        may be dropped if the queue is full.
+        """
+        s._emit('progress',
+                {'job': jid, 'progress': fraction, 'values': values}, jid)
+
+    def _emit(s, ev, arg, jid, last=False):
+        # Queue event ev with argument arg about job jid.  If last,
+        # the room of the job is closed after emitting.
+        with s._lock:
+            if ev != 'progress':
+                # Later progress goes after this.
+                s._progress.pop(jid, None)
+            elif jid in s._progress:
+                s._queue[s._progress[jid]] = (ev, arg, jid, last)
+                return
+            elif len(s._queue) >= s.max_queued:
+                s._dropped += 1
+                return
+            else:
+                s._progress[jid] = len(s._queue)
+            s._queue.append((ev, arg, jid, last))
+
+    def _members(s, room):
+        try:
+            return set(s.sio.server.manager.get_participants("/", room))
+        except KeyError:
+            return set()
+
+    def flush(s):
+        """Emit queued events."""
+        with s._lock:
+            events, s._queue = s._queue, []
+            s._progress = {}
+            dropped, s._dropped = s._dropped, 0
+        if dropped:
+            s.app.logger.warning("Socket.IO: dropped %d progress events", dropped)
+        if not events:
+            return
+        batch_all = s._members(BATCH_PREFIX + ALL_ROOM)
+        # Clients in ALL_ROOM that also subscribed to jobs.
+        in_all = list(s._members(ALL_ROOM))
+        batches = {}
+        for ev, arg, jid, last in events:
+            room = job_room(jid)
+            s.sio.emit(ev, arg, room=room, skip_sid=in_all)
+            s.sio.emit(ev, arg, room=ALL_ROOM)
+            for sid in batch_all | s._members(BATCH_PREFIX + room):
+                batches.setdefault(sid, {}).setdefault(
+                    ev + "_batch", []).append(arg)
+            if last:
+                s.sio.close_room(room)
+                s.sio.close_room(BATCH_PREFIX + room)
+        for sid, evs in batches.items():
+            for ev, args in evs.items():
+                s.sio.emit(ev, args, room=sid)
+
+def leader_app(app):
+    """Return a WSGI app that serves app, marking requests as coming
+    to the leader's own Socket.IO address.  With multiple frontends
+    Simsvc_namespace accepts only such connections.
+    """
+    def wsgi_app(environ, start_response):
+        environ[LEADER_ENVIRON] = True
+        return app(environ, start_response)
+    return wsgi_app
 
 def bind_socketio(app, **kws):
     """Create and return a SocketIO instance bound to the Flask app.
@@ -0,0 +1,10 @@
+"""Requests for server status.
+"""
+
+from flask import Blueprint, jsonify, current_app
+
+status_bp = Blueprint('status_bp', __name__)
+
+@status_bp.route('/')
+def get_status():
+    return jsonify(current_app.stats())
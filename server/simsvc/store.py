@@ -0,0 +1,174 @@
+"""Out-of-database storage for large results.
+
+By default job results are stored in the job database.  Large numeric
+sequences, such as the time series returned by the FMI model, bloat
+the database: every element becomes a pickled Python number.  A result
+store saves them in compressed NumPy .npz files instead and the
+database only holds an Array_ref to each.  See simsvc.results in
+simsvc.yaml for configuration.
+
+NumPy is only required if a store is configured.
+"""
+
+import json, os, tempfile
+
+class Array_ref(object):
+    """A reference to an array in an .npz file.
+    Stored in the database in place of the array.  Treat as immutable.
+
+    Instance attributes, also constructor arguments:
+    path	The .npz file name
+    name	Name of the array in the file
+    size	Length of the array
+    """
+    def __init__(s, path, name, size):
+        s.path = path
+        s.name = name
+        s.size = size
+
+    def __repr__(s):
+        return "Array_ref(%r, %r, %r)" % (s.path, s.name, s.size)
+
+    def load(s, files=None):
+        """Return the array as a numpy.ndarray.
+        files is an optional dict file name -> open .npz file, for
+        loading several arrays without reopening their file.
+        """
+        import numpy as np
+        if files is None:
+            with np.load(s.path) as f:
+                return f[s.name]
+        f = files.get(s.path)
+        if f is None:
+            f = files[s.path] = np.load(s.path)
+        return f[s.name]
+
+def load_value(v, files=None):
+    """Return v with any Array_refs, also those nested in dicts,
+    replaced by lists.  files is as with Array_ref.load.
+    """
+    if isinstance(v, Array_ref):
+        return v.load(files).tolist()
+    elif isinstance(v, dict):
+        return {k: load_value(x, files) for k, x in v.items()}
+    else:
+        return v
+
+def has_refs(v):
+    """Return true if v is or contains (in dicts) an Array_ref.
+    """
+    return (isinstance(v, Array_ref)
+            or isinstance(v, dict) and any(map(has_refs, v.values())))
+
+def iter_json(v, chunk=1000):
+    """Generate JSON for v in pieces, loading Array_refs on the way.
+    Arrays are generated chunk elements at a time, thus the JSON text
+    of an array need not be held in memory at once.  Dict keys are
+    sorted.
+    """
+    if isinstance(v, Array_ref):
+        a = v.load()
+        yield "["
+        for i in range(0, len(a), chunk):
+            yield ("," if i else "") + json.dumps(a[i : i + chunk].tolist())[1:-1]
+        yield "]"
+    elif isinstance(v, dict):
+        yield "{"
+        for i, k in enumerate(sorted(v)):
+            yield ("," if i else "") + json.dumps(str(k)) + ":"
+            yield from iter_json(v[k], chunk)
+        yield "}"
+    else:
+        yield json.dumps(v)
+
+class Npz_store(object):
+    """A result store that saves large arrays in one .npz file per job.
+
+    Constructor arguments, also instance attributes:
+    directory	Where to create files.  If None, use the job work
+		directory; jobs without one keep everything in the
+		database.
+    min_size	Lists and tuples of at least this many numbers (or
+		equally long lists of numbers) are saved in the file.
+		Smaller values stay in the database.
+    compress	Whether to compress the file.
+    """
+    def __init__(s, directory=None, min_size=1000, compress=True):
+        s.directory = directory
+        s.min_size = min_size
+        s.compress = compress
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _as_array(s, v):
+        # Return v as a numeric ndarray if it should be stored, else None.
+        import numpy as np
+        if not isinstance(v, (list, tuple)) or len(v) < s.min_size:
+            return None
+        try:
+            a = np.asarray(v)
+        except ValueError:
+            return None
+        return a if a.dtype.kind in "biuf" else None
+
+    def save(s, job, results):
+        """Move large values out of results, a dict name -> value.
+        job is the db.Job.  Return (dict, file name) where the dict
+        is like results but with large values, also those nested in
+        dicts, replaced by Array_refs to the file.  If nothing was
+        large, return (results, None).
+        """
+        import numpy as np
+        d = job.workdir if s.directory is None else s.directory
+        if d is None:
+            return results, None
+        fd, path = tempfile.mkstemp(prefix="results-", suffix=".npz", dir=d)
+        os.close(fd)
+        arrays = {}
+        def visit(v):
+            if isinstance(v, dict):
+                return {k: visit(x) for k, x in v.items()}
+            a = s._as_array(v)
+            if a is None:
+                return v
+            name = "a%d" % len(arrays)
+            arrays[name] = a
+            return Array_ref(path, name, len(a))
+        try:
+            out = {k: visit(v) for k, v in results.items()}
+            if arrays:
+                (np.savez_compressed if s.compress else np.savez)(
+                    path, **arrays)
+                return out, path
+        except:
+            os.remove(path)
+            raise
+        os.remove(path)
+        return results, None
+
+def make_store(conf):
+    """Create a result store from dask config simsvc.results (a dict).
+    Return None if results are to be kept in the database.
+
+    store is one of null, "workdir", "blob-dir" or "module:name" of a
+    callable that is called with conf and returns a store object.
+    Store objects have a method save like Npz_store.
+    """
+    kind = conf.get('store')
+    if kind is None:
+        return None
+    args = dict(min_size=conf.get('min-size', 1000),
+                compress=conf.get('compress', True))
+    if kind == "workdir":
+        return Npz_store(**args)
+    elif kind == "blob-dir":
+        d = conf.get('blob-dir')
+        if d is None:
+            raise ValueError("simsvc.results.blob-dir is not set")
+        return Npz_store(d, **args)
+    elif ":" in kind:
+        import importlib
+        mod, name = kind.split(":")
+        return getattr(importlib.import_module(mod), name)(conf)
+    else:
+        raise KeyError("Unknown result store %s" % kind)
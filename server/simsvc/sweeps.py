@@ -0,0 +1,192 @@
+"""Parameter sweeps: jobs generated on the server from a design.
+
+A design is a JSON object with field design naming its type:
+
+grid	Full factorial: inputs maps names to lists of levels and every
+	combination becomes a job, the last input varying fastest.
+lhs	Latin hypercube sample of points (a number) points: inputs
+	maps names to bounds [low, high].  Optional seed.
+sobol	Sobol sequence over the same bounds, scrambled with optional
+	seed.  Requires SciPy.
+table	Explicit points: table is an object of equally long columns
+	(name -> list of values) or a list of objects.
+
+Optional field fixed is an object of inputs common to all points;
+the server defaults apply as usual.  The expansion is in design_points,
+the requests in sweeps_bp.
+"""
+
+from flask import Blueprint, jsonify, request, url_for
+import werkzeug.exceptions as wexc
+from http import HTTPStatus
+
+import dask
+
+from . import db, jobs, results, tasks
+from .auth import current_user
+
+DESIGNS = {"grid", "lhs", "sobol", "table"}
+
+def _bounds(inputs):
+    # Return names and bounds as lists; bounds are [low, high].
+    names, lo, hi = [], [], []
+    for k, b in inputs.items():
+        if not (isinstance(b, list) and len(b) == 2
+                and all(isinstance(x, (int, float)) for x in b)
+                and b[0] <= b[1]):
+            raise ValueError("Bounds of %s must be [low, high]" % k)
+        names.append(k)
+        lo.append(b[0])
+        hi.append(b[1])
+    return names, lo, hi
+
+def _unit_sample(kind, n, d, seed):
+    """Return an n x d ndarray of points in the unit cube."""
+    import numpy as np
+    if kind == "sobol":
+        try:
+            from scipy.stats import qmc
+        except ImportError:
+            raise ValueError("Sobol designs require SciPy")
+        return qmc.Sobol(d, scramble=True, seed=seed).random(n)
+    rng = np.random.default_rng(seed)
+    # One sample in each of n equal strata per dimension.
+    perms = np.argsort(rng.random((d, n)), axis=1).T
+    return (perms + rng.random((n, d))) / n
+
+def _grid(inputs, max_points):
+    names = list(inputs)
+    n = 1
+    for k in names:
+        if not (isinstance(inputs[k], list) and inputs[k]):
+            raise ValueError("Levels of %s must be a nonempty list" % k)
+        n *= len(inputs[k])
+    _check_size(n, max_points)
+    rows = [{}]
+    for k in names:
+        rows = [dict(r, **{k: v}) for r in rows for v in inputs[k]]
+    return names, rows
+
+def _table(table):
+    if isinstance(table, dict):
+        cols = list(table.values())
+        if (not all(isinstance(c, list) for c in cols)
+                or len(set(map(len, cols))) > 1):
+            raise ValueError("table columns must be equally long lists")
+        return list(table), [dict(zip(table, r)) for r in zip(*cols)]
+    elif isinstance(table, list) and all(isinstance(r, dict) for r in table):
+        return list({k: None for r in table for k in r}), table
+    else:
+        raise ValueError("table must be an object or a list of objects")
+
+def _sample(kind, inputs, n, seed, max_points):
+    names, lo, hi = _bounds(inputs)
+    if not isinstance(n, int) or n < 1:
+        raise ValueError("points must be a positive integer")
+    _check_size(n, max_points)
+    if seed is not None and not isinstance(seed, int):
+        raise ValueError("seed must be an integer")
+    import numpy as np
+    u = _unit_sample(kind, n, len(names), seed)
+    x = np.asarray(lo) + u * (np.asarray(hi) - lo)
+    return names, [dict(zip(names, r)) for r in x.tolist()]
+
+def _check_size(n, max_points):
+    if max_points is not None and n > max_points:
+        raise ValueError("Design has %d > %d points" % (n, max_points))
+
+def design_points(design, max_points=None):
+    """Expand design (a dict, see the module doc) into a list of input
+    dicts.  Return (names of varied inputs, list of input dicts).
+    Raise ValueError if the design is invalid or has more than
+    max_points points.
+    """
+    if not isinstance(design, dict):
+        raise ValueError("Design must be an object")
+    kind = design.get("design")
+    if kind not in DESIGNS:
+        raise ValueError("design must be one of %s"
+                         % ", ".join(sorted(DESIGNS)))
+    fixed = design.get("fixed", {})
+    if not isinstance(fixed, dict):
+        raise ValueError("fixed must be an object")
+    inputs = design.get("inputs")
+    if kind == "table":
+        names, rows = _table(design.get("table"))
+        _check_size(len(rows), max_points)
+    elif not (isinstance(inputs, dict) and inputs):
+        raise ValueError("inputs must be a nonempty object")
+    elif kind == "grid":
+        names, rows = _grid(inputs, max_points)
+    else:
+        names, rows = _sample(kind, inputs, design.get("points"),
+                              design.get("seed"), max_points)
+    return names, [dict(fixed, **r) for r in rows]
+
+sweeps_bp = Blueprint('sweeps_bp', __name__)
+
+def _sweep(st, sweep):
+    try:
+        return st.sweeps[sweep]
+    except KeyError as e:
+        raise wexc.NotFound from e
+
+@sweeps_bp.route('/', methods=['POST'])
+def post_sweep():
+    design = request.get_json()
+    if not isinstance(design, dict):
+        raise wexc.UnsupportedMediaType("Not a JSON object")
+    try:
+        names, points = design_points(
+            design, dask.config.get('simsvc.sweeps.max-points'))
+    except ValueError as e:
+        raise wexc.BadRequest(str(e))
+    sid = None
+    def record(conn, ids):
+        nonlocal sid
+        sid = db.get_state(conn).add_sweep(
+            db.Sweep(design, names, ids, current_user()))
+    ids = jobs.submit_jobs(points, "post_sweep", record)
+    return (jsonify({"sweep": sid, "jobs": ids}), HTTPStatus.CREATED,
+            {"Location": url_for('.get_sweep', sweep=sid)})
+
+@sweeps_bp.route('/')
+def get_sweeps():
+    with db.transact() as conn:
+        return jsonify(list(db.get_state(conn).sweeps.keys()))
+
+@sweeps_bp.route('/<int:sweep>')
+def get_sweep(sweep):
+    with db.transact() as conn:
+        st = db.get_state(conn)
+        sw = _sweep(st, sweep)
+        return jsonify({"design": sw.design, "varied": list(sw.varied),
+                        "owner": sw.owner, "created": sw.created,
+                        "jobs": list(sw.jobs), "counts": sw.counts(st)})
+
+@sweeps_bp.route('/<int:sweep>/results')
+def get_sweep_results(sweep):
+    """Return the table of the jobs of the sweep, in design order.
+    By default the varied inputs and all results of all existing jobs.
+    """
+    states = results.states_arg()
+    with db.transact() as conn:
+        st = db.get_state(conn)
+        sw = _sweep(st, sweep)
+        inputs = results.names_arg("inputs") or list(sw.varied)
+        res = results.names_arg("vars") or "*"
+        ids = [k for k in sw.jobs if st.status(k) is not None
+               and (states is None or st.status(k) in states)]
+        cols = results.columns(st, ids, inputs, res)
+    return results.table_response(cols)
+
+@sweeps_bp.route('/<int:sweep>', methods=['DELETE'])
+def delete_sweep(sweep):
+    """Delete the sweep and its jobs."""
+    with db.transact() as conn:
+        ids = _sweep(db.get_state(conn), sweep).jobs
+    canc = frozenset(jid for jid in ids if tasks.cancel(jid, delete=True))
+    resp = jobs.delete_jobs(ids, canc, "delete_sweep")
+    with db.transact("delete_sweep") as conn:
+        db.get_state(conn).sweeps.pop(sweep, None)
+    return resp
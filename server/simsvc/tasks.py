@@ -2,14 +2,21 @@
 """
 
 from concurrent.futures import CancelledError
-import queue, sys, traceback as tb
+from collections import Counter, OrderedDict, deque
+from collections.abc import Mapping
+from contextlib import contextmanager
+import copy, hashlib, heapq, operator, pickle, queue, sys, threading, time, uuid
+import traceback as tb
 
 import flask
 from werkzeug.utils import cached_property
 import dask.distributed as dd
-import dask.config
+import dask, dask.config
+from dask.delayed import Delayed
+from dask.highlevelgraph import HighLevelGraph
+from ZODB.POSException import ConflictError
 
-from . import db
+from . import autoscale, db, plugin, store, util
 
 import model
 
@@ -38,6 +45,23 @@ def make_slurm(**kws):
 cluster_types = {'local': dd.LocalCluster, 'kubernetes': make_kube,
                  'slurm': make_slurm}
 
+def resource_args(cltype, resources, kws):
+    """Return cluster constructor kws with arguments added that make
+    workers declare resources (a dict name -> amount).  Kubernetes
+    workers must declare them in the pod spec instead.
+    """
+    if not resources:
+        return kws
+    if cltype == 'local':
+        return dict(kws, resources=resources)
+    elif cltype == 'slurm':
+        res = ",".join("%s=%s" % kv for kv in resources.items())
+        return dict(kws, worker_extra_args=list(
+            kws.get('worker_extra_args', [])) + ["--resources", res])
+    else:
+        raise ValueError("Cannot declare worker resources for cluster type"
+                         " %s: set them in the worker configuration" % cltype)
+
 def timeout_kluge(f, logger=None):
     """Return f(), handle IOErrors.
     If f raises IOError with a message containing "timed out" (in any case),
@@ -55,6 +79,122 @@ def timeout_kluge(f, logger=None):
         else:
             raise
 
+# Worker event topic for progress reports (see Task_spec.progress).
+progress_topic = "simsvc-progress"
+
+# Key of input values that refer to results of other jobs.
+FROM = "$from"
+
+class Input_error(ValueError):
+    """Job inputs are invalid.
+    """
+
+class Dependency_error(Input_error):
+    """An input refers to a result of another job that is not available.
+    """
+
+class Transient_error(Exception):
+    """Models raise this for errors that may go away on retry.
+    Jobs that fail with it are retried (simsvc.tasks.retries).
+    """
+
+def retryable(exc):
+    """Return true if the failure of a task with exception exc should
+    be retried: exc is a Transient_error or an instance of a type
+    named in simsvc.tasks.retry-on.  Names may be plain (KilledWorker)
+    or qualified with the module (distributed.scheduler.KilledWorker).
+    """
+    if isinstance(exc, Transient_error):
+        return True
+    names = set()
+    for c in type(exc).__mro__:
+        names.update((c.__name__, "%s.%s" % (c.__module__, c.__qualname__)))
+    return not names.isdisjoint(
+        dask.config.get('simsvc.tasks.retry-on') or ())
+
+def upstream_ref(v):
+    """Return (job id, result name) if input value v refers to a result
+    of another job, i.e., is {"$from": [job id, result name]}, else
+    None.  Raise Dependency_error if the reference is malformed.
+    """
+    if not (isinstance(v, Mapping) and len(v) == 1 and FROM in v):
+        return None
+    r = v[FROM]
+    if not (isinstance(r, (list, tuple)) and len(r) == 2
+            and isinstance(r[0], int) and isinstance(r[1], str)):
+        raise Dependency_error("Invalid %s: %r" % (FROM, r))
+    return r[0], r[1]
+
+def _upstream_error(jid, name):
+    raise Dependency_error("Result %s of job %s is not available"
+                           % (name, jid))
+
+def _with_upstream(spec, values):
+    """Return a copy of Task_spec spec with values (a dict name -> value)
+    replacing its inputs.  Called on workers for dependent jobs.
+    """
+    spec = copy.copy(spec)
+    if isinstance(spec.inputs, Task_inputs):
+        spec.inputs = Task_inputs({**spec.inputs._values, **values})
+    else:
+        spec.inputs = {**spec.inputs, **values}
+    return spec
+
+class Shared_input(object):
+    """A placeholder for an input value scattered to the workers.
+    Instance attributes, also constructor arguments:
+    key		The Dask key of the value
+    """
+    __slots__ = ['key']
+
+    def __init__(s, key):
+        s.key = key
+
+# Shared input values resolved on this worker: key -> value.
+_resolved = OrderedDict()
+_resolved_max = 16
+_resolved_lock = threading.Lock()
+
+def resolve_shared(key):
+    """Return the value of the shared input with Dask key key.
+    Called in tasks on workers.  The shared data is the pickled value;
+    values are unpickled and cached per worker process, so each is
+    transferred and unpickled at most once unless evicted.
+    """
+    with _resolved_lock:
+        try:
+            _resolved.move_to_end(key)
+            return _resolved[key]
+        except KeyError:
+            pass
+    try:
+        b = dd.get_worker().data[key]
+    except (ValueError, KeyError):
+        b = dd.get_client().get_dataset(key).result()
+    v = pickle.loads(b)
+    with _resolved_lock:
+        _resolved[key] = v
+        while len(_resolved) > _resolved_max:
+            _resolved.popitem(last=False)
+    return v
+
+class Task_inputs(Mapping):
+    """Task inputs on a worker, with Shared_inputs resolved on access.
+    Constructor argument: a dict name -> value or Shared_input.
+    """
+    def __init__(s, values):
+        s._values = values
+
+    def __getitem__(s, k):
+        v = s._values[k]
+        return resolve_shared(v.key) if isinstance(v, Shared_input) else v
+
+    def __iter__(s):
+        return iter(s._values)
+
+    def __len__(s):
+        return len(s._values)
+
 class Task_spec(object):
     """Parameters passed to a simulation task.
     The task should treate this as read-only.
@@ -65,31 +205,135 @@ class Task_spec(object):
 		the task creates here are immediately downloadable
     		from the server.
     jobid	The job id.  Possibly useful for log messages.
+    shared	Inputs scattered to the workers: a dict name -> Dask key.
+		When pickled (sent to a worker) their values are replaced
+		with Shared_inputs, which inputs resolves on access.
+    progress_interval
+		Minimum seconds between progress reports.
     """
-    def __init__(s, jobid, job):
+    def __init__(s, jobid, job, shared=None):
         """Initialize from a .db.Job"""
-        s.inputs = job.inputs
+        s.inputs = dict(job.inputs)
         s.workdir = job.workdir
         s.jobid = jobid
+        s.shared = shared or {}
+        s.progress_interval = dask.config.get(
+            'simsvc.tasks.progress-interval')
+        s._progress_at = None
+
+    def progress(s, fraction=None, **values):
+        """Report progress from the task on a worker.
+        fraction is the fraction done (0 to 1) or None if unknown and
+        values are intermediate results, which should be small and
+        JSON serialisable.  The server relays reports to clients and
+        keeps the latest on the job.  Reports less than
+        progress_interval seconds after the previous one are dropped.
+        Return whether this one was sent.
+        """
+        now = time.monotonic()
+        if (s._progress_at is not None
+                and now - s._progress_at < s.progress_interval):
+            return False
+        s._progress_at = now
+        dd.get_worker().log_event(progress_topic, (s.jobid, fraction, values))
+        return True
 
-#XXX Can this actually be made to work somehow?
-class Bogo_var(object):
-    """Pretends to be a dask.distributed.Variable but is not actually shared.
+    def __getstate__(s):
+        state = dict(s.__dict__)
+        # Already Task_inputs if unpickled (e.g., by the scheduler).
+        if s.shared and not isinstance(s.inputs, Task_inputs):
+            state['inputs'] = Task_inputs(
+                {k: Shared_input(s.shared[k]) if k in s.shared else v
+                 for k, v in s.inputs.items()})
+        return state
+
+class Cancel_flag(object):
+    """A cancellation flag shared between the server and workers.
+
+    This is a thin wrapper around dask.distributed.Event that provides
+    the get/set interface of dask.distributed.Variable that models
+    have been written for.  The Event is named after the task key if
+    given, otherwise after the job and a random token, so the flag can
+    be pickled to workers and a restarted server can recreate the flag
+    of a task it reattaches to.  It only takes scheduler memory while
+    set; the server clears it some time after cancellation.
+
+    Instance attributes:
+    event	The dask.distributed.Event
     """
-    def __init__(s):
-        s.value = None
+    def __init__(s, jobid, client=None, key=None):
+        if key is None:
+            key = "%s-%s" % (jobid, uuid.uuid4().hex)
+        s.event = dd.Event("simsvc-cancel-%s" % key, client)
 
     def get(s):
-        return s.value
+        """Return true if cancellation has been requested."""
+        return s.event.is_set()
 
     def set(s, v):
-        s.value = v
+        """Request cancellation if v is true, otherwise clear the flag."""
+        if v:
+            s.event.set()
+        else:
+            s.event.clear()
+
+    def wait(s, timeout=None):
+        """Wait until cancellation is requested or timeout seconds elapse.
+        Return true if cancellation has been requested.  Models can use
+        this instead of sleeping between polls.
+        """
+        return s.event.wait(timeout)
+
+def keyed(d, key):
+    """Return a Delayed that computes Delayed d under the given key.
+    The result is an alias: it adds no task, only a graph key.  The
+    keys of d's graph are unchanged, thus two aliases of separately
+    built graphs do not share their computation.
+    """
+    return Delayed(key, HighLevelGraph.from_collections(
+        key, {key: d.key}, dependencies=[d]))
+
+class Task(object):
+    """Run-time state of an active job.
+
+    Instance attributes, also constructor arguments:
+    future	The dask.distributed.Future of the computation
+    cancel	Its Cancel_flag
+    owner	The user who posted the job or None
+    shared	Keys of the shared inputs that the task holds a
+		reference to (see TaskFlask.share_inputs)
+    Other instance attributes:
+    started	Time (as time.time()) when the task started processing
+		according to the scheduler or None.
+    finished	Time when the task finished according to the
+		scheduler or None.
+    key		The key of the original future, under which it may
+		have been published.
+    launched	Time when the task was launched (or attached to).
+    duplicate	The future of a speculative duplicate of the task or
+		None.  See TaskFlask.speculate.
+    speculated	Whether a duplicate has been launched.
+    upstream	The futures of other jobs whose results the task
+		takes as inputs.  job id -> future.  See
+		TaskFlask.rebind.
+    """
+    def __init__(s, future, cancel, owner=None, shared=(), upstream=None):
+        s.future = future
+        s.cancel = cancel
+        s.owner = owner
+        s.shared = shared
+        s.upstream = upstream or {}
+        s.started = s.finished = None
+        s.key = future.key
+        s.launched = time.time()
+        s.duplicate = None
+        s.speculated = False
 
 class TaskFlask(db.DBFlask):
     """A Flask app with Dask background jobs.
 
     Instance attributes:
-    tasks	Active tasks.  job id -> (future, cancellation flag).
+    tasks	Active tasks.  job id -> Task.
     		Entries are added by launch and deleted by callback when
     		futures terminate - which can happen at any time.  If
 		you need to iterate over tasks, make a copy.
@@ -105,10 +349,51 @@ class TaskFlask(db.DBFlask):
 		results should first check res and if not found there,
  		call the result method on the task future.
     monitor	An optional launch monitor.  Unless None
-    		monitor(job id, future) is called after a new job is launched.
-    		The monitor may call future.add_done_callback to detect
-    		job termination.  Exceptions raised by monitor are logged
-    		and suppressed.
+    		monitor(job id, future) is called after a new job is launched
+		(also when relaunched for a retry) and, if the monitor
+		has a terminated method, monitor.terminated(job id,
+		status) after the final outcome of the job ("done",
+		"failed" or "cancelled") has been committed.  Exceptions
+		raised by monitor are logged and suppressed.
+    terminated	(job id, status) pairs for monitor.terminated, saved in
+		the current update transaction.
+    written	Result files (see db.Job.save_results) written in the
+		current update transaction, removed if it fails.
+    relaunched	Jobs relaunched by relaunch since the last successful
+		commit of an update transaction.  job id -> task key
+		or None if the job was left waiting.
+    offload	A function for running blocking calls, called as
+		offload(f, *args, **kws).  It should return f(*args, **kws),
+		preferably without blocking other green threads.  The
+		default just calls f.  Used for gathering results.
+    pending_since  time.monotonic() when the oldest update currently
+		pending was scheduled or None if there are none.
+    drained_at	time.monotonic() when flush_updates last finished or None.
+    cancelled	Cancel_flags that have been set.  Cancel_flag -> time.monotonic()
+		when set.  They are cleared by clear_cancelled after
+		cancel_grace seconds, which should be enough for the
+		task to notice.
+    cancel_grace  See cancelled.
+    cache_hits, cache_misses  Result cache lookup counters.
+    in_flight	Number of tasks per owner.  A Counter.
+    waiting	Jobs waiting for launch because their owner has reached
+		the fair-share limit.  owner -> heap of (-priority, job id).
+		Waiting jobs are SCHEDULED in the database.
+    leader	Whether this process is the leader.  Only the leader has
+		a Dask client and runs tasks.  Other processes (frontends)
+		hand new jobs and cancellations over to the leader via the
+		database.  See try_lead.
+    released	Task keys whose datasets (see simsvc.tasks.reattach in
+		simsvc.yaml) are to be unpublished once the current
+		update transaction commits.  See update_transaction.
+    shared	Large input values scattered to the workers, see
+		share_inputs.  Dask key -> [future, reference count].
+    progress	Progress reports not yet saved in the database.
+		job id -> (fraction, values).  See progress_event.
+    runtimes	Run times in seconds of recent successful tasks, for
+		detecting stragglers.  See speculate.
+    retried, duplicated  Counters of automatic retries and
+		speculative duplicates launched.
     """
     def __init__(s, *args, **kws):
         """args and kws are passed to super.
@@ -118,6 +403,157 @@ class TaskFlask(db.DBFlask):
         s.gathers = {}
         s.updates = queue.Queue()
         s.monitor = None
+        s.offload = lambda f, *args, **kws: f(*args, **kws)
+        s.pending_since = s.drained_at = None
+        s.cancelled = {}
+        s.cancel_grace = 60
+        s.cache_hits = s.cache_misses = 0
+        s.in_flight = Counter()
+        s.waiting = {}
+        s.leader = False
+        s._leader_lock = None
+        s._applied = None
+        s._applied_res = s._regathered = {}
+        s.released = []
+        s.terminated = []
+        s.written = []
+        s.relaunched = {}
+        s.shared = {}
+        s._unshared = []
+        s._shared_lock = threading.Lock()
+        s._default_keys = {}
+        s.progress = {}
+        s._progress_lock = threading.Lock()
+        s.runtimes = deque(
+            maxlen=dask.config.get('simsvc.tasks.speculate.history'))
+        s.retried = s.duplicated = 0
+        s._done_lock = threading.Lock()
+        # Jobs being launched by launch_many -> task events that came
+        # before their Task, replayed once it is attached.
+        s._launching = {}
+        s._launch_lock = threading.Lock()
+        # Serialises flush_updates and sync_tasks in threading mode.
+        # Reentrant, thus never blocks green threads.
+        s._flush_lock = threading.RLock()
+
+    def try_lead(s):
+        """Try to become the leader and return s.leader.
+        If config LEADER_LOCK is None, there is only one process and it
+        always leads.  Otherwise the leader is the process that holds a
+        lock on that file; it leads until it exits.
+        """
+        if s.leader:
+            return True
+        path = s.config.get('LEADER_LOCK')
+        if path is not None:
+            import zc.lockfile
+            try:
+                s._leader_lock = zc.lockfile.LockFile(
+                    path, content_template="{pid}@{hostname}")
+            except zc.lockfile.LockError:
+                return False
+        s.leader = True
+        s.logger.info("This process is the leader")
+        return True
+
+    def schedule_update(s, upd):
+        """Add upd to updates.
+        This may be called from any thread.
+        """
+        if s.pending_since is None:
+            s.pending_since = time.monotonic()
+        s.updates.put(upd)
+
+    @contextmanager
+    def update_transaction(s, note):
+        """Return a context manager for a transaction that flushes updates.
+        This is like transact, except that if the transaction fails
+        on a conflict (e.g., with another frontend), the updates that
+        flush_updates performed in it are scheduled again, ahead of
+        those scheduled since, with the results it gathered, and the
+        ConflictError is logged and suppressed.  The files in written are then removed, because
+        the updates write them anew.  After a successful commit the
+        task datasets in released are unpublished and terminated jobs
+        reported.
+        """
+        s._applied = []
+        nrel = len(s.released)
+        nterm = len(s.terminated)
+        s.written = []
+        try:
+            with s.transact(note) as conn:
+                yield conn
+        except ConflictError:
+            s.logger.warning("%s: conflict, rescheduling %s updates",
+                             note, len(s._applied))
+            s._regathered = s._applied_res
+            later = []
+            while True:
+                try:
+                    later.append(s.updates.get_nowait())
+                except queue.Empty:
+                    break
+                s.updates.task_done()
+            for upd in s._applied + later:
+                s.schedule_update(upd)
+            del s.released[nrel:]
+            del s.terminated[nterm:]
+            for path in s.written:
+                util.tryrm(path)
+        else:
+            s.relaunched.clear()
+            s.unpublish_released()
+            s.report_terminated()
+        finally:
+            s._applied = None
+            s._applied_res = {}
+            s.written = []
+
+    def report_terminated(s, term=None):
+        """Pass term, (job id, status) pairs, to monitor.terminated.
+        By default term is terminated, which is then cleared.
+        """
+        if term is None:
+            term, s.terminated = s.terminated, []
+        report = getattr(s.monitor, 'terminated', None)
+        if report is None:
+            return
+        for jid, status in term:
+            try:
+                report(jid, status)
+            except:
+                s.logger.exception("monitor.terminated failed for job %s",
+                                   jid)
+
+    def report_on_commit(s, conn, term):
+        """Report term with report_terminated once the transaction of
+        database connection conn commits.  Nothing is reported if it
+        aborts.
+        """
+        def hook(committed):
+            if committed:
+                s.report_terminated(term)
+        conn.transaction_manager.get().addAfterCommitHook(hook)
+
+    def stats(s):
+        """Return a dict of run-time statistics.
+        Values are JSON serialisable.
+        """
+        now = time.monotonic()
+        ps, da = s.pending_since, s.drained_at
+        return {"leader": s.leader,
+                "tasks": len(s.tasks),
+                "updates": {"queued": s.updates.qsize(),
+                            "gathers": len(s.gathers),
+                            "lag": 0 if ps is None else now - ps,
+                            "since_drain": None if da is None else now - da},
+                "cache": {"hits": s.cache_hits, "misses": s.cache_misses},
+                "retried": s.retried, "duplicated": s.duplicated,
+                "autoscale": s.autoscale_stats(),
+                "shared_inputs": len(s.shared),
+                "owners": {str(o): {"in_flight": s.in_flight[o],
+                                    "waiting": len(s.waiting.get(o, ()))}
+                           for o in s.in_flight.keys() | s.waiting.keys()}}
 
     @cached_property
     def cluster(s):
@@ -129,12 +565,40 @@ class TaskFlask(db.DBFlask):
         ctor = cluster_types.get(cltype)
         if ctor is None:
             raise KeyError("Unknown cluster type %s" % cltype)
-        clust = ctor(**dask.config.get('simsvc.cluster.args'))
+        clust = ctor(**resource_args(
+            cltype, dask.config.get('simsvc.cluster.worker-resources'),
+            dask.config.get('simsvc.cluster.args')))
         ad = dask.config.get('simsvc.cluster.adapt')
         if ad:
+            if dask.config.get('simsvc.cluster.autoscale.target-latency'):
+                raise ValueError("simsvc.cluster.adapt and autoscale"
+                                 " are mutually exclusive")
             clust.adapt(**ad)
         return clust
 
+    def autoscale_stats(s):
+        """Return the stats of autoscaler or None if we do not scale.
+        Never creates the autoscaler (or the cluster): only the leader
+        does that, in flush_updates.
+        """
+        if not s.leader or s.__dict__.get('autoscaler') is None:
+            return None
+        return s.autoscaler.stats()
+
+    @cached_property
+    def autoscaler(s):
+        """The autoscale.Autoscaler of our cluster or None if
+        simsvc.cluster.autoscale is not enabled or we have no cluster.
+        """
+        lat = dask.config.get('simsvc.cluster.autoscale.target-latency')
+        if lat is None:
+            return None
+        if s.cluster is None:
+            s.logger.warning("simsvc.cluster.autoscale needs"
+                             " simsvc.cluster.type; ignored")
+            return None
+        return autoscale.Autoscaler(s)
+
     @cached_property
     def client(s):
         """Our Dask client
@@ -153,14 +617,445 @@ class TaskFlask(db.DBFlask):
                 s.logger.warning("Scheduler connection timed out; retrying")
         if hasattr(model, 'worker_callback'):
             cli.register_worker_callbacks(model.worker_callback)
+        try:
+            reg = (getattr(cli, 'register_plugin', None)
+                   or cli.register_scheduler_plugin)
+            reg(plugin.Task_tracker())
+            cli.subscribe_topic(plugin.topic, s.task_event)
+        except:
+            s.logger.exception("Failed to register scheduler plugin."
+                               "  Running jobs will be reported as scheduled.")
+        cli.subscribe_topic(progress_topic, s.progress_event)
         return cli
 
-    def flush_updates(s, conn=None):
+    @cached_property
+    def result_store(s):
+        """Where to save large results (see .store) or None to keep
+        them in the database.  Configured by simsvc.results.
+        """
+        return store.make_store(dask.config.get('simsvc.results'))
+
+    def task_event(s, ev):
+        """Handle an event from plugin.Task_tracker.
+        Record start and finish times in tasks and schedule a database
+        update to mark started jobs as running.  This is called in the
+        Dask client thread.  Events of jobs that launch_many has
+        submitted but not yet attached are kept for it to replay.
+        """
+        t, (jid, key, state) = ev
+        with s._launch_lock:
+            task = s.tasks.get(jid)
+            if task is None:
+                early = s._launching.get(jid)
+                if early is not None:
+                    early.append(ev)
+                return
+        if state == 'processing':
+            if task.started is None:
+                task.started = t
+                s.schedule_update((s.mark_running, jid, t))
+        elif key == task.future.key:
+            task.finished = t
+
+    def progress_event(s, ev):
+        """Handle a progress report from Task_spec.progress.
+        Pass it to the monitor and schedule saving it in the job,
+        unless a save is already pending, in which case the latest
+        report is saved.  This is called in the Dask client thread.
+        """
+        t, (jid, fraction, values) = ev
+        if jid not in s.tasks:
+            return
+        with s._progress_lock:
+            pending = jid in s.progress
+            s.progress[jid] = (fraction, values)
+        if not pending:
+            s.schedule_update((s.save_progress, jid))
+        report = getattr(s.monitor, 'progress', None)
+        if report is not None:
+            try:
+                report(jid, fraction, values)
+            except:
+                s.logger.exception("monitor.progress failed for job %s", jid)
+
+    def save_progress(s, conn, res, jid):
+        """A database update for saving the latest progress of job jid.
+        """
+        with s._progress_lock:
+            p = s.progress.pop(jid, None)
+        st = db.get_state(conn)
+        status = st.status(jid)
+        if p is not None and status is not None and status.active():
+            j = st.jobs[jid]
+            j.progress, j.partial = p
+
+    def upstream_inputs(s, job, st=None, batch=None, bound=None):
+        """Return a dict name -> value for the inputs of db.Job job that
+        refer to results of other jobs (see upstream_ref).  Results of
+        jobs that have a task, are waiting to be gathered or are being
+        launched with job (batch: job id -> Delayed) are Delayeds
+        depending on the upstream computation, thus computed on the
+        cluster without passing through the server.  Results of jobs
+        that are DONE in App_state st are loaded from the database.
+        Otherwise the value is a Delayed that raises Dependency_error,
+        failing the dependent task.  If bound is given, it is updated
+        with the futures and Delayeds depended on (job id -> value).
+        """
+        res = {}
+        for k, v in job.inputs.items():
+            ref = upstream_ref(v)
+            if ref is None:
+                continue
+            ujid, name = ref
+            task = s.tasks.get(ujid)
+            fut = (task.future if task is not None
+                   else s.gathers.get(ujid, (batch or {}).get(ujid)))
+            uj = None if st is None else st.jobs.get(ujid)
+            if fut is not None:
+                res[k] = dask.delayed(operator.getitem, pure=True)(fut, name)
+                if bound is not None:
+                    bound[ujid] = fut
+            elif (uj is not None and uj.status == db.Job_status.DONE
+                  and name in uj.results):
+                res[k] = store.load_value(uj.results[name])
+            else:
+                res[k] = dask.delayed(_upstream_error, pure=True)(ujid, name)
+        return res
+
+    def upstream_pending(s, job, st):
+        """Return true if db.Job job refers to results of an active job
+        in App_state st that has no task or future to gather, e.g., is
+        waiting for fair share or is being saved: upstream_inputs
+        would not find its result.
+        """
+        for v in job.inputs.values():
+            ref = upstream_ref(v)
+            if ref is None:
+                continue
+            ujid = ref[0]
+            status = st.status(ujid)
+            if (status is not None and status.active()
+                    and ujid not in s.tasks and ujid not in s.gathers):
+                return True
+        return False
+
+    def check_upstream(s, st, job):
+        """Raise Dependency_error unless every input of db.Job job that
+        refers to a result of another job (see upstream_ref) refers to
+        an active job or an existing result of a DONE job in App_state
+        st.
+        """
+        for v in job.inputs.values():
+            ref = upstream_ref(v)
+            if ref is None:
+                continue
+            ujid, name = ref
+            status = st.status(ujid)
+            if status is None:
+                raise Dependency_error("No job %s" % ujid)
+            elif status == db.Job_status.DONE:
+                if name not in st.jobs[ujid].results:
+                    raise Dependency_error("Job %s has no result %s"
+                                           % (ujid, name))
+            elif not status.active():
+                raise Dependency_error("Job %s is %s" % (ujid, status.name))
+
+    def task_key(s, jid, job, upstream=()):
+        """Return the Dask key for the task of job jid, a db.Job.
+        The key is derived from the job id and inputs, so that a
+        restarted server can find the task's published dataset (see
+        sync_tasks).  It names only the alias made by keyed: the model's
+        graph keeps its own keys, thus relaunching the job computes it
+        anew rather than reusing a task still on the cluster.
+        Automatic retries (job.attempts) get a new key, as do tasks
+        bound to different upstream tasks (upstream: their keys).
+        """
+        key = "simsvc-job-%d-%s" % (jid, job.input_hash()[:16])
+        if job.attempts:
+            key += "-r%d" % job.attempts
+        if upstream:
+            key += "-u" + dask.base.tokenize(*upstream)[:8]
+        return key
+
+    def unpublish_released(s):
+        """Unpublish the task datasets in released and clear it.
+        Also unpublish shared inputs that release_inputs has released
+        unless they have been shared again.  Errors are logged and
+        suppressed.
+        """
+        rel = s.released if dask.config.get('simsvc.tasks.reattach') else []
+        s.released = []
+        uns, s._unshared = s._unshared, []
+        rel = rel + [key for key in uns if key not in s.shared]
+        if not rel:
+            return
+        def unpublish():
+            for key in rel:
+                try:
+                    s.client.unpublish_dataset(key)
+                except KeyError:
+                    pass
+        try:
+            s.offload(unpublish)
+        except:
+            s.logger.exception("Failed to unpublish %s datasets", len(rel))
+
+    def reattach(s, conn, jids):
+        """Reattach to surviving tasks of active jobs.
+
+        jids are ids of active jobs that have no task in this process,
+        most likely because the server was restarted.  Those whose
+        task_key is published as a dataset on the scheduler get a Task
+        for the published future; its results are then saved as if the
+        task had been launched by this process.  Return the set of job
+        ids reattached.  Published simsvc tasks that do not belong to
+        an active job are scheduled for release.  conn is a database
+        connection.  Shared inputs of reattached jobs are shared
+        again and other shared inputs released.  No-op unless
+        simsvc.tasks.reattach is enabled.
+        """
+        if not dask.config.get('simsvc.tasks.reattach'):
+            return set()
+        st = db.get_state(conn)
+        pub = set(s.client.list_datasets())
+        done = set()
+        for jid in jids:
+            job = st.jobs[jid]
+            if job.task_key in pub:
+                try:
+                    fut = s.client.get_dataset(job.task_key)
+                except KeyError:
+                    continue
+                # The previous server released the shared inputs.
+                s.attach(jid, job, fut,
+                         Cancel_flag(jid, s.client, job.task_key),
+                         s.share_inputs(job).values())
+                done.add(jid)
+                s.logger.info("Reattached job %s", jid)
+        for key in pub:
+            if not isinstance(key, str):
+                continue
+            if key.startswith("simsvc-input-"):
+                if key not in s.shared:
+                    s._unshared.append(key)
+                continue
+            if not key.startswith("simsvc-job-"):
+                continue
+            try:
+                jid = int(key.split("-")[2])
+            except ValueError:
+                continue
+            status = st.status(jid)
+            if (status is None or not status.active()
+                or st.jobs[jid].task_key != key):
+                s.logger.info("Releasing orphan task %s", key)
+                s.released.append(key)
+        return done
+
+    def _large_inputs(s, values, lim):
+        # Return {name: Dask key} of the values (a mapping) that
+        # pickle to at least lim bytes.  The key is a content hash.
+        out = {}
+        for k, v in values.items():
+            if v is None or isinstance(v, (bool, int, float)):
+                continue
+            b = pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(b) >= lim:
+                out[k] = "simsvc-input-" + hashlib.sha256(b).hexdigest()[:32]
+        return out
+
+    def share_inputs(s, job):
+        """Scatter the large inputs of db.Job job to the workers.
+
+        Inputs that pickle to at least simsvc.tasks.scatter-min-bytes
+        are scattered (broadcast) once per content hash and shared by
+        all tasks whose inputs include them.  They are scattered in
+        pickled form, which Dask transfers much faster than, e.g., long
+        lists.  They are also published as datasets named by their
+        keys, for resolve_shared on workers that lack a copy.  Large defaults are only
+        found once per Defaults_snapshot version.  Return a dict input
+        name -> Dask key for Task_spec and take a reference to each
+        value for the caller; pass the keys to release_inputs when done.
+        The value is released when the last reference is.
+        """
+        lim = dask.config.get('simsvc.tasks.scatter-min-bytes')
+        if lim is None:
+            return {}
+        keys = {}
+        if job.defaults is not None:
+            ver = job.defaults.version
+            dk = s._default_keys.get(ver)
+            if dk is None:
+                dk = s._default_keys[ver] = s._large_inputs(
+                    job.defaults.values, lim)
+            keys.update((k, key) for k, key in dk.items()
+                        if k not in job.overrides)
+        keys.update(s._large_inputs(job.overrides, lim))
+        new = {}
+        with s._shared_lock:
+            for k, key in keys.items():
+                ent = s.shared.get(key)
+                if ent is None:
+                    new[key] = k
+                else:
+                    ent[1] += 1
+        if not new:
+            return keys
+        try:
+            futs = s.client.scatter({key: pickle.dumps(
+                                         job.inputs[k],
+                                         protocol=pickle.HIGHEST_PROTOCOL)
+                                     for key, k in new.items()},
+                                    broadcast=True, hash=False)
+            s.client.publish_dataset(override=True, **futs)
+        except:
+            s.release_inputs(key for key in keys.values() if key not in new)
+            raise
+        with s._shared_lock:
+            for key in keys.values():
+                if key in new:
+                    s.shared.setdefault(key, [futs[key], 0])[1] += 1
+        s.logger.debug("Scattered %s inputs", len(new))
+        return keys
+
+    def release_inputs(s, keys):
+        """Release references to shared inputs taken by share_inputs.
+        Values without references are unpublished by
+        unpublish_released.  This may be called from any thread.
+        """
+        with s._shared_lock:
+            for key in keys:
+                ent = s.shared.get(key)
+                if ent is not None:
+                    ent[1] -= 1
+                    if ent[1] <= 0:
+                        del s.shared[key]
+                        s._unshared.append(key)
+
+    def mark_running(s, conn, res, jid, t):
+        """A database update for marking a job running since time t.
+        """
+        st = db.get_state(conn)
+        if st.status(jid) == db.Job_status.SCHEDULED:
+            st.set_status(jid, db.Job_status.RUNNING)
+            st.jobs[jid].started = t
+
+    def cache_key(s, job):
+        """Return the result cache key for db.Job job.
+        Return None if the cache is disabled.
+        """
+        if not dask.config.get('simsvc.cache.enabled'):
+            return None
+        ver = dask.config.get('simsvc.cache.model-version')
+        if ver is None:
+            ver = getattr(model, 'version', None)
+        return util.canonical_hash(
+            [ver, job.input_hash(dask.config.get('simsvc.cache.float-digits'))])
+
+    def cache_result(s, st, jid, job):
+        """Add a done job to the result cache and prune the cache.
+        st is the App_state.  No-op unless job.cache_key is set.
+        """
+        if job.cache_key is None:
+            return
+        now = time.time()
+        st.cache.add(job.cache_key, jid, now)
+        st.cache.prune(now, dask.config.get('simsvc.cache.max-entries'),
+                       dask.config.get('simsvc.cache.ttl'))
+
+    def submit(s, conn, jobs, use_cache=True):
+        """Complete jobs from the result cache or launch them.
+
+        jobs is a sequence of (job id, db.Job) pairs of new jobs.  Jobs
+        whose inputs hash to an entry in the result cache get a copy of
+        the cached results and DONE status, and are reported to the
+        monitor as terminated when conn commits (by the leader, via
+        App_state.unreported, if this process is not the leader, because
+        only the leader emits events).  The rest are launched with
+        launch_many and their cache_key set so their results are cached
+        once done.  If use_cache is false or the cache is disabled, all
+        jobs are launched and none will be cached.  Transaction handling
+        is as with launch.  If this process is not the leader, jobs
+        are marked SCHEDULED and added to App_state.unlaunched instead
+        of launching them.
+
+        Inputs that refer to results of other jobs are checked with
+        check_upstream, resource requirements with resources and
+        priorities with priority, which raise Input_error before
+        anything is launched.
+        """
+        st = db.get_state(conn)
+        for jid, job in jobs:
+            s.check_upstream(st, job)
+            s.resources(job)
+            s.priority(job)
+        ttl = dask.config.get('simsvc.cache.ttl')
+        now = time.time()
+        rest = []
+        hits = []
+        for jid, job in jobs:
+            key = s.cache_key(job) if use_cache else None
+            if key is None:
+                rest.append((jid, job))
+                continue
+            src = st.cache.lookup(key, st.jobs, now, ttl)
+            if src is None:
+                s.cache_misses += 1
+                job.cache_key = key
+                rest.append((jid, job))
+            else:
+                s.cache_hits += 1
+                job.save_results(src.results, s.result_store)
+                job.finished = now
+                st.set_status(jid, db.Job_status.DONE)
+                hits.append((jid, "done"))
+        if hits and s.leader:
+            s.report_on_commit(conn, hits)
+        else:
+            for jid, status in hits:
+                st.unreported.insert(jid)
+        if not rest:
+            return
+        if s.leader:
+            s.dispatch(rest, st)
+            for jid, job in rest:
+                st.reindex(jid)
+        else:
+            for jid, job in rest:
+                st.set_status(jid, db.Job_status.SCHEDULED)
+                st.unlaunched.insert(jid)
+
+    def gather_finished(s):
+        """Gather the results of futures in gathers and clear it.
+        Return a dict job id -> result.  Errors are logged and the
+        failed futures omitted.
+        """
+        s.pending_since = None
+        gat = s.gathers
+        s.gathers = {}
+        if gat:
+            s.logger.debug("Gathering %s futures", len(gat))
+            res = s.offload(s.client.gather, gat, errors='skip')
+            if len(res) < len(gat):
+                bad = gat.keys() - res.keys()
+                s.logger.error("Errors gathering %s futures: %s",
+                               len(bad), bad)
+        else:
+            res = {}
+        if s._regathered:
+            res.update(s._regathered)
+            s._regathered = {}
+        return res
+
+    def flush_updates(s, conn=None, res=None):
         """Perform any scheduled database updates.
 
         A database connection may be provided; if not, creates and
         commits its own transaction.  In either case, updates are bundled
-        into the same transaction.
+        into the same transaction.  res is the result of
+        gather_finished, called here if None.  Callers that create
+        the transaction should gather first: that keeps the
+        transaction short and less likely to conflict.
 
         Updates that raise TimeoutError are re-queued after the whole
         queue has been processed.  Before raising such an update
@@ -169,10 +1064,15 @@ class TaskFlask(db.DBFlask):
 
         Any other exceptions from updates are logged and suppressed.
         They do not cause a retry; the failed updates are removed
-        from the queue.  It is also possible that commit will fail;
-        there is no provision for retrying that.
+        from the queue.  It is also possible that commit will fail.
+        If it fails on a conflict in a transaction created here or by
+        sync_tasks, the updates are scheduled again (see
+        update_transaction).  Other commit failures are not retried.
 
-        Should be called before any request involving jobs.
+        Normally called periodically by a background drainer
+        (see create_app).  Request handlers only see updates once their
+        transaction has been committed.  In threading mode request
+        threads call this concurrently; they take turns.
 
         Joining s.updates is deprecated and not very useful: it waits
         for all update functions to be called and return but not for
@@ -180,19 +1080,16 @@ class TaskFlask(db.DBFlask):
         SimpleQueue at some point.
         """
         if conn is None:
-            with s.transact("flush_updates") as conn:
-                return s.flush_updates(conn)
-        gat = s.gathers
-        s.gathers = {}
-        if gat:
-            s.logger.debug("Gathering %s futures", len(gat))
-            res = s.client.gather(gat, errors='skip')
-            if len(res) < len(gat):
-                bad = gat.keys() - res.keys()
-                s.logger.error("Errors gathering %s futures: %s",
-                               len(bad), bad)
-        else:
-            res = {}
+            with s._flush_lock:
+                res = s.gather_finished()
+                with s.update_transaction("flush_updates") as conn:
+                    s.flush_updates(conn, res)
+            # Also after a conflict, which update_transaction suppresses.
+            return
+        if res is None:
+            res = s.gather_finished()
+        if s._applied is not None:
+            s._applied_res = res
         s.logger.debug("Flushing approximately %s updates", s.updates.qsize())
         bad = []
         while True:
@@ -202,6 +1099,8 @@ class TaskFlask(db.DBFlask):
                     upd[0](conn, res, *upd[1:])
                 else:
                     upd(conn, res)
+                if s._applied is not None:
+                    s._applied.append(upd)
             except queue.Empty:
                 break
             except TimeoutError:
@@ -210,98 +1109,541 @@ class TaskFlask(db.DBFlask):
                 s.logger.exception("Scheduled update failed.")
             s.updates.task_done()
         for b in bad:
-            s.updates.put(b)
+            s.schedule_update(b)
+        s.launch_waiting(conn)
+        if s.leader:
+            s.adopt_jobs(conn)
+            s.speculate(conn)
+            if s.autoscaler is not None:
+                try:
+                    s.autoscaler.step()
+                except:
+                    s.logger.exception("Autoscaling failed")
+        s.drained_at = time.monotonic()
+
+    def adopt_jobs(s, conn):
+        """Handle requests from frontends that are not the leader.
+        Process App_state.cancel_requests, report the jobs in
+        App_state.unreported as terminated, then launch the jobs in
+        App_state.unlaunched.  conn is a database connection.  Launch
+        errors are logged and suppressed; sync_tasks will retry later.
+        """
+        st = db.get_state(conn)
+        for jid in list(st.unreported.keys(1)):
+            st.unreported.remove(jid)
+            s.terminated.append((jid, "done"))
+        for jid, dele in list(st.cancel_requests.items()):
+            del st.cancel_requests[jid]
+            if not s.cancel(jid, bool(dele)) and dele and jid in st.jobs:
+                st.close_job(jid)
+        todo = []
+        for jid in list(st.unlaunched.keys(1)):
+            st.unlaunched.remove(jid)
+            status = st.status(jid)
+            # Already launched if a previous adopt_jobs conflicted.
+            if status is not None and status.active() and jid not in s.tasks:
+                todo.append((jid, st.jobs[jid]))
+        if not todo:
+            return
+        try:
+            s.dispatch(todo, st)
+            for jid, job in todo:
+                st.reindex(jid)
+        except:
+            s.logger.exception("Failed to launch %s new jobs", len(todo))
+
+    def defer_cancel(s, conn, jid, delete=False):
+        """Ask the leader to cancel job jid.
+        If this process is not the leader and the job is active, mark
+        it CANCELLED, add it to App_state.cancel_requests and return
+        true.  Otherwise return false: use cancel instead.  If delete
+        is true, the leader deletes the job after cancelling it.
+        """
+        if s.leader:
+            return False
+        st = db.get_state(conn)
+        status = st.status(jid)
+        if status is None or not status.active():
+            return False
+        st.set_status(jid, db.Job_status.CANCELLED)
+        st.cancel_requests[jid] = int(delete)
+        return True
 
     def refresh_jobs(s, conn=None):
-        """Check if any scheduled jobs have started.  If so, record in the
-        database.  A database connection may be provided; if not,
-        creates and commits its own transaction.  Also check that each
-        task corresponds to an active job in the database.  Cancel any
-        task that does not.
+        """Check that each task corresponds to an active job in the
+        database.  Cancel any task that does not.  A database connection
+        may be provided; if not, creates and commits its own transaction.
 
-        Should be called before any request that needs to distinguish
-        between scheduled and running jobs.
+        This walks all tasks and is called periodically by sync_tasks,
+        not by requests.  Running status is tracked incrementally by
+        task_event instead.
         """
         if conn is None:
             with s.transact("refresh_jobs") as conn:
                 return s.refresh_jobs(conn)
-        jobs = db.get_state(conn).jobs
-        for jid, (fut, canc) in list(s.tasks.items()):
+        st = db.get_state(conn)
+        for jid, task in list(s.tasks.items()):
             # task_done will clean this up or is doing it now.
-            if fut.done():
+            if task.future.done():
                 continue
-            job = jobs.get(jid)
-            if job is None:
+            status = st.status(jid)
+            if status is None:
                 s.logger.error("Cancelling unknown task %s.", jid)
                 s.cancel(jid)
-            elif not job.status.active():
+            elif status == db.Job_status.CANCELLED:
+                s.cancel(jid)
+            elif not status.active():
                 s.logger.error("Cancelling task %s with invalid status %s",
-                               jid, job.status.name)
-                job.status = db.Job_status.INVALID
+                               jid, status.name)
+                st.set_status(jid, db.Job_status.INVALID)
                 s.cancel(jid)
-            # This does not work because Dask futures don't implement running.
-            # elif fut.running() and job.status == db.Job_status.SCHEDULED:
-            #     job.status = db.Job_status.RUNNING
 
     def task_done(s, jid, fut):
         """Callback when a job is done.
 
         jid is a job id, fut its future.  Schedule a database
         update for saving results and remove the job from tasks.
+
+        fut may also be a speculative duplicate (see speculate).  The
+        first of the two to finish wins and the other is cancelled,
+        except that a failed duplicate only ends itself.
         """
-        assert s.tasks[jid][0] == fut
         assert fut.done()
+        with s._done_lock:
+            task = s.tasks.get(jid)
+            if task is None or (fut is not task.future
+                                and fut is not task.duplicate):
+                # The loser of a speculative race.
+                return
+            if task.duplicate is not None and (
+                    fut is task.duplicate and fut.status != 'finished'
+                    or fut.status == 'error'):
+                # One of the two failed; the other carries on.
+                if fut is task.future:
+                    task.future = task.duplicate
+                task.duplicate = None
+                s.logger.info("Job %s: a duplicate task ended (%s)",
+                              jid, fut.status)
+                return
+            dup_won = fut is task.duplicate
+            loser = task.future if dup_won else task.duplicate
+            task.future, task.duplicate = fut, None
+            del s.tasks[jid]
+        fin = task.finished or time.time()
+        if loser is not None:
+            s.logger.info("Job %s: %s finished first, cancelling the other",
+                          jid, "duplicate" if dup_won else "original")
+            task.cancel.set(True)
+            s.cancelled[task.cancel] = time.monotonic()
+            loser.cancel()
+        if fut.status == 'finished' and not dup_won:
+            s.runtimes.append(fin - (task.started or task.launched))
         def save_job(conn, res):
-            job = db.get_state(conn).jobs.get(jid)
+            # Our future keeps the result until gathered.
+            s.released.append(task.key)
+            st = db.get_state(conn)
+            job = st.jobs.get(jid)
             if job is None:
                 s.logger.error("Job %s is gone.  Not saving it then.", jid)
+                s.terminated.append((jid, "cancelled"))
                 return
+            job.finished = fin
             try:
                 r = res.get(jid)
                 if r is None:
                     r = timeout_kluge(fut.result, s.logger)
-                job.save_results(r)
+                job.save_results(r, s.result_store)
+                if job.result_file is not None:
+                    s.written.append(job.result_file)
             except CancelledError:
                 s.logger.debug("Job %s cancelled", jid)
                 # We sometimes cancel invalid tasks.
                 if job.status != db.Job_status.INVALID:
-                    job.status = db.Job_status.CANCELLED
+                    st.set_status(jid, db.Job_status.CANCELLED)
+                s.terminated.append((jid, "cancelled"))
             except TimeoutError:
                 s.logger.error("Timeout fetching job %s, will retry", jid)
                 s.gathers[jid] = fut
                 raise
             except:
+                if (s.rebind(st, jid, job, task)
+                        or s.retry_job(st, jid, job, sys.exc_info()[1])):
+                    return
                 s.logger.debug("Job %s failed", jid)
-                job.status = db.Job_status.FAILED
+                st.set_status(jid, db.Job_status.FAILED)
                 job.error = "".join(tb.format_exception(*sys.exc_info()))
+                s.terminated.append((jid, "failed"))
             else:
                 s.logger.debug("Job %s done", jid)
-                job.status = db.Job_status.DONE
+                st.set_status(jid, db.Job_status.DONE)
+                s.cache_result(st, jid, job)
+                s.terminated.append((jid, "done"))
         s.gathers[jid] = fut
-        s.updates.put(save_job)
-        del s.tasks[jid]
+        s.schedule_update(save_job)
+        s.release_inputs(task.shared)
+        s.in_flight[task.owner] -= 1
+        if s.in_flight[task.owner] <= 0:
+            del s.in_flight[task.owner]
         s.logger.debug("Task %s done", jid)
 
-    def launch(s, jid, job):
+    def launch(s, jid, job, st=None):
         """Launch a task.
         jid is a job id, job is a db.Job.  This modifies job.
         Caller should provide a transaction and commit if launch returns.
         Otherwise we may have a running job that is not in the database.
+        The caller should also call db.App_state.reindex for the job,
+        as this changes its status.  st is the App_state, needed for
+        inputs that refer to results of finished jobs (see
+        upstream_inputs).
+        """
+        s.launch_many([(jid, job)], st)
+
+    @staticmethod
+    def priority(job):
+        """Return the Dask priority of db.Job job.
+        That is job.priority unless None, otherwise the input
+        simsvc.priority, defaulting to 0.  Higher runs first.  Raise
+        Input_error if the input is not a number.
+        """
+        p = job.priority
+        if p is None:
+            p = job.inputs.get('simsvc.priority', 0)
+        try:
+            return int(p)
+        except (TypeError, ValueError, OverflowError):
+            raise Input_error("simsvc.priority must be a number")
+
+    @staticmethod
+    def resources(job):
+        """Return the Dask worker resources required by the task of
+        db.Job job: simsvc.tasks.resources updated with the input
+        simsvc.resources, both dicts name -> amount.  Zero amounts are
+        dropped.  Raise Input_error if the input is not such a dict.
         """
-        canc = Bogo_var()
-        canc.set(False)
-        spec = Task_spec(jid, job)
-        fut = s.client.compute(model.task(spec, canc))
-        s.tasks[jid] = fut, canc
-        job.status = db.Job_status.SCHEDULED
+        req = job.inputs.get('simsvc.resources', {})
+        if not (isinstance(req, Mapping)
+                and all(isinstance(k, str) and isinstance(v, (int, float))
+                        and v >= 0 for k, v in req.items())):
+            raise Input_error("simsvc.resources must map names"
+                              " to non-negative numbers")
+        res = dict(dask.config.get('simsvc.tasks.resources') or {})
+        res.update(req)
+        return {k: v for k, v in res.items() if v}
+
+    def check_resources(s, reqs):
+        """Log a warning for each of reqs (resource dicts) that no
+        current worker satisfies.  Such tasks wait until a worker that
+        does joins the cluster.
+        """
+        workers = s.client.scheduler_info()['workers'].values()
+        have = [w.get('resources', {}) for w in workers]
+        for req in reqs:
+            if not any(all(h.get(k, 0) >= v for k, v in req.items())
+                       for h in have):
+                s.logger.warning("No worker has resources %s", req)
+
+    def task_delayed(s, jid, job, key, canc, shared, up):
+        """Return (Delayed, resources) for the task of job jid.
+        job is the db.Job, key the Dask key to compute it under, canc
+        its Cancel_flag, shared as from share_inputs and up as from
+        upstream_inputs.  resources is as from resources; the tasks
+        are annotated with it.
+        """
+        spec = Task_spec(jid, job, shared)
+        ann = {plugin.annotation: jid}
+        res = s.resources(job)
+        if res:
+            ann['resources'] = res
+        with dask.annotate(**ann):
+            if up:
+                spec = dask.delayed(_with_upstream, pure=False)(spec, up)
+            return keyed(model.task(spec, canc), key), res
+
+    def rebind(s, st, jid, job, task):
+        """Relaunch job jid if its Task task failed because a future
+        that it took inputs from (task.upstream) failed or was
+        cancelled while the upstream job remains active in App_state
+        st, i.e., is being retried or continued by a duplicate.  The
+        relaunched task depends on the new upstream task (or waits
+        for it, see dispatch).  job is the db.Job.  Return true if
+        relaunched.
+        """
+        lost = [u for u, f in task.upstream.items()
+                if f.status in ('error', 'cancelled')
+                and (st.status(u) or db.Job_status.INVALID).active()]
+        if not (lost and s.leader and job.status.active()):
+            return False
+        try:
+            if s.relaunch(st, jid, job):
+                s.logger.info("Relaunching job %s after upstream jobs %s"
+                              " failed and were relaunched", jid, lost)
+        except:
+            s.logger.exception("Failed to rebind job %s", jid)
+            return False
+        return True
+
+    def relaunch(s, st, jid, job):
+        """Dispatch job jid, whose task has ended, again from a database
+        update in App_state st.  job is the db.Job.  Return true if
+        dispatched, false if an earlier run of the update already did
+        that in a transaction that failed on a conflict (see
+        relaunched).  Then only the state of the job in the database is
+        restored, because the new task may already be running or even
+        finished.
+        """
+        if jid in s.relaunched:
+            key = s.relaunched[jid]
+            job.status = db.Job_status.SCHEDULED
+            if key is not None:
+                job.started = job.finished = None
+                job.task_key = key
+            st.reindex(jid)
+            return False
+        s.dispatch([(jid, job)], st)
+        task = s.tasks.get(jid)
+        s.relaunched[jid] = None if task is None else task.key
+        st.reindex(jid)
+        return True
+
+    def retry_job(s, st, jid, job, exc):
+        """Relaunch job jid after its task failed with exception exc,
+        if retryable(exc) and the job has been retried fewer than
+        simsvc.tasks.retries times.  job is the db.Job and st the
+        App_state.  Return true if relaunched.
+        """
+        lim = dask.config.get('simsvc.tasks.retries') or 0
+        if not (s.leader and job.status.active() and job.attempts < lim
+                and retryable(exc)):
+            return False
+        job.attempts += 1
+        try:
+            new = s.relaunch(st, jid, job)
+        except:
+            s.logger.exception("Failed to retry job %s", jid)
+            job.attempts -= 1
+            return False
+        if new:
+            s.retried += 1
+            s.logger.info("Retrying job %s (attempt %d) after %s", jid,
+                          job.attempts + 1, type(exc).__name__)
+        return True
+
+    def speculate(s, conn):
+        """Launch duplicates of straggling tasks.
+        A task straggles if it has been running longer than
+        simsvc.tasks.speculate.factor times the given quantile of
+        recent run times (runtimes).  Each task gets at most one
+        duplicate, which shares its Cancel_flag; see task_done for
+        how they race.  Disabled if factor is null.  conn is a
+        database connection.
+        """
+        conf = lambda k: dask.config.get('simsvc.tasks.speculate.' + k)
+        factor = conf('factor')
+        if factor is None or len(s.runtimes) < max(1, conf('min-history')):
+            return
+        rts = sorted(s.runtimes)
+        lim = factor * rts[int(conf('quantile') * (len(rts) - 1))]
+        now = time.time()
+        st = None
+        for jid, task in list(s.tasks.items()):
+            start = task.started or task.launched
+            if task.speculated or now - start <= lim or task.future.done():
+                continue
+            task.speculated = True
+            if st is None:
+                st = db.get_state(conn)
+            job = st.jobs.get(jid)
+            if job is None:
+                continue
+            try:
+                s.launch_duplicate(jid, job, task, st)
+            except:
+                s.logger.exception("Failed to duplicate job %s", jid)
+            else:
+                s.duplicated += 1
+                s.logger.info("Job %s has run %.0f s > %.0f s, launched"
+                              " a duplicate", jid, now - start, lim)
+
+    def launch_duplicate(s, jid, job, task, st=None):
+        """Launch a speculative duplicate of Task task of job jid.
+        job is the db.Job.  The duplicate is not published.
+        """
+        sh = s.share_inputs(job)
+        try:
+            d, res = s.task_delayed(jid, job, task.key + "-dup",
+                                    task.cancel, sh,
+                                    s.upstream_inputs(job, st))
+            fut = s.client.compute(d, priority=s.priority(job))
+        except:
+            s.release_inputs(sh.values())
+            raise
+        task.shared.extend(sh.values())
+        task.duplicate = fut
+        fut.add_done_callback(lambda f: s.task_done(jid, f))
+
+    def launch_many(s, jobs, st=None):
+        """Launch tasks for multiple jobs.
+        jobs is a sequence of (job id, db.Job) pairs.  The tasks are
+        submitted to Dask in a single call per distinct priority.
+        Transaction handling and st are as with launch.  If model.task
+        raises, nothing is launched.  This ignores fair share; see
+        dispatch.
+
+        Tasks are annotated with the worker resources that they
+        require (see resources).
+
+        Jobs with inputs that refer to results of other jobs get as
+        spec a Delayed that computes the Task_spec with those inputs
+        resolved (upstream_inputs), thus their tasks depend on the
+        upstream tasks in the Dask graph and start when those finish.
+
+        Each task is computed under task_key, which is also saved in
+        the job.  If simsvc.tasks.reattach is enabled, the futures are
+        published as datasets under their keys (see reattach).  Large
+        inputs are scattered with share_inputs.
+
+        Tasks may start before they are attached.  Their task events
+        are collected meanwhile and replayed to task_event afterwards.
+        """
+        with s._launch_lock:
+            for jid, job in jobs:
+                s._launching[jid] = []
+        cancs = []
+        dels = []
+        shared = []
+        bounds = []
+        batch = {}
+        reqs = {}
+        try:
+            for jid, job in jobs:
+                sh = s.share_inputs(job)
+                shared.append(sh)
+                bound = {}
+                up = s.upstream_inputs(job, st, batch, bound)
+                bounds.append(bound)
+                key = s.task_key(jid, job, [bound[u].key
+                                            for u in sorted(bound)])
+                canc = Cancel_flag(jid, s.client, key)
+                cancs.append(canc)
+                d, res = s.task_delayed(jid, job, key, canc, sh, up)
+                dels.append(d)
+                if res:
+                    reqs[tuple(sorted(res.items()))] = res
+                batch[jid] = d
+            prios = [s.priority(job) for jid, job in jobs]
+            futs = [None] * len(dels)
+            retries = dask.config.get('simsvc.tasks.dask-retries')
+            for p in set(prios):
+                ii = [i for i, q in enumerate(prios) if q == p]
+                pfs = s.client.compute([dels[i] for i in ii], priority=p,
+                                       retries=retries)
+                for i, f in zip(ii, pfs):
+                    futs[i] = f
+            dd.fire_and_forget(futs)
+            if dask.config.get('simsvc.tasks.reattach'):
+                s.client.publish_dataset(override=True,
+                                         **{f.key: f for f in futs})
+        except:
+            for sh in shared:
+                s.release_inputs(sh.values())
+            with s._launch_lock:
+                for jid, job in jobs:
+                    s._launching.pop(jid, None)
+            raise
+        if reqs:
+            s.check_resources(reqs.values())
+        byjob = {jid: fut for (jid, job), fut in zip(jobs, futs)}
+        for (jid, job), fut, canc, sh, bound in zip(
+                jobs, futs, cancs, shared, bounds):
+            job.status = db.Job_status.SCHEDULED
+            job.started = job.finished = None
+            job.task_key = fut.key
+            up = {u: byjob.get(u, f) for u, f in bound.items()}
+            s.attach(jid, job, fut, canc, sh.values(), up)
+        with s._launch_lock:
+            early = [ev for jid, job in jobs
+                     for ev in s._launching.pop(jid, ())]
+        for ev in early:
+            s.task_event(ev)
+
+    def attach(s, jid, job, fut, canc, shared=(), upstream=None):
+        """Add a Task for future fut and Cancel_flag canc of job jid.
+        job is the db.Job.  shared are the keys of shared inputs that
+        the task takes over references to, upstream the futures of the
+        results that it depends on (see Task).  Arrange for task_done
+        to be called when fut terminates and call monitor (save_job
+        reports termination).
+        """
+        s.tasks[jid] = Task(fut, canc, job.owner, list(shared), upstream)
+        s.in_flight[job.owner] += 1
         fut.add_done_callback(lambda f: s.task_done(jid, f))
-        dd.fire_and_forget(fut)
         if s.monitor is not None:
             try:
                 s.monitor(jid, fut)
             except:
                 s.logger.exception("monitor.launch failed for job %s", jid)
 
+    def dispatch(s, jobs, st=None):
+        """Launch jobs, subject to fair share.
+
+        jobs is a sequence of (job id, db.Job) pairs.  Jobs that
+        depend on results of active jobs without a task
+        (upstream_pending) and, if simsvc.fair-share.max-in-flight is
+        set, jobs whose owner already has that many tasks are not
+        launched but marked SCHEDULED and added to waiting.  The rest
+        are passed to launch_many.  Transaction handling and st are as
+        with launch.
+        """
+        lim = dask.config.get('simsvc.fair-share.max-in-flight')
+        now = []
+        nnew = Counter()
+        for jid, job in jobs:
+            o = job.owner
+            if (lim is None or s.in_flight[o] + nnew[o] < lim) and not (
+                    st is not None and s.upstream_pending(job, st)):
+                nnew[o] += 1
+                now.append((jid, job))
+            else:
+                job.status = db.Job_status.SCHEDULED
+                heapq.heappush(s.waiting.setdefault(o, []),
+                               (-s.priority(job), jid))
+        if now:
+            s.launch_many(now, st)
+
+    def launch_waiting(s, conn):
+        """Launch waiting jobs whose owners are below the fair-share limit.
+        conn is a database connection.  Waiting jobs that have been
+        deleted or are no longer active are dropped.  Launch errors are
+        logged and suppressed; sync_tasks will retry later.
+        """
+        if not s.waiting:
+            return
+        lim = dask.config.get('simsvc.fair-share.max-in-flight')
+        st = db.get_state(conn)
+        todo = []
+        for o, q in list(s.waiting.items()):
+            n = len(q) if lim is None else lim - s.in_flight[o]
+            while q and n > 0:
+                prio, jid = heapq.heappop(q)
+                status = st.status(jid)
+                if status is not None and status.active():
+                    if s.upstream_pending(st.jobs[jid], st):
+                        # Retry once its upstream jobs have tasks.
+                        heapq.heappush(q, (prio, jid))
+                        break
+                    todo.append((jid, st.jobs[jid]))
+                    n -= 1
+            if not q:
+                del s.waiting[o]
+        if todo:
+            try:
+                s.launch_many(todo, st)
+                for jid, job in todo:
+                    st.reindex(jid)
+            except:
+                s.logger.exception("Failed to launch %s waiting jobs",
+                                   len(todo))
+
     def cancel(s, jid, delete=False):
         """Attempt to cancel a task.
 
@@ -310,26 +1652,41 @@ class TaskFlask(db.DBFlask):
         arrange for the job to be deleted from the database after the
         task terminates (or immediately if it had already terminated).
         """
-        ent = s.tasks.get(jid)
-        if ent is None:
+        task = s.tasks.get(jid)
+        if task is None:
             return False
-        fut, canc = ent
+        fut, canc = task.future, task.cancel
+        if task.duplicate is not None:
+            task.duplicate.cancel()
         if delete:
             def del_job(conn, res):
                 s.logger.debug("Deleting job %s on cancel", jid)
-                jobs = db.get_state(conn).jobs
-                if jobs[jid].close():
-                    del jobs[jid]
+                db.get_state(conn).close_job(jid)
             def del_on_cancel(fut):
                 if fut.cancelled():
-                    s.updates.put(del_job)
+                    s.schedule_update(del_job)
             fut.add_done_callback(del_on_cancel)
         if fut.done():
             return False
         canc.set(True)
+        s.cancelled[canc] = time.monotonic()
         fut.cancel()
         return True
 
+    def clear_cancelled(s):
+        """Clear cancellation flags older than cancel_grace.
+        Flags are not cleared immediately on termination because a
+        cancelled future terminates before its task has seen the flag.
+        """
+        lim = time.monotonic() - s.cancel_grace
+        for canc, t in list(s.cancelled.items()):
+            if t < lim:
+                try:
+                    canc.set(False)
+                except:
+                    s.logger.exception("Failed to clear %s", canc.event.name)
+                del s.cancelled[canc]
+
     def cancel_all(s, delete=False):
         """Cancel all active tasks.
 
@@ -347,25 +1704,41 @@ class TaskFlask(db.DBFlask):
 
         Compare run-time tasks with active jobs in the database.  Call
         flush_updates, then check that each active job has a task; if
-        not, launch one.  Most likely a previous app instance crashed.
+        not, reattach to its task on the cluster or, failing that,
+        launch one.  Most likely a previous app instance crashed.
         Then call refresh_jobs to ensure that all tasks have an active job.
         Everything is done in a single transaction created here.  When
         launching tasks exceptions are logged and suppressed.
 
         This should be called at startup and periodically.  Calling it
-        at every request may be a bit expensive.  flush_updates and
-        refresh_jobs should be sufficient for that and faster.
+        at every request would be expensive.
         """
+        with s._flush_lock:
+            s._sync_tasks()
+        s.clear_cancelled()
+
+    def _sync_tasks(s):
         live = set(s.tasks)
-        with s.transact("sync_tasks") as conn:
-            s.flush_updates(conn)
-            # Don't relaunch timed out jobs.
-            live |= s.gathers.keys()
-            jobs = db.get_state(conn).jobs
-            for jid, job in jobs.items():
-                if job.status.active() and jid not in live:
+        res = s.gather_finished()
+        with s.update_transaction("sync_tasks") as conn:
+            s.flush_updates(conn, res)
+            # Don't relaunch timed out or just adopted jobs.
+            live |= s.gathers.keys() | s.tasks.keys()
+            live.update(jid for q in s.waiting.values() for _, jid in q)
+            st = db.get_state(conn)
+            active = st.ids_with_status([db.Job_status.SCHEDULED,
+                                         db.Job_status.RUNNING])
+            lost = [jid for jid in active if jid not in live]
+            if lost:
+                try:
+                    live |= s.reattach(conn, lost)
+                except:
+                    s.logger.exception("Failed to reattach tasks")
+            for jid in lost:
+                if jid not in live:
                     try:
-                        s.launch(jid, job)
+                        s.dispatch([(jid, st.jobs[jid])], st)
+                        st.reindex(jid)
                     except:
                         s.logger.exception("Failed to relaunch job %s", jid)
                     else:
@@ -382,16 +1755,31 @@ def refresh_jobs():
     """
     return flask.current_app.refresh_jobs()
 
-def launch(jid, job):
+def launch(jid, job, st=None):
     """Run TaskFlask.launch on current app.
     """
-    return flask.current_app.launch(jid, job)
+    return flask.current_app.launch(jid, job, st)
+
+def launch_many(jobs, st=None):
+    """Run TaskFlask.launch_many on current app.
+    """
+    return flask.current_app.launch_many(jobs, st)
+
+def submit(conn, jobs, use_cache=True):
+    """Run TaskFlask.submit on current app.
+    """
+    return flask.current_app.submit(conn, jobs, use_cache)
 
 def cancel(jid, delete=False):
     """Run TaskFlask.cancel on current app.
     """
     return flask.current_app.cancel(jid, delete)
 
+def defer_cancel(conn, jid, delete=False):
+    """Run TaskFlask.defer_cancel on current app.
+    """
+    return flask.current_app.defer_cancel(conn, jid, delete)
+
 def cancel_all(delete=False):
     """Run TaskFlask.cancel_all on current app.
     """
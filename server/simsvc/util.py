@@ -1,6 +1,6 @@
 """Miscellaneous utilities.
 """
-import os
+import os, json, hashlib
 from http import HTTPStatus
 
 empty_response = ("", HTTPStatus.NO_CONTENT)
@@ -44,3 +44,53 @@ def tryrm(fname):
         os.remove(fname)
     except FileNotFoundError:
         pass
+
+def json_stream(items, pairs=False, chunk=1000):
+    """Generate a JSON array of items in pieces, for streaming responses.
+    If pairs is true, items must be (key, value) pairs and a JSON object
+    is generated instead.  Keys are converted to strings.  Each piece
+    holds up to chunk items.
+    """
+    from flask import json
+    if pairs:
+        fmt = lambda kv: "%s:%s" % (json.dumps(str(kv[0])), json.dumps(kv[1]))
+        opn, cls = "{", "}\n"
+    else:
+        fmt = json.dumps
+        opn, cls = "[", "]\n"
+    yield opn
+    buf = []
+    sep = ""
+    for x in items:
+        buf.append(fmt(x))
+        if len(buf) >= chunk:
+            yield sep + ",".join(buf)
+            buf.clear()
+            sep = ","
+    if buf:
+        yield sep + ",".join(buf)
+    yield cls
+
+def _round_floats(x, digits):
+    if isinstance(x, float):
+        return float("%.*g" % (digits, x))
+    elif isinstance(x, (list, tuple)):
+        return [_round_floats(v, digits) for v in x]
+    elif isinstance(x, dict):
+        return {k: _round_floats(v, digits) for k, v in x.items()}
+    else:
+        return x
+
+def canonical_hash(x, digits=None):
+    """Return a hash of the JSON serialisable value x as a hex string.
+
+    Equal values hash equally regardless of dict order or whether
+    sequences are lists or tuples.  Mappings other than dict (e.g.,
+    OOBTree) must be converted to dict first.  If digits is given,
+    floats are rounded to that many significant digits first, so that
+    nearly equal values hash equally.
+    """
+    if digits is not None:
+        x = _round_floats(x, digits)
+    js = json.dumps(x, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(js.encode()).hexdigest()
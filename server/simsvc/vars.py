@@ -3,10 +3,11 @@
 
 from enum import Enum
 
+import dask, flask
 from flask import Blueprint, jsonify, request, current_app
 import werkzeug.exceptions as wexc
 
-from . import db, util, tasks
+from . import codec, db, series, store, util
 
 get_vars = Blueprint('get_vars', __name__)
 set_vars = Blueprint('set_vars', __name__)
@@ -33,6 +34,28 @@ def _get_vars(st, vt=Vtype.default, job=None):
         else:
             raise ValueError("Unknown vtype %s" % vt)
 
+def _respond(v, name=None):
+    """Return a response for v, encoded as negotiated by the Accept and
+    Accept-Encoding headers (see .codec).  name is the variable name
+    if v is a single variable.  If v refers to arrays in a result
+    store, they are loaded or, in JSON, streamed from there.  Call
+    outside the transaction that v came from.
+    """
+    explicit = {mt for mt, q in request.accept_mimetypes if q > 0}
+    mt = request.accept_mimetypes.best_match(
+        codec.offers(v, name, explicit), codec.JSON)
+    if mt == codec.JSON and store.has_refs(v):
+        resp = flask.Response(store.iter_json(v), mimetype=mt)
+    elif mt == codec.JSON:
+        resp = jsonify(codec.tolists(v))
+    else:
+        resp = flask.Response(codec.encode(
+            v, mt, name, dask.config.get('simsvc.server.array-min-size')),
+                              mimetype=mt)
+    return codec.finish(
+        resp, request.accept_encodings.best_match(codec.encodings()),
+        dask.config.get('simsvc.server.compress-min-bytes'))
+
 @get_vars.route('/')
 def get_all_vars(vtype, job):
     vt = Vtype[vtype]
@@ -40,27 +63,50 @@ def get_all_vars(vtype, job):
     only = request.args.get("only")
     if only is not None:
         only = [vn.strip() for vn in only.split(",")]
-    if vt == Vtype.results:
-        tasks.flush_updates()
     try:
         with db.transact() as conn:
             vars = _get_vars(db.get_state(conn), vt, job)
-            return jsonify({k: vars[k] for k in only} if only
-                           else dict(vars) if values else list(vars))
+            res = ({k: vars[k] for k in only} if only
+                   else dict(vars) if values else list(vars))
     except KeyError as e:
         raise wexc.NotFound("No such variable: %s" % e) from e
+    return _respond(res)
+
+def _select(val, times):
+    """Apply time series selection parameters of the request to val.
+    times is the time vector if val refers to one by name.  Return a
+    new series with explicit times or val if there were no parameters.
+    """
+    args = request.args
+    sel = dict(start=args.get("from", type=float),
+               end=args.get("to", type=float),
+               step=args.get("step", type=int),
+               buckets=args.get("buckets", type=int))
+    if all(x is None for x in sel.values()) and "agg" not in args:
+        return val
+    if not series.is_series(val):
+        raise wexc.BadRequest("Not a time series")
+    try:
+        t, v = series.select(val['times'] if times is None else times,
+                             val['values'], agg=args.get("agg", "mean"),
+                             **sel)
+    except ValueError as e:
+        raise wexc.BadRequest(str(e)) from e
+    return {'times': t, 'values': v}
 
 @get_vars.route('/<var>')
 def get_var(vtype, job, var):
     vt = Vtype[vtype]
-    if vt== Vtype.results:
-        tasks.flush_updates()
+    times = None
     try:
         with db.transact() as conn:
             vars = _get_vars(db.get_state(conn), vt, job)
-            return jsonify(vars[var])
+            val = vars[var]
+            if series.is_series(val) and isinstance(val['times'], str):
+                times = vars.get(val['times'])
     except KeyError as e:
         raise wexc.NotFound from e
+    return _respond(_select(val, times), var)
 
 @set_vars.route('/', methods=['PUT'])
 def set_all_vars():
@@ -68,9 +114,11 @@ def set_all_vars():
     if not isinstance(req, dict):
         raise wexc.UnsupportedMediaType("Not a JSON object")
     with db.transact("set_all_vars") as conn:
-        vars = _get_vars(db.get_state(conn))
+        st = db.get_state(conn)
+        vars = _get_vars(st)
         vars.clear()
         vars.update(req)
+        st.defaults_changed()
         return util.empty_response
 
 @set_vars.route('/<var>', methods=['PUT', 'DELETE'])
@@ -78,7 +126,8 @@ def set_var(var):
     meth = request.method
     try:
         with db.transact("set_var") as conn:
-            vars = _get_vars(db.get_state(conn))
+            st = db.get_state(conn)
+            vars = _get_vars(st)
             if meth == 'DELETE':
                 del vars[var]
             else:
@@ -86,6 +135,7 @@ def set_var(var):
                 if val is None:
                     raise wexc.UnsupportedMediaType("Not JSON data")
                 vars[var] = val
+            st.defaults_changed()
             return util.empty_response
     except KeyError as e:
         raise wexc.NotFound from e
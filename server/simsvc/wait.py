@@ -0,0 +1,133 @@
+"""Waiting for jobs to terminate, for long-polling requests.
+
+Waiting requests register a Waiter with the app's Waiters, which checks
+the job status index on behalf of all of them in one transaction per
+check and wakes those whose jobs have terminated.  With Eventlet the
+update drainer runs the checks and waiters are green threads blocked
+on green events, thus a waiter costs little more than its connection.
+With real threads (threading mode) the waiting threads run the checks
+themselves, one at a time: the others just wait to be woken.
+
+Because checks read the database, they also see jobs that terminated
+on another frontend.
+"""
+
+import threading, time
+
+from . import db
+
+class Waiter(object):
+    """A request waiting for jobs.
+
+    Instance attributes:
+    ids		Set of job ids
+    all		Whether to wait for all of ids to terminate rather than any
+    event	Set when the wait is over
+    """
+    __slots__ = ('ids', 'all', 'event')
+
+    def __init__(s, ids, all, event):
+        s.ids = ids
+        s.all = all
+        s.event = event
+
+    def satisfied(s, done):
+        """Return whether the wait is over when done is the set of
+        terminated ids.
+        """
+        return s.ids <= done if s.all else not s.ids.isdisjoint(done)
+
+def terminated(st, ids):
+    """Return the subset of ids that are inactive or do not exist
+    in App_state st.
+    """
+    done = set()
+    for jid in ids:
+        status = st.status(jid)
+        if status is None or not status.active():
+            done.add(jid)
+    return done
+
+class Waiters(object):
+    """The waiters of an app.
+
+    Constructor arguments, also instance attributes:
+    app		The TaskFlask
+    event_type	Type of Waiter.event, threading.Event or a green
+		equivalent
+    poll_interval
+		If not None, waiting threads flush updates and check
+		for terminated jobs at this interval, one thread at a
+		time.  Otherwise check
+		must be called periodically by someone else.
+    """
+    def __init__(s, app, event_type=threading.Event, poll_interval=None):
+        s.app = app
+        s.event_type = event_type
+        s.poll_interval = poll_interval
+        s.by_job = {}
+        s._lock = threading.Lock()
+        s._poll_lock = threading.Lock()
+
+    def __len__(s):
+        with s._lock:
+            return len({w for ws in s.by_job.values() for w in ws})
+
+    def _add(s, w):
+        with s._lock:
+            for jid in w.ids:
+                s.by_job.setdefault(jid, set()).add(w)
+
+    def _remove(s, w):
+        with s._lock:
+            for jid in w.ids:
+                ws = s.by_job.get(jid)
+                if ws is not None:
+                    ws.discard(w)
+                    if not ws:
+                        del s.by_job[jid]
+
+    def check(s):
+        """Wake the waiters whose jobs have terminated.
+        No-op if there are no waiters.
+        """
+        with s._lock:
+            ids = list(s.by_job)
+        if not ids:
+            return
+        with s.app.db.transaction() as conn:
+            done = terminated(db.get_state(conn), ids)
+        woken = set()
+        with s._lock:
+            for jid in done:
+                woken.update(s.by_job.get(jid, ()))
+        for w in woken:
+            if w.satisfied(done) and not w.event.is_set():
+                w.event.set()
+
+    def wait(s, ids, all=False, timeout=None):
+        """Wait until any (or all) of ids have terminated or timeout
+        seconds have elapsed.  Return true unless timed out.  The caller
+        should check first that the wait is necessary: jobs that
+        terminate before the next check only wake us then.
+        """
+        w = Waiter(frozenset(ids), all, s.event_type())
+        s._add(w)
+        try:
+            if s.poll_interval is None:
+                return w.event.wait(timeout)
+            end = None if timeout is None else time.monotonic() + timeout
+            while True:
+                dt = (s.poll_interval if end is None
+                      else min(s.poll_interval, end - time.monotonic()))
+                if dt <= 0 or w.event.wait(dt):
+                    return w.event.is_set()
+                if s._poll_lock.acquire(blocking=False):
+                    try:
+                        if s.app.leader:
+                            s.app.flush_updates()
+                        s.check()
+                    finally:
+                        s._poll_lock.release()
+        finally:
+            s._remove(w)